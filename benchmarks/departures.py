@@ -0,0 +1,70 @@
+""" Benchmark departure board queries against filtering stop times in python.
+
+Usage: python benchmarks/departures.py [stop_times] [queries]
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from synthetic import write_feed, grid_for_stop_times  # noqa: E402
+
+
+def naive_departures(schedule, stop_id, date, start, limit):
+    service_ids = {s.service_id for s in schedule.services_on(date)}
+    stop = schedule.stops_by_id(stop_id)[0]
+    departures = sorted((st.departure_time, st.trip_id) for st in stop.stop_times
+                        if st.departure_time >= start
+                        and st.trip.service_id in service_ids)
+    return departures[:limit]
+
+
+def bench(label, query, requests):
+    timings = []
+    for request in requests:
+        start = time.perf_counter()
+        query(*request)
+        timings.append(time.perf_counter() - start)
+    print('%-12s median %8.2f ms   p95 %8.2f ms'
+          % (label, 1000 * statistics.median(timings),
+             1000 * sorted(timings)[int(len(timings) * 0.95)]))
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_dir = os.path.join(tmp, 'feed')
+        write_feed(feed_dir, grid=grid_for_stop_times(target))
+        schedule = pygtfs.Schedule(os.path.join(tmp, 'feed.db'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            pygtfs.append_feed(schedule, feed_dir, bulk=True)
+        print('%d stop_times' % schedule.stop_times_query.count())
+
+        stop_ids = [s.stop_id for s in schedule.stops]
+        rng = random.Random(0)
+        requests = [(rng.choice(stop_ids),
+                     datetime.date(2021, 3, 1) + datetime.timedelta(days=rng.randrange(7)),
+                     datetime.timedelta(seconds=rng.randrange(5 * 3600, 23 * 3600)),
+                     10)
+                    for _ in range(queries)]
+
+        bench('departures',
+              lambda stop_id, date, start, limit: schedule.departures(
+                  stop_id, date, start=start, limit=limit),
+              requests)
+        bench('python', lambda *request: naive_departures(schedule, *request),
+              requests[:max(1, queries // 20)])
+
+
+if __name__ == '__main__':
+    main()
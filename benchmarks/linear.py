@@ -0,0 +1,102 @@
+""" Benchmark projecting the stop times of a feed onto their shapes.
+
+Compares linear.reference_feed, which projects every stop pattern once with
+NumPy, with projecting every trip's stops in python, on a sample of trips.
+
+Usage: python benchmarks/linear.py [stop_times] [points_per_hop]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from pygtfs import linear, loader, spatial  # noqa: E402
+from pygtfs.gtfs_entities import ShapeGeometry, ShapePoint  # noqa: E402
+from synthetic import write_feed, grid_for_stop_times  # noqa: E402
+
+
+def densify(schedule, points_per_hop):
+    """ Add points between the points of every shape, for realistic shapes. """
+    rows = []
+    for shape in schedule.session.query(ShapePoint.shape_id).distinct():
+        points = (schedule.session.query(ShapePoint)
+                  .filter(ShapePoint.shape_id == shape.shape_id)
+                  .order_by(ShapePoint.shape_pt_sequence).all())
+        sequence = 0
+        for a, b in zip(points, points[1:] + points[-1:]):
+            steps = points_per_hop if b is not a else 1
+            for k in range(steps):
+                f = k / steps
+                rows.append(dict(
+                    feed_id=a.feed_id, shape_id=a.shape_id,
+                    shape_pt_sequence=sequence,
+                    shape_pt_lat=a.shape_pt_lat + f * (b.shape_pt_lat - a.shape_pt_lat),
+                    shape_pt_lon=a.shape_pt_lon + f * (b.shape_pt_lon - a.shape_pt_lon)))
+                sequence += 1
+    schedule.session.execute(ShapePoint.__table__.delete())
+    schedule.session.execute(ShapePoint.__table__.insert(), rows)
+    schedule.session.execute(ShapeGeometry.__table__.delete())
+    loader._build_shape_geometries(schedule, 1, 5000)
+    schedule.session.commit()
+    return len(rows)
+
+
+def naive(trip):
+    """ The distances of the stops of a trip, projected in python. """
+    points = [(p.shape_pt_lat, p.shape_pt_lon) for p in trip.shape_points]
+    distances = [0.0]
+    for a, b in zip(points, points[1:]):
+        distances.append(distances[-1] + spatial.distance(*a, *b))
+    found = []
+    for stop_time in sorted(trip.stop_times, key=lambda st: st.stop_sequence):
+        stop = stop_time.stop
+        best = None
+        for i, (a, b) in enumerate(zip(points, points[1:])):
+            for k in range(11):
+                f = k / 10
+                lat = a[0] + f * (b[0] - a[0])
+                lon = a[1] + f * (b[1] - a[1])
+                d = spatial.distance(stop.stop_lat, stop.stop_lon, lat, lon)
+                if best is None or d < best[0]:
+                    best = (d, distances[i] + f * (distances[i + 1] - distances[i]))
+        found.append(best[1])
+    return found
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    points_per_hop = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_dir = os.path.join(tmp, 'feed')
+        write_feed(feed_dir, grid=grid_for_stop_times(target))
+        schedule = pygtfs.Schedule(os.path.join(tmp, 'feed.db'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            pygtfs.append_feed(schedule, feed_dir, bulk=True)
+            points = densify(schedule, points_per_hop)
+        trips = schedule.trips
+        print('%d stop_times, %d trips, %d shape points'
+              % (schedule.stop_times_query.count(), len(trips), points))
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            written = linear.reference_feed(schedule, schedule.feeds[0].feed_id)
+        print('reference_feed  %8.2f s  (%d stop times referenced)'
+              % (time.perf_counter() - start, written))
+
+        sample = trips[:20]
+        start = time.perf_counter()
+        for trip in sample:
+            naive(trip)
+        elapsed = time.perf_counter() - start
+        print('python per trip %8.2f s  (extrapolated from %d trips)'
+              % (elapsed * len(trips) / len(sample), len(sample)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+""" Benchmark the loader: rows per second of ORM, bulk and parallel loads.
+
+Usage: python benchmarks/load.py [stop_times]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from synthetic import write_feed, grid_for_stop_times  # noqa: E402
+
+
+def bench(feed_dir, **kwargs):
+    schedule = pygtfs.Schedule(':memory:')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pygtfs.append_feed(schedule, feed_dir, **kwargs)
+    elapsed = time.perf_counter() - start
+    return schedule.stop_times_query.count(), elapsed
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_dir = os.path.join(tmp, 'feed')
+        write_feed(feed_dir, grid=grid_for_stop_times(target))
+        for label, kwargs in (('orm', {}), ('bulk', {'bulk': True}),
+                              ('4 workers', {'workers': 4})):
+            rows, elapsed = bench(feed_dir, **kwargs)
+            print('%-10s %9d stop_times %8.2fs %10.0f rows/s'
+                  % (label, rows, elapsed, rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+""" Benchmark journey planning with RAPTOR.
+
+Compiles the timetable of a weekday of a synthetic grid feed, then times
+earliest arrival and pareto queries between random pairs of stops,
+departing at random times of the day.
+
+Usage: python benchmarks/routing.py [stop_times] [queries]
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from synthetic import write_feed, grid_for_stop_times  # noqa: E402
+
+
+def timed(queries, query):
+    """ The durations in milliseconds of running `query` on every query. """
+    durations = []
+    for origin, destination, departure in queries:
+        start = time.perf_counter()
+        query(origin, destination, departure)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def report(name, durations):
+    durations.sort()
+    print('%-16s median %7.2f ms  p95 %7.2f ms  max %7.2f ms'
+          % (name, statistics.median(durations),
+             durations[int(len(durations) * 0.95)], durations[-1]))
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_dir = os.path.join(tmp, 'feed')
+        write_feed(feed_dir, grid=grid_for_stop_times(target))
+        schedule = pygtfs.Schedule(os.path.join(tmp, 'feed.db'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            pygtfs.append_feed(schedule, feed_dir, bulk=True)
+        print('%d stop_times, %d stops'
+              % (schedule.stop_times_query.count(), len(schedule.stops)))
+
+        start = time.perf_counter()
+        timetable = schedule.timetable(datetime.date(2024, 6, 5))
+        print('compile          %7.2f s   %r'
+              % (time.perf_counter() - start, timetable))
+
+        queries = [(random.choice(timetable.stop_ids),
+                    random.choice(timetable.stop_ids),
+                    datetime.timedelta(seconds=random.randrange(5 * 3600, 22 * 3600)))
+                   for _ in range(count)]
+        report('earliest_arrival', timed(queries, timetable.earliest_arrival))
+        report('pareto', timed(queries, timetable.pareto))
+
+
+if __name__ == '__main__':
+    main()
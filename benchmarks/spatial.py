@@ -0,0 +1,69 @@
+""" Benchmark nearest stop and bounding box lookups of the stop indexes.
+
+Usage: python benchmarks/spatial.py [stops] [queries]
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from pygtfs import spatial  # noqa: E402
+from pygtfs.gtfs_entities import Feed, Stop  # noqa: E402
+
+
+def bench(label, lookup, points):
+    timings = []
+    found = 0
+    for lat, lon in points:
+        start = time.perf_counter()
+        found += len(lookup(lat, lon))
+        timings.append(time.perf_counter() - start)
+    print('%-22s median %7.3f ms   p95 %7.3f ms   %5.1f stops/query'
+          % (label, 1000 * statistics.median(timings),
+             1000 * sorted(timings)[int(len(timings) * 0.95)],
+             found / len(points)))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        schedule = pygtfs.Schedule(os.path.join(tmp, 'stops.db'))
+        feed = Feed(feed_name='spatial')
+        schedule.session.add(feed)
+        schedule.session.flush()
+        # a metropolitan area of about 50 x 50 km
+        schedule.session.execute(Stop.__table__.insert(), [
+            dict(feed_id=feed.feed_id, stop_id='S%d' % i, stop_name='S%d' % i,
+                 stop_lat=40 + rng.random() * 0.45, stop_lon=-74 + rng.random() * 0.6)
+            for i in range(n)])
+        schedule._feeds_changed(feed.feed_id)
+        schedule.session.commit()
+        print('%d stops, %s' % (n, type(schedule._stop_index).__name__))
+
+        points = [(40 + rng.random() * 0.45, -74 + rng.random() * 0.6)
+                  for _ in range(queries)]
+        index = schedule._stop_index
+        grid = spatial._GridIndex(schedule)
+        bench('index near 300 m', lambda lat, lon: index.near(lat, lon, 300), points)
+        bench('grid near 300 m', lambda lat, lon: grid.near(lat, lon, 300), points)
+        bench('index bbox 0.005 deg', lambda lat, lon: index.in_bbox(
+            lat, lon, lat + 0.005, lon + 0.005), points)
+        bench('stops_near 300 m', lambda lat, lon: schedule.stops_near(
+            lat, lon, 300), points)
+        bench('scan near 300 m', lambda lat, lon: [
+            s for s in schedule.session.execute(
+                Stop.__table__.select()) if spatial.distance(
+                    lat, lon, s.stop_lat, s.stop_lon) <= 300],
+            points[:max(1, queries // 100)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+""" Generate synthetic gtfs feeds of arbitrary size for benchmarking.
+
+The network is a square grid of stops, with one bidirectional route per grid
+line. Every route runs a trip in each direction every `headway` minutes over
+the service day.
+"""
+
+import csv
+import math
+import os
+
+
+def _write(directory, name, header, rows):
+    with open(os.path.join(directory, name), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _hms(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def write_feed(directory, grid=10, headway=10, hop_seconds=120,
+               start=5 * 3600, end=24 * 3600):
+    """ Write a feed to `directory`, returning the number of stop times. """
+    os.makedirs(directory, exist_ok=True)
+    _write(directory, 'agency.txt',
+           ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+           [['SYN', 'Synthetic Transit', 'http://example.com', 'UTC']])
+    _write(directory, 'calendar.txt',
+           ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday',
+            'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+           [['WD', 1, 1, 1, 1, 1, 0, 0, '20200101', '20301231'],
+            ['WE', 0, 0, 0, 0, 0, 1, 1, '20200101', '20301231']])
+    _write(directory, 'calendar_dates.txt',
+           ['service_id', 'date', 'exception_type'],
+           [['HOL', '2020%02d%02d' % (m, d), 1]
+            for m in range(1, 13) for d in (1, 15)])
+
+    stops = [('S%d_%d' % (x, y), 40 + y * 0.005, -74 + x * 0.0065)
+             for y in range(grid) for x in range(grid)]
+    _write(directory, 'stops.txt',
+           ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+           [[sid, 'Stop %s' % sid, lat, lon] for sid, lat, lon in stops])
+
+    lines = []
+    for n in range(grid):
+        lines.append(('H%d' % n, ['S%d_%d' % (x, n) for x in range(grid)]))
+        lines.append(('V%d' % n, ['S%d_%d' % (n, y) for y in range(grid)]))
+    _write(directory, 'routes.txt',
+           ['route_id', 'agency_id', 'route_short_name', 'route_long_name',
+            'route_type'],
+           [[rid, 'SYN', rid, 'Line %s' % rid, 3] for rid, _ in lines])
+
+    coords = {sid: (lat, lon) for sid, lat, lon in stops}
+    shapes = []
+    for rid, line_stops in lines:
+        for direction, pattern in enumerate((line_stops, line_stops[::-1])):
+            shape_id = '%s_%d' % (rid, direction)
+            seq = 0
+            for a, b in zip(pattern, pattern[1:] + pattern[-1:]):
+                for k in range(4 if a != b else 1):
+                    lat = coords[a][0] + (coords[b][0] - coords[a][0]) * k / 4
+                    lon = coords[a][1] + (coords[b][1] - coords[a][1]) * k / 4
+                    shapes.append([shape_id, '%.6f' % lat, '%.6f' % lon, seq])
+                    seq += 1
+    _write(directory, 'shapes.txt',
+           ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+           shapes)
+
+    trips = []
+    stop_times = []
+    for rid, line_stops in lines:
+        for direction, pattern in enumerate((line_stops, line_stops[::-1])):
+            for service_id in ('WD', 'WE', 'HOL'):
+                for k, first in enumerate(range(start, end, headway * 60)):
+                    trip_id = '%s_%d_%s_%d' % (rid, direction, service_id, k)
+                    trips.append([rid, service_id, trip_id, pattern[-1],
+                                  direction, '%s_%d' % (rid, direction)])
+                    for seq, sid in enumerate(pattern):
+                        t = first + seq * hop_seconds
+                        stop_times.append([trip_id, _hms(t), _hms(t + 30), sid,
+                                           seq + 1])
+    _write(directory, 'trips.txt',
+           ['route_id', 'service_id', 'trip_id', 'trip_headsign',
+            'direction_id', 'shape_id'], trips)
+    _write(directory, 'stop_times.txt',
+           ['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+            'stop_sequence'], stop_times)
+    return len(stop_times)
+
+
+def grid_for_stop_times(stop_times, headway=10):
+    """ The grid size giving roughly `stop_times` stop times. """
+    trips_per_route = 6 * (19 * 60 // headway)
+    return max(2, int(round(math.pow(stop_times / (2 * trips_per_route), 0.5))))
@@ -0,0 +1,79 @@
+""" Benchmark the read throughput of a thread safe schedule shared by threads.
+
+Usage: python benchmarks/threads.py [stop_times] [queries] [max_threads]
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pygtfs  # noqa: E402
+from synthetic import write_feed, grid_for_stop_times  # noqa: E402
+
+
+def run(schedule, requests, threads):
+    chunks = [requests[i::threads] for i in range(threads)]
+
+    def work(chunk):
+        for kind, arg in chunk:
+            if kind == 'trip':
+                schedule.trips_by_id(arg)[0].stop_times
+            else:
+                stop_id, date, start = arg
+                schedule.departures(stop_id, date, start=start, limit=10)
+        schedule.remove_session()
+
+    workers = [threading.Thread(target=work, args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(requests) / (time.perf_counter() - start)
+
+
+def main():
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    max_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_dir = os.path.join(tmp, 'feed')
+        db = os.path.join(tmp, 'feed.db')
+        write_feed(feed_dir, grid=grid_for_stop_times(target))
+        with contextlib.redirect_stdout(io.StringIO()):
+            pygtfs.append_feed(pygtfs.Schedule(db), feed_dir, bulk=True)
+
+        schedule = pygtfs.Schedule(db, thread_safe=True, read_only=True,
+                                   pool_size=max_threads)
+        print('%d stop_times, %d cpus' % (schedule.stop_times_query.count(),
+                                          os.cpu_count()))
+        stop_ids = [s.stop_id for s in schedule.stops]
+        trip_ids = [t.trip_id for t in schedule.trips]
+        schedule.remove_session()
+        rng = random.Random(0)
+        requests = [
+            ('trip', rng.choice(trip_ids)) if rng.random() < 0.5 else
+            ('departures', (rng.choice(stop_ids),
+                            datetime.date(2021, 3, 1) +
+                            datetime.timedelta(days=rng.randrange(7)),
+                            datetime.timedelta(seconds=rng.randrange(5 * 3600,
+                                                                     23 * 3600))))
+            for _ in range(queries)]
+
+        threads = 1
+        while threads <= max_threads:
+            print('%2d threads %8.0f queries/s' % (threads, run(schedule, requests,
+                                                               threads)))
+            threads *= 2
+
+
+if __name__ == '__main__':
+    main()
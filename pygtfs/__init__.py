@@ -1,10 +1,28 @@
+import importlib
+import sys
 import warnings
 
-from .loader import append_feed, delete_feed, overwrite_feed, list_feeds
-from .schedule import Schedule
-
 try:
     from ._version import version as __version__
 except ImportError:
     warnings.warn("pygtfs should be installed for the version to work")
     __version__ = "0"
+
+# The loader and the schedule import sqlalchemy: they are imported on first
+# use, so that readers like pygtfs.compiled start without it.
+_lazy = {'append_feed': 'loader', 'delete_feed': 'loader',
+         'overwrite_feed': 'loader', 'update_feed': 'loader',
+         'list_feeds': 'loader', 'Schedule': 'schedule'}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    return getattr(importlib.import_module('.' + _lazy[name], __name__), name)
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__
+    from .loader import (append_feed, delete_feed, overwrite_feed,  # noqa: F401
+                         update_feed, list_feeds)
+    from .schedule import Schedule  # noqa: F401
@@ -0,0 +1,209 @@
+""" A schedule for asyncio programs, on SQLAlchemy's async engine.
+
+:py:class:`AsyncSchedule` has the entity accessors of
+:py:class:`pygtfs.Schedule` as coroutines and async iterators::
+
+    schedule = AsyncSchedule("gtfs.db")
+    stops = await schedule.stops
+    trips = await schedule.trips_by_id("AB1")
+    async for stop_time in schedule.stop_times_iter(feed_id=1):
+        ...
+    await schedule.close()
+
+Every call runs in a session of its own, so concurrent calls overlap their
+I/O. The entities are returned detached from their session: relationships
+can't be loaded lazily from async code, so load the ones needed with a
+profile (``with schedule.loading("timetable"):``). Feeds are still loaded
+with the loader and a :py:class:`pygtfs.Schedule`.
+
+Requires the asyncio extra of SQLAlchemy (greenlet), and aiosqlite for
+sqlite or asyncpg for PostgreSQL.
+"""
+
+import contextlib
+import contextvars
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from .gtfs_entities import gtfs_all, Feed, Base
+from .schedule import loading_profiles
+
+# The async drivers used for database urls without one.
+_async_drivers = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+
+
+def _async_url(db_connection):
+    if '://' not in db_connection:
+        db_connection = 'sqlite:///%s' % db_connection
+    url = sqlalchemy.engine.make_url(db_connection)
+    if url.drivername in _async_drivers:
+        url = url.set(drivername='%s+%s' % (url.drivername,
+                                             _async_drivers[url.drivername]))
+    return url
+
+
+class AsyncSchedule:
+    """ The full database, for asyncio programs.
+
+    :param db_connection: Either a sqlalchemy database url or a filename to
+        be used with sqlite. Urls without a driver use aiosqlite or asyncpg.
+    :param pool_size: The number of connections kept open by the pool.
+    :param max_overflow: The number of connections opened beyond `pool_size`
+        when they are all in use.
+    """
+
+    def __init__(self, db_connection, pool_size=None, max_overflow=None):
+        self.db_connection = db_connection
+        options = {}
+        if pool_size is not None:
+            options['pool_size'] = pool_size
+        if max_overflow is not None:
+            options['max_overflow'] = max_overflow
+        self.engine = create_async_engine(_async_url(db_connection), **options)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self._loading_profile = contextvars.ContextVar('loading_profile',
+                                                       default=None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """ Close the connections of the engine. """
+        await self.engine.dispose()
+
+    async def create_all(self):
+        """ Create the tables that don't exist yet. """
+        async with self.engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    @property
+    def loading_profile(self):
+        """ The name of the eager loading profile applied to queries in the
+        current task, see :py:meth:`loading`. """
+        return self._loading_profile.get()
+
+    @contextlib.contextmanager
+    def loading(self, profile):
+        """ Load relationships with the named profile of
+        :py:data:`pygtfs.schedule.loading_profiles` within a ``with`` block,
+        in the current task and the tasks it creates. """
+        if profile is not None and profile not in loading_profiles:
+            raise ValueError('unknown loading profile %r, expected one of %s'
+                             % (profile, ', '.join(loading_profiles)))
+        token = self._loading_profile.set(profile)
+        try:
+            yield self
+        finally:
+            self._loading_profile.reset(token)
+
+    def query(self, entity):
+        """ A ``select`` of `entity`, with the options of the current
+        :py:attr:`loading_profile`. All the entity accessors use it. """
+        statement = sqlalchemy.select(entity)
+        profile = self.loading_profile
+        if profile is not None:
+            statement = statement.options(*loading_profiles[profile].get(entity, ()))
+        return statement
+
+    async def all(self, statement):
+        """ Run a ``select`` of entities, and return them in a list. """
+        async with self.sessionmaker() as session:
+            return (await session.scalars(statement)).unique().all()
+
+    async def execute(self, statement, params=None):
+        """ Run a statement, and return the rows in a list. """
+        async with self.sessionmaker() as session:
+            return (await session.execute(statement, params)).all()
+
+
+def _meta_query_all(entity, docstring=None):
+    def _query_all(instance_self):
+        """ A coroutine returning a list """
+        return instance_self.all(instance_self.query(entity))
+
+    if docstring is not None:
+        _query_all.__doc__ = docstring
+    return property(_query_all)
+
+
+def _meta_query_by_id(entity, docstring=None):
+    async def _query_by_id(self, id):
+        """ A coroutine returning a list of entries with matching ids """
+        return await self.all(self.query(entity).where(entity.id == id))
+    if docstring is not None:
+        _query_by_id.__doc__ = docstring
+    return _query_by_id
+
+
+def _meta_query_raw(entity, docstring=None):
+    def _query_raw(instance_self):
+        """
+            A ``select`` statement that the user can then manipulate
+            manually, and run with :py:meth:`AsyncSchedule.all`
+        """
+        return instance_self.query(entity)
+
+    if docstring is not None:
+        _query_raw.__doc__ = docstring
+    return property(_query_raw)
+
+
+def _meta_query_iter(entity, docstring=None):
+    primary_key = sqlalchemy.inspect(entity).primary_key
+
+    async def _query_iter(self, feed_id=None, batch_size=1000):
+        """
+            An async iterator over the entries, optionally of one feed only.
+
+            Reads `batch_size` entries at a time, paginating on the primary
+            key, so that whole tables can be scanned in constant memory.
+        """
+        mapper = sqlalchemy.inspect(entity)
+        statement = self.query(entity).order_by(*primary_key)
+        if feed_id is not None:
+            statement = statement.where(entity.feed_id == feed_id)
+        last = None
+        while True:
+            page = statement
+            if last is not None:
+                page = page.where(sqlalchemy.tuple_(*primary_key) >
+                                  sqlalchemy.tuple_(*last))
+            batch = await self.all(page.limit(batch_size))
+            if not batch:
+                return
+            last = mapper.primary_key_from_instance(batch[-1])
+            for entry in batch:
+                yield entry
+            if len(batch) < batch_size:
+                return
+
+    if docstring is not None:
+        _query_iter.__doc__ = docstring
+    return _query_iter
+
+
+for entity in (gtfs_all + [Feed]):
+    entity_doc = ("A coroutine returning a list of "
+                  ":py:class:`pygtfs.gtfs_entities.{0}` objects"
+                  .format(entity.__name__))
+    entity_raw_doc = ("A ``select`` of :py:class:`pygtfs.gtfs_entities.{0}` "
+                      "objects".format(entity.__name__))
+    entity_by_id_doc = ("A coroutine returning a list of "
+                        ":py:class:`pygtfs.gtfs_entities.{0}` objects with "
+                        "matching id".format(entity.__name__))
+    entity_iter_doc = ("An async iterator over "
+                       ":py:class:`pygtfs.gtfs_entities.{0}` objects, "
+                       "optionally of one feed, read in batches"
+                       .format(entity.__name__))
+    setattr(AsyncSchedule, entity._plural_name_, _meta_query_all(entity, entity_doc))
+    setattr(AsyncSchedule, entity._plural_name_ + "_query",
+            _meta_query_raw(entity, entity_raw_doc))
+    setattr(AsyncSchedule, entity._plural_name_ + "_iter",
+            _meta_query_iter(entity, entity_iter_doc))
+    if hasattr(entity, 'id'):
+        setattr(AsyncSchedule, entity._plural_name_ + "_by_id",
+                _meta_query_by_id(entity, entity_by_id_doc))
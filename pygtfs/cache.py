@@ -0,0 +1,91 @@
+""" A result cache for :py:class:`pygtfs.Schedule`, see its `cache_size`.
+
+Results are kept in least recently used order, up to `maxsize` entries, and
+optionally for `ttl` seconds only. Every entry is tagged with the feed_id
+its query was restricted to, or None when it covers all the feeds.
+Invalidating a feed drops the entries of that feed and the entries of all
+feeds, since adding, changing or dropping a feed can change them. The
+schedule does so whenever a feed is appended, updated or dropped.
+
+The cached entities belong to the schedule's session, so the schedule also
+drops every result when the session's transaction ends (on commit, rollback
+or close) or an instance is expunged; a result is never used expired or
+detached.
+"""
+
+import collections
+import time
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class ResultCache(object):
+    """ An LRU cache of query results, with an optional time to live.
+
+    :param maxsize: The maximum number of results kept.
+    :param ttl: The number of seconds a result is kept, or None to keep it
+        until it is evicted or invalidated.
+    :param clock: The function returning the current time in seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive, not %r' % maxsize)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expiry, feed_id, value), least recently used first
+        self._entries = collections.OrderedDict()
+        # feed_id -> keys
+        self._tags = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, compute, feed_id=None):
+        """ The cached result of `key`, or the result of `compute()`, cached
+        and tagged with `feed_id`. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expiry, _, value = entry
+            if expiry is None or self.clock() < expiry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+        self.misses += 1
+        value = compute()
+        expiry = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = (expiry, feed_id, value)
+        self._tags[feed_id].add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return value
+
+    def _remove(self, key):
+        _, feed_id, _ = self._entries.pop(key)
+        keys = self._tags[feed_id]
+        keys.discard(key)
+        if not keys:
+            del self._tags[feed_id]
+
+    def invalidate(self, feed_id=None):
+        """ Drop the results of a feed and of all the feeds, or every result
+        if `feed_id` is None. """
+        if feed_id is None:
+            self._entries.clear()
+            self._tags.clear()
+            return
+        for tag in (feed_id, None):
+            for key in self._tags.pop(tag, ()):
+                del self._entries[key]
+
+    def info(self):
+        """ The counters of the cache, as a :py:data:`CacheInfo`. """
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize,
+                         len(self._entries))
@@ -0,0 +1,270 @@
+""" Columnar NumPy snapshots of feeds, see :py:meth:`pygtfs.Schedule.columnar`.
+
+A snapshot holds the main tables of a feed as NumPy structured arrays:
+
+* ids are encoded as ``int32`` indices into the sorted string arrays of
+  :py:attr:`ColumnarFeed.ids`, shared between tables (``stop_times.stop_id``
+  and ``stops.stop_id`` use the same codes), with -1 for missing ids,
+* times are seconds after midnight of the service day, -1 when missing,
+* coordinates and distances are floats, NaN when missing,
+* small integer enums are ``int8`` or ``int16``, -1 when missing.
+
+Rows are ordered by id, stop times by trip and stop sequence, and shape
+points by shape and sequence. For sqlite databases stored in a file,
+snapshots are cached as ``.npy`` files in a ``<database>.columnar/<feed_id>``
+directory next to the database, and opened memory-mapped. The schedule
+drops the cache of a feed once a change to the feed is committed. A cached
+snapshot also records the :py:func:`fingerprint` of the feed it was built
+from, and is rebuilt when it no longer matches, e.g. when the database file
+was replaced or a dropped feed's id was reused.
+
+Requires numpy.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from sqlalchemy import select
+
+from .gtfs_entities import (Feed, FeedVersion, Route, Service, ShapePoint,
+                            Stop, StopTime, Trip)
+
+
+# The tables of a snapshot: the entity, and for every field its NumPy dtype,
+# 'time' for times in seconds, or the name of the ids it is encoded with
+# (ending in '_id').
+_tables = {
+    'stops': (Stop, [('stop_id', 'stop_id'), ('stop_lat', 'f8'),
+                     ('stop_lon', 'f8'), ('location_type', 'i1'),
+                     ('parent_station', 'stop_id'), ('zone_id', 'zone_id')]),
+    'routes': (Route, [('route_id', 'route_id'), ('agency_id', 'agency_id'),
+                       ('route_type', 'i2')]),
+    'trips': (Trip, [('trip_id', 'trip_id'), ('route_id', 'route_id'),
+                     ('service_id', 'service_id'), ('direction_id', 'i1'),
+                     ('block_id', 'block_id'), ('shape_id', 'shape_id')]),
+    'stop_times': (StopTime, [('trip_id', 'trip_id'), ('stop_sequence', 'i4'),
+                              ('stop_id', 'stop_id'), ('arrival_time', 'time'),
+                              ('departure_time', 'time'), ('pickup_type', 'i1'),
+                              ('drop_off_type', 'i1'),
+                              ('shape_dist_traveled', 'f8')]),
+    'shapes': (ShapePoint, [('shape_id', 'shape_id'),
+                            ('shape_pt_sequence', 'i4'), ('shape_pt_lat', 'f8'),
+                            ('shape_pt_lon', 'f8'),
+                            ('shape_dist_traveled', 'f8')]),
+    'services': (Service, [('service_id', 'service_id')]),
+}
+
+# The fields the rows of every table are sorted on.
+_order = {'stop_times': ('trip_id', 'stop_sequence'),
+          'shapes': ('shape_id', 'shape_pt_sequence')}
+
+_id_names = sorted({dtype for _, fields in _tables.values()
+                    for _, dtype in fields if dtype.endswith('_id')})
+
+
+class ColumnarFeed(object):
+    """ The tables of a feed as NumPy structured arrays.
+
+    :param tables: A dict mapping table names to structured arrays.
+    :param ids: A dict mapping id names (``"stop_id"``, ``"trip_id"``...) to
+        the sorted arrays of strings the id fields are encoded with.
+    """
+
+    def __init__(self, tables, ids):
+        self.tables = tables
+        self.ids = ids
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['tables'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return '<ColumnarFeed %s>' % ', '.join(
+            '%s: %d' % (name, len(table)) for name, table in self.tables.items())
+
+    def encode(self, id_name, values):
+        """ The codes of string ids, -1 for unknown ids. """
+        import numpy
+
+        ids = self.ids[id_name]
+        values = numpy.asarray(values, dtype=str)
+        codes = numpy.searchsorted(ids, values).astype('i4')
+        found = codes < len(ids)
+        found[found] = ids[codes[found]] == values[found]
+        codes[~found] = -1
+        return codes
+
+    def decode(self, id_name, codes):
+        """ The string ids of codes, None for -1. """
+        ids = self.ids[id_name]
+        return [ids[code] if code >= 0 else None for code in codes]
+
+
+def _seconds(value):
+    if value is None:
+        return -1
+    return value.days * 86400 + value.seconds
+
+
+def _convert(values, dtype):
+    import numpy
+
+    if dtype == 'time':
+        return numpy.array([_seconds(v) for v in values], dtype='i4')
+    if dtype.startswith('f'):
+        return numpy.array([numpy.nan if v is None else float(v) for v in values],
+                           dtype=dtype)
+    return numpy.array([-1 if v is None else int(v) for v in values], dtype=dtype)
+
+
+def build(schedule, feed_id):
+    """ Read a :py:class:`ColumnarFeed` of a feed from the database. """
+    import numpy
+
+    raw = {}
+    for name, (entity, fields) in _tables.items():
+        rows = schedule.session.execute(
+            select(*(entity.__table__.c[field] for field, _ in fields))
+            .where(entity.__table__.c.feed_id == feed_id)).all()
+        raw[name] = [list(column) for column in zip(*rows)] if rows else [
+            [] for _ in fields]
+
+    values = {id_name: set() for id_name in _id_names}
+    for name, (_, fields) in _tables.items():
+        for (field, dtype), column in zip(fields, raw[name]):
+            if dtype in values:
+                values[dtype].update(column)
+    ids = {}
+    for id_name, id_values in values.items():
+        id_values.discard(None)
+        ids[id_name] = numpy.array(sorted(id_values), dtype=str)
+
+    tables = {}
+    for name, (_, fields) in _tables.items():
+        columns = []
+        dtypes = []
+        for (field, dtype), column in zip(fields, raw[name]):
+            if dtype in ids:
+                codes = {value: code for code, value in enumerate(ids[dtype].tolist())}
+                columns.append(numpy.array([codes.get(v, -1) for v in column],
+                                           dtype='i4'))
+                dtypes.append((field, 'i4'))
+            else:
+                columns.append(_convert(column, dtype))
+                dtypes.append((field, columns[-1].dtype))
+        table = numpy.empty(len(raw[name][0]), dtype=dtypes)
+        for (field, _), column in zip(dtypes, columns):
+            table[field] = column
+        order = _order.get(name, (fields[0][0],))
+        tables[name] = table[numpy.lexsort([table[f] for f in reversed(order)])]
+    return ColumnarFeed(tables, ids)
+
+
+def cache_directory(schedule, feed_id):
+    """ The cache directory of a feed, or None if the database is not a
+    sqlite file. """
+    url = schedule.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return os.path.join(url.database + '.columnar', str(feed_id))
+
+
+def fingerprint(schedule, feed_id):
+    """ What identifies the data of a feed: the database file, the name and
+    append date of the feed, and its :py:class:`FeedVersion`, replaced
+    whenever pygtfs changes the feed. """
+    feed = schedule.session.execute(
+        select(Feed.feed_name, Feed.feed_append_date, FeedVersion.version)
+        .outerjoin(FeedVersion, FeedVersion.feed_id == Feed.feed_id)
+        .where(Feed.feed_id == feed_id)).first()
+    database = schedule.engine.url.database
+    return {
+        'feed_id': feed_id,
+        'database_inode': os.stat(database).st_ino,
+        'feed_name': feed and feed.feed_name,
+        'feed_append_date': feed and feed.feed_append_date and
+        feed.feed_append_date.isoformat(),
+        'version': feed and feed.version,
+    }
+
+
+def save(feed_arrays, directory, feed_fingerprint=None):
+    """ Write a snapshot to `directory`, replacing it atomically. """
+    import numpy
+
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+    try:
+        for name, table in feed_arrays.tables.items():
+            numpy.save(os.path.join(tmp, name + '.npy'), table)
+        for name, ids in feed_arrays.ids.items():
+            numpy.save(os.path.join(tmp, 'ids.' + name + '.npy'), ids)
+        with open(os.path.join(tmp, 'fingerprint.json'), 'w') as f:
+            json.dump(feed_fingerprint, f)
+        # a directory can only replace an empty one: move the old snapshot
+        # out of the way first, to a name of its own
+        old = tempfile.mkdtemp(dir=parent, prefix='.old')
+        try:
+            os.replace(directory, old)
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(tmp, directory)
+        except OSError:
+            # another process saved its snapshot in between
+            if not os.path.isdir(directory):
+                raise
+        shutil.rmtree(old, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load(directory, feed_fingerprint=None):
+    """ Open a cached snapshot memory-mapped, or return None if there is
+    none or if it was built from data with another fingerprint. """
+    import numpy
+
+    if not os.path.isdir(directory):
+        return None
+    try:
+        if feed_fingerprint is not None:
+            with open(os.path.join(directory, 'fingerprint.json')) as f:
+                if json.load(f) != feed_fingerprint:
+                    return None
+        tables = {name: numpy.load(os.path.join(directory, name + '.npy'),
+                                   mmap_mode='r')
+                  for name in _tables}
+        ids = {name: numpy.load(os.path.join(directory, 'ids.' + name + '.npy'),
+                                mmap_mode='r')
+               for name in _id_names}
+    except (IOError, ValueError):
+        return None
+    return ColumnarFeed(tables, ids)
+
+
+def invalidate(directory):
+    """ Remove a cached snapshot. """
+    if directory is not None and os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def columnar(schedule, feed_id, cache=True):
+    """ The :py:class:`ColumnarFeed` of a feed, from the cache if possible. """
+    directory = cache_directory(schedule, feed_id) if cache else None
+    if directory is None:
+        return build(schedule, feed_id)
+    before = fingerprint(schedule, feed_id)
+    feed_arrays = load(directory, before)
+    if feed_arrays is not None:
+        return feed_arrays
+    feed_arrays = build(schedule, feed_id)
+    # not cached if the feed changed while it was read
+    if fingerprint(schedule, feed_id) != before:
+        return feed_arrays
+    save(feed_arrays, directory, before)
+    return load(directory, before) or feed_arrays
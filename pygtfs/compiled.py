@@ -0,0 +1,256 @@
+""" A compiled, read-only binary format for the timetable of a feed.
+
+:py:func:`pygtfs.compiler.compile_feed` writes a feed of a schedule database
+into a single file, and :py:class:`CompiledFeed` answers stop, route, trip
+and stop time lookups from it. This module only needs the standard library:
+importing it does not import sqlalchemy nor the rest of pygtfs' entities.
+The file is memory-mapped, so that all the processes reading it share the
+operating system page cache, and opening it costs next to nothing.
+
+The file starts with a header: the magic bytes ``PYGTFSC\\0``, the format
+version, the byte order and the number of sections, followed by a directory
+of the sections, each with its name, type code (of the :py:mod:`array`
+module), offset and length in bytes. Names are ASCII, at most 32 bytes
+long. Sections are 8 byte aligned arrays:
+
+* string pools (``<pool>.data`` and ``<pool>.offsets``): the sorted, UTF-8
+  encoded ids of stops, routes, trips, services and shapes, and the other
+  texts (names, headsigns). Entities are stored in the order of their ids,
+  so the position of an id in its pool is the index of its rows.
+* columns of the stops, routes and trips, with ids and texts as indices into
+  the pools, and -1 for missing values.
+* the stop times grouped by trip in stop sequence order, with an offset
+  table per trip, and an index of them per stop, ordered by departure time.
+* the dates of every service, as proleptic Gregorian ordinals.
+
+Times are in seconds after midnight of the service day.
+"""
+
+import bisect
+import collections
+import datetime
+import mmap
+import struct
+import sys
+
+from .exceptions import PygtfsException
+
+MAGIC = b'PYGTFSC\0'
+FORMAT_VERSION = 1
+
+# the header, and the directory entry of every section
+HEADER = struct.Struct('<8sII8sI4x')
+SECTION_NAME_SIZE = 32
+SECTION = struct.Struct('<%ds2sxxxxxxQQ' % SECTION_NAME_SIZE)
+
+POOLS = ('stop_id', 'route_id', 'trip_id', 'service_id', 'shape_id', 'text')
+
+CompiledStop = collections.namedtuple(
+    'CompiledStop', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon',
+                     'location_type', 'parent_station'])
+CompiledRoute = collections.namedtuple(
+    'CompiledRoute', ['route_id', 'route_short_name', 'route_long_name',
+                      'route_type'])
+CompiledTrip = collections.namedtuple(
+    'CompiledTrip', ['trip_id', 'route_id', 'service_id', 'trip_headsign',
+                     'direction_id', 'shape_id'])
+CompiledStopTime = collections.namedtuple(
+    'CompiledStopTime', ['trip_id', 'stop_sequence', 'stop_id', 'arrival_time',
+                         'departure_time'])
+
+
+class _PoolView(object):
+    """ A string pool of a compiled feed. """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            return None
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def _bytes(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def find(self, value):
+        """ The index of `value`, or -1. """
+        key = value.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._bytes(lo) == key:
+            return lo
+        return -1
+
+
+class CompiledFeed(object):
+    """ A compiled feed, read from a memory-mapped file.
+
+    Lookups raise KeyError for unknown ids. Can be used as a context
+    manager, closing the file on exit.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = view = memoryview(self._mmap)
+        try:
+            magic, version, count, byteorder, _ = HEADER.unpack_from(view)
+        except struct.error:
+            raise PygtfsException('%s is not a compiled feed' % filename)
+        if magic != MAGIC:
+            raise PygtfsException('%s is not a compiled feed' % filename)
+        if version != FORMAT_VERSION:
+            raise PygtfsException('%s has format version %d, expected %d'
+                                  % (filename, version, FORMAT_VERSION))
+        if byteorder.rstrip(b'\0').decode('ascii') != sys.byteorder:
+            raise PygtfsException('%s was compiled for another byte order'
+                                  % filename)
+        self._sections = {}
+        for i in range(count):
+            name, typecode, offset, length = SECTION.unpack_from(
+                view, HEADER.size + i * SECTION.size)
+            section = view[offset:offset + length]
+            typecode = typecode.decode('ascii')
+            if typecode != 'B':
+                section = section.cast(typecode)
+            self._sections[name.rstrip(b'\0').decode('ascii')] = section
+        self.pools = {name: _PoolView(self._sections[name + '.data'],
+                                      self._sections[name + '.offsets'])
+                      for name in POOLS}
+
+    def close(self):
+        self.pools = {}
+        for section in self._sections.values():
+            section.release()
+        self._sections = {}
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _index(self, pool, value, table):
+        i = self.pools[pool].find(value)
+        if i < 0 or not self._sections[table + '.present'][i]:
+            raise KeyError(value)
+        return i
+
+    def _ids(self, pool, table):
+        present = self._sections[table + '.present']
+        return [self.pools[pool][i] for i in range(len(present)) if present[i]]
+
+    def stop_ids(self):
+        return self._ids('stop_id', 'stops')
+
+    def route_ids(self):
+        return self._ids('route_id', 'routes')
+
+    def trip_ids(self):
+        return self._ids('trip_id', 'trips')
+
+    def stop(self, stop_id):
+        i = self._index('stop_id', stop_id, 'stops')
+        s = self._sections
+        return CompiledStop(stop_id, self.pools['text'][s['stops.stop_name'][i]],
+                            s['stops.stop_lat'][i], s['stops.stop_lon'][i],
+                            _none(s['stops.location_type'][i]),
+                            self.pools['stop_id'][s['stops.parent_station'][i]])
+
+    def route(self, route_id):
+        i = self._index('route_id', route_id, 'routes')
+        s = self._sections
+        text = self.pools['text']
+        return CompiledRoute(route_id, text[s['routes.route_short_name'][i]],
+                             text[s['routes.route_long_name'][i]],
+                             _none(s['routes.route_type'][i]))
+
+    def trip(self, trip_id):
+        i = self._index('trip_id', trip_id, 'trips')
+        s = self._sections
+        return CompiledTrip(trip_id,
+                            self.pools['route_id'][s['trips.route_id'][i]],
+                            self.pools['service_id'][s['trips.service_id'][i]],
+                            self.pools['text'][s['trips.trip_headsign'][i]],
+                            _none(s['trips.direction_id'][i]),
+                            self.pools['shape_id'][s['trips.shape_id'][i]])
+
+    def _stop_time(self, i, trip_id=None):
+        s = self._sections
+        if trip_id is None:
+            trip = bisect.bisect_right(s['trips.stop_times'], i) - 1
+            trip_id = self.pools['trip_id'][trip]
+        return CompiledStopTime(trip_id, s['stop_times.stop_sequence'][i],
+                                self.pools['stop_id'][s['stop_times.stop_id'][i]],
+                                s['stop_times.arrival_time'][i],
+                                s['stop_times.departure_time'][i])
+
+    def stop_times(self, trip_id):
+        """ The stop times of a trip, in stop sequence order. """
+        i = self.pools['trip_id'].find(trip_id)
+        if i < 0:
+            raise KeyError(trip_id)
+        offsets = self._sections['trips.stop_times']
+        return [self._stop_time(j, trip_id)
+                for j in range(offsets[i], offsets[i + 1])]
+
+    def stop_times_at(self, stop_id, start=0, end=None):
+        """ The stop times at a stop departing between `start` and `end`
+        (seconds), in departure order. """
+        i = self.pools['stop_id'].find(stop_id)
+        if i < 0:
+            raise KeyError(stop_id)
+        offsets = self._sections['stops.stop_times']
+        index = self._sections['stops.stop_time_index']
+        departures = self._sections['stop_times.departure_time']
+        lo, hi = offsets[i], offsets[i + 1]
+        # binary search the first departure at or after start
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if departures[index[mid]] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        for j in range(lo, offsets[i + 1]):
+            if end is not None and departures[index[j]] > end:
+                break
+            found.append(self._stop_time(index[j]))
+        return found
+
+    def service_dates(self, service_id):
+        """ The dates a service runs on. """
+        i = self.pools['service_id'].find(service_id)
+        if i < 0:
+            raise KeyError(service_id)
+        offsets = self._sections['services.dates']
+        ordinals = self._sections['services.date_ordinals']
+        return [datetime.date.fromordinal(ordinals[j])
+                for j in range(offsets[i], offsets[i + 1])]
+
+    def runs_on(self, service_id, date):
+        """ Whether a service runs on `date`. """
+        i = self.pools['service_id'].find(service_id)
+        if i < 0:
+            return False
+        offsets = self._sections['services.dates']
+        ordinals = self._sections['services.date_ordinals']
+        ordinal = date.toordinal()
+        j = bisect.bisect_left(ordinals, ordinal, offsets[i], offsets[i + 1])
+        return j < offsets[i + 1] and ordinals[j] == ordinal
+
+
+def _none(value):
+    return None if value == -1 else value
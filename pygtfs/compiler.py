@@ -0,0 +1,196 @@
+""" Compilation of a feed into the format of :py:mod:`pygtfs.compiled`.
+
+:py:func:`compile_feed` reads a feed from a schedule database and writes it
+to a single file, read by :py:class:`pygtfs.compiled.CompiledFeed`. Unlike
+the reader, this module needs sqlalchemy and the entities.
+"""
+
+import array
+import sys
+
+from sqlalchemy import select
+
+from .compiled import (FORMAT_VERSION, HEADER, MAGIC, SECTION,
+                       SECTION_NAME_SIZE)
+from .exceptions import PygtfsException
+from .gtfs_entities import Feed, Route, ServiceDate, Stop, StopTime, Trip
+
+
+def _seconds(value):
+    if value is None:
+        return -1
+    return value.days * 86400 + value.seconds
+
+
+class _Pool(object):
+    """ A sorted pool of strings, while compiling. """
+
+    def __init__(self, values):
+        self.values = sorted({v for v in values if v is not None},
+                             key=lambda v: v.encode('utf-8'))
+        self.index = {v: i for i, v in enumerate(self.values)}
+
+    def get(self, value):
+        return -1 if value is None else self.index[value]
+
+    def sections(self, name):
+        offsets = array.array('I', [0])
+        data = bytearray()
+        for value in self.values:
+            data += value.encode('utf-8')
+            offsets.append(len(data))
+        return {name + '.data': ('B', bytes(data)),
+                name + '.offsets': ('I', offsets)}
+
+
+def compile_feed(schedule, filename, feed_id=None):
+    """ Write a feed of `schedule` to `filename` in the compiled format.
+
+    :param feed_id: The feed to compile, by default the last one loaded.
+    """
+    session = schedule.session
+    if feed_id is None:
+        feed_id = session.execute(select(Feed.feed_id).order_by(
+            Feed.feed_id.desc())).scalar()
+        if feed_id is None:
+            raise PygtfsException('There are no feeds to compile')
+
+    def rows(*columns):
+        entity = columns[0].class_
+        return session.execute(
+            select(*columns).where(entity.feed_id == feed_id)).all()
+
+    stops = rows(Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon,
+                 Stop.location_type, Stop.parent_station)
+    routes = rows(Route.route_id, Route.route_short_name, Route.route_long_name,
+                  Route.route_type)
+    trips = rows(Trip.trip_id, Trip.route_id, Trip.service_id,
+                 Trip.trip_headsign, Trip.direction_id, Trip.shape_id)
+    stop_times = rows(StopTime.trip_id, StopTime.stop_sequence, StopTime.stop_id,
+                      StopTime.arrival_time, StopTime.departure_time)
+    service_dates = rows(ServiceDate.service_id, ServiceDate.date)
+
+    pools = {
+        'stop_id': _Pool([s.stop_id for s in stops] +
+                         [s.parent_station for s in stops] +
+                         [st.stop_id for st in stop_times]),
+        'route_id': _Pool([r.route_id for r in routes] + [t.route_id for t in trips]),
+        'trip_id': _Pool([t.trip_id for t in trips] + [st.trip_id for st in stop_times]),
+        'service_id': _Pool([t.service_id for t in trips] +
+                            [sd.service_id for sd in service_dates]),
+        'shape_id': _Pool([t.shape_id for t in trips]),
+        'text': _Pool([s.stop_name for s in stops] +
+                      [r.route_short_name for r in routes] +
+                      [r.route_long_name for r in routes] +
+                      [t.trip_headsign for t in trips]),
+    }
+    sections = {}
+    for name, pool in pools.items():
+        sections.update(pool.sections(name))
+
+    def columns(table, entities, pool_name, fields):
+        """ Columns of `entities` in the order of their ids in `pool_name`. """
+        by_index = {}
+        for entity in entities:
+            by_index[pools[pool_name].get(entity[0])] = entity
+        n = len(pools[pool_name].values)
+        for i, (field, typecode, convert) in enumerate(fields, 1):
+            missing = float('nan') if typecode == 'd' else -1
+            sections['%s.%s' % (table, field)] = (typecode, array.array(
+                typecode, [convert(by_index[j][i]) if j in by_index and
+                           by_index[j][i] is not None else missing
+                           for j in range(n)]))
+        sections['%s.present' % table] = ('B', bytes(
+            1 if j in by_index else 0 for j in range(n)))
+
+    text = pools['text'].get
+    columns('stops', stops, 'stop_id', [
+        ('stop_name', 'i', text), ('stop_lat', 'd', float),
+        ('stop_lon', 'd', float), ('location_type', 'i', int),
+        ('parent_station', 'i', pools['stop_id'].get)])
+    columns('routes', routes, 'route_id', [
+        ('route_short_name', 'i', text), ('route_long_name', 'i', text),
+        ('route_type', 'i', int)])
+    columns('trips', trips, 'trip_id', [
+        ('route_id', 'i', pools['route_id'].get),
+        ('service_id', 'i', pools['service_id'].get),
+        ('trip_headsign', 'i', text), ('direction_id', 'i', int),
+        ('shape_id', 'i', pools['shape_id'].get)])
+
+    # stop times, grouped by trip in stop sequence order
+    trip_index = pools['trip_id'].get
+    stop_index = pools['stop_id'].get
+    stop_times = sorted(stop_times, key=lambda st: (trip_index(st.trip_id),
+                                                    st.stop_sequence))
+    st_trip = array.array('i', (trip_index(st.trip_id) for st in stop_times))
+    sections['stop_times.stop_sequence'] = ('i', array.array(
+        'i', (st.stop_sequence for st in stop_times)))
+    sections['stop_times.stop_id'] = ('i', array.array(
+        'i', (stop_index(st.stop_id) for st in stop_times)))
+    sections['stop_times.arrival_time'] = ('i', array.array(
+        'i', (_seconds(st.arrival_time) for st in stop_times)))
+    departures = array.array('i', (_seconds(st.departure_time) for st in stop_times))
+    sections['stop_times.departure_time'] = ('i', departures)
+    sections['trips.stop_times'] = ('I', _offsets(
+        st_trip, len(pools['trip_id'].values)))
+
+    # the stop times of every stop, by departure time
+    by_stop = sorted(range(len(stop_times)), key=lambda i: (
+        sections['stop_times.stop_id'][1][i], departures[i], i))
+    sections['stops.stop_times'] = ('I', _offsets(
+        [sections['stop_times.stop_id'][1][i] for i in by_stop],
+        len(pools['stop_id'].values)))
+    sections['stops.stop_time_index'] = ('I', array.array('I', by_stop))
+
+    # the dates of every service
+    service_index = pools['service_id'].get
+    service_dates = sorted((service_index(sd.service_id), sd.date.toordinal())
+                           for sd in service_dates)
+    sections['services.dates'] = ('I', _offsets(
+        [s for s, _ in service_dates], len(pools['service_id'].values)))
+    sections['services.date_ordinals'] = ('i', array.array(
+        'i', (d for _, d in service_dates)))
+
+    _write(filename, sections)
+    return filename
+
+
+def _offsets(sorted_keys, n):
+    """ The offset table of `n` groups, from the group of every row. """
+    offsets = array.array('I', [0] * (n + 1))
+    for key in sorted_keys:
+        offsets[key + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    return offsets
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def _write(filename, sections):
+    names = sorted(sections)
+    blobs = []
+    for name in names:
+        typecode, values = sections[name]
+        blobs.append(values if isinstance(values, bytes) else values.tobytes())
+    offset = HEADER.size + SECTION.size * len(names)
+    offset += _pad(offset)
+    directory = []
+    for name, blob in zip(names, blobs):
+        if len(name.encode('ascii')) > SECTION_NAME_SIZE:
+            raise PygtfsException('section name %r is longer than %d bytes'
+                                  % (name, SECTION_NAME_SIZE))
+        directory.append(SECTION.pack(name.encode('ascii'),
+                                       sections[name][0].encode('ascii'),
+                                       offset, len(blob)))
+        offset += len(blob) + _pad(len(blob))
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(names),
+                             sys.byteorder.encode('ascii'), 0))
+        f.write(b''.join(directory))
+        f.write(b'\0' * _pad(f.tell()))
+        for blob in blobs:
+            f.write(blob)
+            f.write(b'\0' * _pad(len(blob)))
@@ -1,20 +1,30 @@
 import os
 import io
 import csv
+import functools
+import itertools
+import operator
 
 from collections import namedtuple
 from zipfile import ZipFile
 
 
-def _row_stripper(row):
-    return (cell.strip() for cell in row)
-
-
 class CSV(object):
-    """A CSV file."""
+    """A CSV file.
 
-    def __init__(self, rows, feedtype='CSVTuple', columns=None):
+    :param rows: An iterator of rows, the first one being the header.
+    :param strip_fields: Strip whitespace around the fields.
+    :param empty_to_none: Turn empty fields into None.
+    :param clean_rows: The rows are tuples of exactly the wanted columns,
+        already stripped and without blank rows, so they can be turned into
+        records without any further processing.
+    """
+
+    def __init__(self, rows, feedtype='CSVTuple', columns=None,
+                 strip_fields=False, empty_to_none=False, clean_rows=False):
         header = list(next(rows))
+        if strip_fields:
+            header = [h.strip() for h in header]
         # deal with annoying unnecessary boms on utf-8
         header[0] = header[0].lstrip("\ufeff")
         if not columns:
@@ -24,67 +34,340 @@ class CSV(object):
         if len(self.cols) == len(header):
             # There is no actual filtering, we can skip it
             self.cols = None
-        self.Tuple = namedtuple(feedtype, self._pick_columns(header))
-        self.rows = rows
+        self.header = self._pick_columns(header)
+        self.Tuple = namedtuple(feedtype, self.header)
+        if strip_fields and empty_to_none:
+            self._clean = lambda row: [x.strip() or None for x in row]
+        elif strip_fields:
+            self._clean = lambda row: [x.strip() for x in row]
+        elif empty_to_none:
+            self._clean = lambda row: [x if x else None for x in row]
+        else:
+            self._clean = tuple
+        if self.cols and len(self.cols) > 1:
+            self._pick_columns = operator.itemgetter(*self.cols)
+        if clean_rows:
+            self._records = map(functools.partial(tuple.__new__, self.Tuple), rows)
+        else:
+            self._records = map(self._record, rows)
 
     def __repr__(self):
-        return '<CSV %s>' % self.header
+        return '<CSV %s>' % (self.header,)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        n = tuple(next(self.rows))
-        if n:
-            return self.Tuple._make(self._pick_columns(n))
+        return next(self._records)
+
+    def batches(self, batch_size, dtypes=None):
+        """ Yield the remaining records as batches of columns.
+
+        Every batch is a list with one sequence of values per column (in the
+        order of :py:attr:`header`), holding up to `batch_size` rows. Blank
+        rows are skipped.
+
+        :param dtypes: A dict mapping column names to NumPy dtypes. These
+            columns are returned as NumPy arrays instead of lists, with
+            missing values as NaN.
+        """
+        batch = []
+        for record in self:
+            if record:
+                batch.append(record)
+                if len(batch) == batch_size:
+                    yield self._columns(batch, dtypes)
+                    batch = []
+        if batch:
+            yield self._columns(batch, dtypes)
+
+    def _columns(self, batch, dtypes):
+        columns = [list(column) for column in zip(*batch)]
+        if dtypes:
+            for i, name in enumerate(self.header):
+                if name in dtypes:
+                    columns[i] = _numpy_column(name, columns[i], dtypes[name])
+        return columns
+
+    def _record(self, row):
+        if row:
+            return self.Tuple._make(self._clean(self._pick_columns(row)))
 
     def _pick_columns(self, row):
         if self.cols:
-            return (row[x] for x in self.cols)
+            return [row[x] for x in self.cols]
         return row
 
 
+class _ArrowCSV(CSV):
+    """ A :py:class:`CSV` reading batches of clean pyarrow string arrays. """
+
+    def __init__(self, arrow_batches, feedtype, header):
+        self._arrow_batches = arrow_batches
+        rows = itertools.chain([header], self._rows())
+        super(_ArrowCSV, self).__init__(rows, feedtype=feedtype, columns=header,
+                                        clean_rows=True)
+
+    def _rows(self):
+        for arrays in self._arrow_batches:
+            yield from zip(*(array.to_pylist() for array in arrays))
+
+    def batches(self, batch_size, dtypes=None):
+        import pyarrow
+
+        pending = None
+        for arrays in self._arrow_batches:
+            if pending is not None:
+                arrays = [pyarrow.concat_arrays(pair) for pair in zip(pending, arrays)]
+            length = len(arrays[0]) if arrays else 0
+            start = 0
+            while length - start >= batch_size:
+                yield self._arrow_columns([a.slice(start, batch_size) for a in arrays],
+                                          dtypes)
+                start += batch_size
+            pending = [a.slice(start) for a in arrays] if start < length else None
+        if pending is not None:
+            yield self._arrow_columns(pending, dtypes)
+
+    def _arrow_columns(self, arrays, dtypes):
+        import pyarrow.compute
+
+        columns = []
+        for name, array in zip(self.header, arrays):
+            if dtypes and name in dtypes:
+                dtype = _numpy_dtype(dtypes[name])
+                if dtype.kind != 'f' and array.null_count:
+                    raise ValueError('missing values in integer column %s' % name)
+                array = pyarrow.compute.cast(array, pyarrow.from_numpy_dtype(dtype))
+                columns.append(array.to_numpy(zero_copy_only=False).astype(dtype, copy=False))
+            else:
+                columns.append(array.to_pylist())
+        return columns
+
+
+def _numpy_dtype(dtype):
+    import numpy
+    return numpy.dtype(dtype)
+
+
+def _numpy_column(name, values, dtype):
+    import numpy
+
+    dtype = _numpy_dtype(dtype)
+    if dtype.kind == 'f':
+        values = ['nan' if v is None else v for v in values]
+    elif None in values:
+        raise ValueError('missing values in integer column %s' % name)
+    return numpy.array(values).astype(dtype)
+
+
+def _python_engine(handle, feedtype, columns, strip_fields, empty_to_none):
+    """ The pure python csv engine, based on :py:func:`csv.reader`. """
+    rows = csv.reader(io.TextIOWrapper(handle, encoding="utf-8"))
+    return CSV(feedtype=feedtype, rows=rows, columns=columns,
+               strip_fields=strip_fields, empty_to_none=empty_to_none)
+
+
+def _pyarrow_engine(handle, feedtype, columns, strip_fields, empty_to_none):
+    """ A csv engine built on the multithreaded pyarrow csv reader.
+
+    Column selection happens in the tokenizer, and whitespace stripping and
+    empty values are handled with vectorized compute functions.
+    """
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+
+    # read the header ourselves, to select columns by their cleaned names
+    header_line = handle.readline()
+    header = next(csv.reader([header_line.decode("utf-8")]), [])
+    if strip_fields:
+        header = [h.strip() for h in header]
+    if header:
+        header[0] = header[0].lstrip("\ufeff")
+    if not columns:
+        raise ValueError('missing columns argument')
+    # rename unwanted (possibly duplicate or empty) columns out of the way
+    names = [h if h in columns else '_ignored_%d' % i
+             for i, h in enumerate(header)]
+    selected = [n for n in names if n in columns]
+
+    try:
+        reader = pyarrow.csv.open_csv(
+            handle,
+            read_options=pyarrow.csv.ReadOptions(column_names=names),
+            convert_options=pyarrow.csv.ConvertOptions(
+                include_columns=selected,
+                column_types={n: pyarrow.string() for n in selected},
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False))
+    except pyarrow.ArrowInvalid as e:
+        # a file with just a header
+        if not str(e).startswith('Empty CSV file'):
+            raise
+        reader = ()
+
+    def arrow_batches():
+        for batch in reader:
+            arrays = []
+            for array in batch.columns:
+                if strip_fields:
+                    array = pyarrow.compute.utf8_trim_whitespace(array)
+                if empty_to_none:
+                    array = pyarrow.compute.if_else(
+                        pyarrow.compute.equal(array, ''),
+                        pyarrow.scalar(None, pyarrow.string()), array)
+                arrays.append(array)
+            yield arrays
+
+    return _ArrowCSV(arrow_batches(), feedtype, selected)
+
+
+def _pyarrow_available():
+    try:
+        import pyarrow.csv  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# NumPy dtypes of the numeric gtfs fields, see :py:meth:`Feed.read_columns`.
+# Floating point fields may be empty (read as NaN), integer fields may not.
+numeric_dtypes = {
+    'stop_lat': 'f8',
+    'stop_lon': 'f8',
+    'shape_pt_lat': 'f8',
+    'shape_pt_lon': 'f8',
+    'shape_pt_sequence': 'i8',
+    'shape_dist_traveled': 'f8',
+    'stop_sequence': 'i8',
+    'route_type': 'i8',
+    'headway_secs': 'i8',
+    'price': 'f8',
+    'min_transfer_time': 'f8',
+}
+
+# The available csv engines, see :py:class:`Feed`.
+csv_engines = {'python': _python_engine, 'pyarrow': _pyarrow_engine}
+
+
+def _get_engine(name):
+    if name is None or name == 'auto':
+        name = 'pyarrow' if _pyarrow_available() else 'python'
+    try:
+        return csv_engines[name]
+    except KeyError:
+        raise ValueError('unknown csv engine %r, expected one of %s'
+                         % (name, ', '.join(csv_engines)))
 
 
 class Feed(object):
     """A collection of CSV files with headers, either zipped into an archive
-    or loose in a folder."""
+    or loose in a folder.
 
-    def __init__(self, filename, strip_fields=True):
+    :param csv_engine: The name of the engine parsing the files, one of
+        :py:data:`csv_engines`, or ``"auto"`` for pyarrow when it is
+        installed and the pure python engine otherwise. All engines return
+        the same records from valid files, but pyarrow rejects rows with
+        more or fewer fields than the header, which the default pure python
+        engine accepts.
+    """
+
+    def __init__(self, filename, strip_fields=True, csv_engine='python'):
         self.filename = filename
         self.feed_name = derive_feed_name(filename)
         self.zf = None
         self.strip_fields = strip_fields
         self.empty_to_none = True
+        self.csv_engine = csv_engine
+        self._engine = _get_engine(csv_engine)
         if not os.path.isdir(filename):
             self.zf = ZipFile(filename)
 
     def __repr__(self):
         return '<Feed %s>' % self.filename
 
-    def reader(self, filename):
+    def open(self, filename):
+        """ Open a file of the feed in binary mode. """
         if self.zf:
             try:
-                text_file_handle = io.TextIOWrapper(
-                    self.zf.open(filename, "r"), encoding="utf-8")
-            except IOError:
+                return self.zf.open(filename, "r")
+            except KeyError:
                 raise IOError('%s is not present in feed' % filename)
+        return open(os.path.join(self.filename, filename), "rb")
+
+    def fingerprint(self):
+        """ The size and modification time of the archive, or of every file
+        of the folder, which change with any new export of the feed. """
+        if self.zf:
+            paths = [self.filename]
         else:
-            text_file_handle = open(os.path.join(self.filename, filename), "r",
-                                    encoding="utf-8")
+            paths = sorted(os.path.join(self.filename, name)
+                           for name in os.listdir(self.filename))
+        stats = [(os.path.basename(path), os.stat(path)) for path in paths]
+        return ';'.join('%s:%d:%d' % (name, stat.st_size, stat.st_mtime_ns)
+                        for name, stat in stats)
+
+    def reader(self, filename):
+        text_file_handle = io.TextIOWrapper(self.open(filename), encoding="utf-8")
         return csv.reader(text_file_handle)
 
     def read_table(self, filename, columns):
-        if self.strip_fields:
-            rows = (_row_stripper(row) for row in self.reader(filename))
-        else:
-            rows = self.reader(filename)
-        if self.empty_to_none:
-            # Set empty strings to None, let nullable handle missing values.
-            rows = ((x if x else None for x in row) for row in rows)
-        feedtype = filename.rsplit('/')[-1].rsplit('.')[0].title().replace('_',
-                                                                           '')
-        return CSV(feedtype=feedtype, rows=rows, columns=columns)
+        return self._engine(self.open(filename), _feedtype(filename), columns,
+                            self.strip_fields, self.empty_to_none)
+
+    def read_columns(self, filename, columns, batch_size=10000, dtypes=None):
+        """ Read a table as a stream of column batches.
+
+        Yields dicts mapping every column name to a sequence of up to
+        `batch_size` values, see :py:meth:`CSV.batches`.
+
+        :param dtypes: ``True`` to return the numeric gtfs fields in
+            :py:data:`numeric_dtypes` as NumPy arrays, or a dict mapping
+            field names to NumPy dtypes. Requires numpy.
+        """
+        if dtypes is True:
+            dtypes = numeric_dtypes
+        table = self.read_table(filename, columns)
+        for batch in table.batches(batch_size, dtypes):
+            yield dict(zip(table.header, batch))
+
+    def read_chunks(self, filename, chunk_bytes):
+        """ Split a file into chunks of about `chunk_bytes` bytes.
+
+        Every chunk is a self contained csv document: it starts with the
+        header line, followed by whole records (quoted fields may span lines).
+        The chunks can be parsed independently with :py:func:`read_chunk`.
+        """
+        with self.open(filename) as f:
+            header = f.readline()
+            quotes = header.count(b'"') % 2
+            while True:
+                block = f.read(chunk_bytes)
+                if not block:
+                    break
+                quotes = (quotes + block.count(b'"')) % 2
+                parts = [header, block]
+                # read up to the end of a record
+                while quotes or not block.endswith(b'\n'):
+                    block = f.readline()
+                    if not block:
+                        break
+                    quotes = (quotes + block.count(b'"')) % 2
+                    parts.append(block)
+                yield b''.join(parts)
+
+
+def read_chunk(chunk, filename, columns, strip_fields=True, empty_to_none=True,
+               csv_engine='python'):
+    """ Parse a chunk produced by :py:meth:`Feed.read_chunks` like
+    :py:meth:`Feed.read_table` would parse the whole file. """
+    return _get_engine(csv_engine)(io.BytesIO(chunk), _feedtype(filename),
+                                   columns, strip_fields, empty_to_none)
+
+
+def _feedtype(filename):
+    return filename.rsplit('/')[-1].rsplit('.')[0].title().replace('_', '')
 
 
 def derive_feed_name(filename):
@@ -0,0 +1,165 @@
+""" Expansion of frequency based trips into the trips they run.
+
+A trip with :py:class:`pygtfs.gtfs_entities.Frequency` entries is a
+template: its stop times give the times between the stops, and every
+frequency entry starts a trip every `headway_secs` seconds from its
+`start_time`, up to but excluding its `end_time`. The first stop of a trip
+started at `t` departs at `t`, and the other stop times are shifted by the
+same amount. If the first stop has no times, the first stop that has them
+departs at `t`; templates without any times are skipped. Overlapping
+entries start every trip once.
+
+:py:meth:`pygtfs.Schedule.frequency_trips` generates the trips one at a
+time. :py:meth:`pygtfs.Schedule.expand_frequencies` stores their start times
+in the ``_frequency_trips`` table, one row per trip and not per stop time,
+which :py:meth:`pygtfs.Schedule.departures` then reads in place of the
+template.
+"""
+
+import collections
+import datetime
+import itertools
+import logging
+
+from sqlalchemy import select
+
+from .gtfs_entities import Frequency, FrequencyTrip, StopTime
+
+logger = logging.getLogger(__name__)
+
+# A trip run by a frequency based trip, with its start time and its
+# stop times.
+ExpandedTrip = collections.namedtuple(
+    'ExpandedTrip', ['feed_id', 'trip_id', 'start_time', 'exact_times',
+                     'stop_times'])
+
+# A stop time of an :py:data:`ExpandedTrip`.
+ExpandedStopTime = collections.namedtuple(
+    'ExpandedStopTime', ['stop_id', 'stop_sequence', 'arrival_time',
+                         'departure_time'])
+
+
+def _seconds(value):
+    return None if value is None else int(value.total_seconds())
+
+
+def start_times(start_time, end_time, headway_secs, first=None, last=None):
+    """ The start times in seconds of the trips of a frequency entry, only
+    those between `first` and `last` if given. """
+    start = _seconds(start_time)
+    end = _seconds(end_time)
+    if headway_secs <= 0:
+        return range(0)
+    if first is not None and first > start:
+        # the first start time not before `first`
+        start += -(-(first - start) // headway_secs) * headway_secs
+    if last is not None:
+        end = min(end, last + 1)
+    return range(start, end, headway_secs)
+
+
+def _template_start(trip_id, stop_times):
+    """ The departure time in seconds of the first timed stop of a
+    template, or None with a warning if it has no times. """
+    for stop_time in stop_times:
+        if stop_time.departure_time is not None:
+            return _seconds(stop_time.departure_time)
+        if stop_time.arrival_time is not None:
+            return _seconds(stop_time.arrival_time)
+    logger.warning('Skipping the frequencies of trip %s, its stop times '
+                   'have no times', trip_id)
+    return None
+
+
+def _shift(value, offset):
+    if value is None:
+        return None
+    return value + datetime.timedelta(seconds=offset)
+
+
+def expand(schedule, start=None, end=None, trip_id=None, feed_id=None):
+    """ Generate the :py:data:`ExpandedTrip` of the frequency based trips,
+    ordered by feed, trip and start time. See
+    :py:meth:`pygtfs.Schedule.frequency_trips`. """
+    first = _seconds(start)
+    last = _seconds(end)
+    query = (schedule.session.query(Frequency)
+             .order_by(Frequency.feed_id, Frequency.trip_id, Frequency.start_time))
+    if trip_id is not None:
+        query = query.filter(Frequency.trip_id == trip_id)
+    if feed_id is not None:
+        query = query.filter(Frequency.feed_id == feed_id)
+    for (trip_feed_id, frequency_trip_id), frequencies in itertools.groupby(
+            query, key=lambda f: (f.feed_id, f.trip_id)):
+        stop_times = schedule.session.execute(
+            select(StopTime.stop_id, StopTime.stop_sequence,
+                   StopTime.arrival_time, StopTime.departure_time)
+            .where(StopTime.feed_id == trip_feed_id)
+            .where(StopTime.trip_id == frequency_trip_id)
+            .order_by(StopTime.stop_sequence)).all()
+        if not stop_times:
+            continue
+        template_start = _template_start(frequency_trip_id, stop_times)
+        if template_start is None:
+            continue
+        exact_times = {}
+        for frequency in frequencies:
+            for seconds in start_times(frequency.start_time, frequency.end_time,
+                                       frequency.headway_secs, first, last):
+                # overlapping entries would start the same trip twice
+                exact_times.setdefault(seconds, frequency.exact_times)
+        for seconds in sorted(exact_times):
+            offset = seconds - template_start
+            yield ExpandedTrip(
+                trip_feed_id, frequency_trip_id,
+                datetime.timedelta(seconds=seconds), exact_times[seconds],
+                [ExpandedStopTime(stop_id, stop_sequence,
+                                  _shift(arrival_time, offset),
+                                  _shift(departure_time, offset))
+                 for stop_id, stop_sequence, arrival_time, departure_time
+                 in stop_times])
+
+
+def materialize(schedule, feed_id, chunk_size=5000):
+    """ Store the start times of the frequency based trips of a feed in the
+    ``_frequency_trips`` table, replacing the ones stored before. Returns
+    the number of trips. """
+    session = schedule.session
+    session.execute(FrequencyTrip.__table__.delete().where(
+        FrequencyTrip.feed_id == feed_id))
+    template_starts = {}
+    for trip_id, rows in itertools.groupby(session.execute(
+            select(StopTime.trip_id, StopTime.arrival_time, StopTime.departure_time)
+            .where(StopTime.feed_id == feed_id)
+            .where(StopTime.trip_id.in_(select(Frequency.trip_id).where(
+                Frequency.feed_id == feed_id)))
+            .order_by(StopTime.trip_id, StopTime.stop_sequence)),
+            key=lambda row: row[0]):
+        template_starts[trip_id] = _template_start(trip_id, rows)
+
+    rows = []
+    count = 0
+    # overlapping entries would start the same trip twice
+    seen = set()
+    for frequency in (session.query(Frequency).filter(Frequency.feed_id == feed_id)
+                      .order_by(Frequency.trip_id, Frequency.start_time)):
+        template_start = template_starts.get(frequency.trip_id)
+        if template_start is None:
+            continue
+        for seconds in start_times(frequency.start_time, frequency.end_time,
+                                   frequency.headway_secs):
+            if (frequency.trip_id, seconds) in seen:
+                continue
+            seen.add((frequency.trip_id, seconds))
+            rows.append(dict(feed_id=feed_id, trip_id=frequency.trip_id,
+                             start_seconds=seconds,
+                             offset_seconds=seconds - template_start,
+                             exact_times=frequency.exact_times))
+        if len(rows) >= chunk_size:
+            session.execute(FrequencyTrip.__table__.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        session.execute(FrequencyTrip.__table__.insert(), rows)
+        count += len(rows)
+    return count
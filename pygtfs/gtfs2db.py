@@ -1,10 +1,12 @@
 """ gtfs2db - convert a gtfs feed to a pygtfs database
 
 Usage:
-  gtfs2db append <feed_file> <database> [--chunk-size <integer>] [--ignore_files FILES]
-  gtfs2db overwrite <feed_file> <database> [-i, --interactive] [--chunk-size <integer>] [--ignore_files FILES]
+  gtfs2db append <feed_file> <database> [--chunk-size <integer>] [--ignore_files FILES] [--bulk] [--workers <integer>] [--fast-load] [--csv-engine ENGINE] [--resume]
+  gtfs2db overwrite <feed_file> <database> [-i, --interactive] [--chunk-size <integer>] [--ignore_files FILES] [--bulk] [--workers <integer>] [--fast-load] [--csv-engine ENGINE]
+  gtfs2db update <feed_file> <database> [--chunk-size <integer>] [--ignore_files FILES] [--csv-engine ENGINE]
   gtfs2db delete <feed_file> <database> [-i, --interactive]
   gtfs2db list <database>
+  gtfs2db compile <database> <out> [--feed-id <integer>]
   gtfs2db (-h | --help)
   gtfs2db --version
 
@@ -15,6 +17,17 @@ Options:
   --chunk-size <int>    How often to flush database. If memory consumption is high,
                         lower this number. [default: 10000]
   --ignore_files FILES  Ignore these files in the read, e.g. "routes.txt,stop_times.txt".
+  --bulk                Insert rows with batched core inserts instead of ORM
+                        objects. Much faster for large feeds.
+  --workers <int>       Parse the feed files in this many processes, while
+                        inserting in bulk in the main process.
+  --fast-load           On sqlite, load in WAL mode and drop the indexes while
+                        loading, then rebuild them and analyze the database.
+  --csv-engine ENGINE   The csv parser, "python", "pyarrow" or "auto" for
+                        pyarrow if it is installed. [default: python]
+  --feed-id <int>       The feed to compile, by default the last one loaded.
+  --resume              Commit after every chunk, and continue an unfinished
+                        resumable load of the same feed file if there is one.
   <feed_file>           The gtfs file on which to operate. Can be either a folder
                         containing .txt files, or a .zip file.
   <database>            The database. Can be either a file, which is interpreted
@@ -25,8 +38,12 @@ Commands:
   append            appends the gtfs feed to the database
   overwrite         delete any existing feeds which had the same original
                     filename as the new file, and then append the new file.
+  update            update the latest feed with the same filename as the new
+                    file to its contents, writing only the changed rows.
   delete            delete from the database any feeds with the name supplied.
   list              list existing feeds in the database.
+  compile           write a feed to <out> in the compiled read-only format of
+                    `pygtfs.compiled`.
 
 Description:
   This is a tool to manage a database containing several gtfs feeds. The
@@ -38,7 +55,9 @@ Description:
 
 from docopt import docopt
 
-from . import __version__, append_feed, delete_feed, overwrite_feed, list_feeds
+from . import (__version__, append_feed, delete_feed, overwrite_feed,
+               update_feed, list_feeds)
+from .compiler import compile_feed
 from .schedule import Schedule
 
 
@@ -48,6 +67,10 @@ def main():
     args = docopt(__doc__, version=__version__)
     schedule = Schedule(args['<database>'])
 
+    workers = None
+    if args['--workers']:
+        workers = int(args['--workers'])
+
     ignore_files = ()
     if ignore_files_str := args['--ignore_files']:
         ignore_files = ignore_files_str.split(',')
@@ -55,7 +78,17 @@ def main():
     if args['append']:
         append_feed(schedule, args['<feed_file>'],
                     chunk_size=int(args['--chunk-size']),
-                    ignore_files=ignore_files)
+                    ignore_files=ignore_files,
+                    bulk=args['--bulk'],
+                    workers=workers,
+                    fast_load=args['--fast-load'],
+                    csv_engine=args['--csv-engine'] or 'python',
+                    resume=args['--resume'])
+    elif args['update']:
+        update_feed(schedule, args['<feed_file>'],
+                    chunk_size=int(args['--chunk-size']),
+                    ignore_files=ignore_files,
+                    csv_engine=args['--csv-engine'] or 'python')
     elif args['delete']:
         delete_feed(schedule, args['<feed_file>'],
                     interactive=args['--interactive'])
@@ -63,9 +96,18 @@ def main():
         overwrite_feed(schedule, args['<feed_file>'],
                        interactive=args['--interactive'],
                        chunk_size=int(args['--chunk-size']),
-                       ignore_files=ignore_files)
+                       ignore_files=ignore_files,
+                       bulk=args['--bulk'],
+                       workers=workers,
+                       fast_load=args['--fast-load'],
+                       csv_engine=args['--csv-engine'] or 'python')
     elif args['list']:
         list_feeds(schedule)
+    elif args['compile']:
+        feed_id = None
+        if args['--feed-id']:
+            feed_id = int(args['--feed-id'])
+        compile_feed(schedule, args['<out>'], feed_id=feed_id)
 
 if __name__ == '__main__':
     main()
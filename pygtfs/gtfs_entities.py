@@ -6,52 +6,82 @@ when possible relations are taken into account, e.g. a :py:class:`Route` class
 has a `trips` attribute, with a list of trips for the specific route.
 """
 
+import array
 import datetime
+import functools
+import sys
 
-from sqlalchemy import Column, ForeignKey, ForeignKeyConstraint, and_, Table, Index
+from sqlalchemy import (Column, ForeignKey, ForeignKeyConstraint, and_, Table, Index,
+                        inspect)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, validates, synonym, foreign
+from sqlalchemy.orm import backref, relationship, validates, synonym, foreign
 from sqlalchemy.types import (Unicode, Integer, Float, Boolean, Date, Interval,
-                              Numeric)
+                              LargeBinary, Numeric)
 
 from .exceptions import PygtfsValidationError
 
 Base = declarative_base()
 
 
-def _validate_date(*field_names):
-    @validates(*field_names)
-    def make_date(self, key, value):
-        if value is None or value == "":
-            return None
-        return datetime.datetime.strptime(value, '%Y%m%d').date()
-    return make_date
+# Field converters turn the raw strings of a feed into python values. They
+# are shared by the ``@validates`` hooks of single instances and by
+# :py:func:`convert_columns`, which converts whole columns at once for the
+# bulk loader. Converters flagged as ``memoize`` handle fields where feeds
+# repeat a small set of values millions of times (times, dates, enums), so
+# every distinct string is only parsed once.
 
+_MEMO_SIZE = 2 ** 16
 
-def _validate_time_delta(*field_names):
-    @validates(*field_names)
-    def time_delta(self, key, value):
-        if value is None or value == "":
-            return None
-        (hours, minutes, seconds) = map(int, value.split(":"))
-        return datetime.timedelta(hours=hours, minutes=minutes,
-                                  seconds=seconds)
-    return time_delta
 
+def _memoized(converter):
+    converter.memoize = True
+    return converter
 
-def _validate_int_bool(*field_names):
-    @validates(*field_names)
-    def int_bool(self, key, value):
-        if value not in ("0", "1"):
-            raise PygtfsValidationError("{0} must be 0 or 1, "
-                                        "was {1}".format(key, value))
-        return value == "1"
-    return int_bool
 
+@functools.lru_cache(maxsize=_MEMO_SIZE)
+def _parse_date(value):
+    if len(value) != 8 or not value.isdigit():
+        raise ValueError("time data {0!r} does not match format "
+                         "'%Y%m%d'".format(value))
+    return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
 
-def _validate_int_choice(int_choice, *field_names):
-    @validates(*field_names)
-    def in_range(self, key, value):
+
+@functools.lru_cache(maxsize=_MEMO_SIZE)
+def _parse_time_delta(value):
+    (hours, minutes, seconds) = map(int, value.split(":"))
+    return datetime.timedelta(seconds=hours * 3600 + minutes * 60 + seconds)
+
+
+@_memoized
+def _convert_date(key, value):
+    if value is None or value == "":
+        return None
+    return _parse_date(value)
+
+
+@_memoized
+def _convert_time_delta(key, value):
+    if value is None or value == "":
+        return None
+    return _parse_time_delta(value)
+
+
+@_memoized
+def _convert_int_bool(key, value):
+    if value not in ("0", "1"):
+        raise PygtfsValidationError("{0} must be 0 or 1, "
+                                    "was {1}".format(key, value))
+    return value == "1"
+
+
+def _int_choice_converter(int_choice):
+    # the canonical spelling of every choice, the only ones real feeds use
+    choices = {str(choice): choice for choice in int_choice if choice is not None}
+
+    @_memoized
+    def in_range(key, value):
+        if value in choices:
+            return choices[value]
         if value is None or value == "":
             if (None in int_choice):
                 return None
@@ -66,9 +96,8 @@ def _validate_int_choice(int_choice, *field_names):
     return in_range
 
 
-def _validate_float_range(float_min, float_max, *field_names):
-    @validates(*field_names)
-    def in_range(self, key, value):
+def _float_range_converter(float_min, float_max):
+    def in_range(key, value):
         float_value = float(value)
         if not (float_min <= float_value <= float_max):
             raise PygtfsValidationError(
@@ -78,13 +107,42 @@ def _validate_float_range(float_min, float_max, *field_names):
     return in_range
 
 
-def _validate_float_none(*field_names):
+def _convert_float_none(key, value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def _validator(converter, *field_names):
     @validates(*field_names)
-    def is_float_none(self, key, value):
-        if value is None or value == "":
-            return None
-        return float(value)
-    return is_float_none
+    def validate(self, key, value):
+        return converter(key, value)
+    validate.converter = converter
+    return validate
+
+
+def _validate_date(*field_names):
+    return _validator(_convert_date, *field_names)
+
+
+def _validate_time_delta(*field_names):
+    return _validator(_convert_time_delta, *field_names)
+
+
+def _validate_int_bool(*field_names):
+    return _validator(_convert_int_bool, *field_names)
+
+
+def _validate_int_choice(int_choice, *field_names):
+    return _validator(_int_choice_converter(int_choice), *field_names)
+
+
+def _validate_float_range(float_min, float_max, *field_names):
+    return _validator(_float_range_converter(float_min, float_max), *field_names)
+
+
+def _validate_float_none(*field_names):
+    return _validator(_convert_float_none, *field_names)
 
 
 class Feed(Base):
@@ -112,11 +170,53 @@ class Feed(Base):
     transfers = relationship("Transfer", backref=("feed"), cascade="all, delete-orphan")
     feedinfo = relationship("FeedInfo", backref=("feed"), cascade="all, delete-orphan")
     translations = relationship("Translation", backref=("feed"), cascade="all, delete-orphan")
+    load_progress = relationship("LoadProgress", backref=("feed"), cascade="all, delete-orphan")
+    version = relationship("FeedVersion", backref=("feed"), uselist=False, cascade="all, delete-orphan")
+    service_dates = relationship("ServiceDate", backref=("feed"), cascade="all, delete-orphan")
+    stop_departures = relationship("StopDeparture", backref=("feed"), cascade="all, delete-orphan")
+    shape_geometries = relationship("ShapeGeometry", backref=("feed"), cascade="all, delete-orphan")
+    hop_geometries = relationship("HopGeometry", backref=("feed"), cascade="all, delete-orphan")
+    stop_distances = relationship("StopDistance", backref=("feed"), cascade="all, delete-orphan")
+    frequency_trips = relationship("FrequencyTrip", backref=("feed"), cascade="all, delete-orphan")
 
     def __repr__(self):
         return '<Feed %s: %s>' % (self.feed_id, self.feed_name)
 
 
+class FeedVersion(Base):
+    """ A token replaced every time pygtfs changes a feed, which tells
+    whether data derived from the feed outside the database is current,
+    see :py:func:`pygtfs.columnar.fingerprint`. Feeds loaded by an earlier
+    version have none until they are changed.
+    """
+    __tablename__ = '_feed_versions'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    version = Column(Unicode)
+
+    def __repr__(self):
+        return '<FeedVersion %s: %s>' % (self.feed_id, self.version)
+
+
+class LoadProgress(Base):
+    """ How far a resumable load of a feed got, per table.
+
+    Rows exist only while the load is unfinished, see the `resume` argument
+    of :py:func:`pygtfs.loader.append_feed`. The load is resumed only from
+    the same export, identified by its :py:meth:`pygtfs.feed.Feed.fingerprint`.
+    """
+    __tablename__ = '_feed_load_progress'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    table_name = Column(Unicode, primary_key=True)
+    fingerprint = Column(Unicode)
+    rows_loaded = Column(Integer, default=0)
+    complete = Column(Boolean, default=False)
+
+    def __repr__(self):
+        return '<LoadProgress %s: %s %d%s>' % (self.feed_id, self.table_name,
+                                               self.rows_loaded,
+                                               ' complete' if self.complete else '')
+
+
 class Agency(Base):
     __tablename__ = 'agency'
     _plural_name_ = 'agencies'
@@ -243,6 +343,97 @@ class ShapePoint(Base):
         return '<ShapePoint %s>' % self.shape_id
 
 
+def _pack_doubles(values):
+    packed = array.array('d', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_doubles(data):
+    unpacked = array.array('d')
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+
+class ShapeGeometry(Base):
+    """ The line of a shape, stored once per shape.
+
+    Derived by the loader from the :py:class:`ShapePoint` entries of a feed,
+    in sequence order. The coordinates are packed as little endian doubles,
+    latitude and longitude alternating, and the distances as the cumulative
+    great circle distance in meters from the first point.
+    """
+    __tablename__ = '_shape_geometries'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    shape_id = Column(Unicode, primary_key=True)
+    point_count = Column(Integer)
+    length = Column(Float)
+    coordinates = Column(LargeBinary)
+    cumulative_distances = Column(LargeBinary)
+
+    @classmethod
+    def pack(cls, points):
+        """ The column values of a line of (lat, lon) `points`. """
+        from .spatial import distance
+
+        distances = [0.0]
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            distances.append(distances[-1] + distance(lat1, lon1, lat2, lon2))
+        return dict(point_count=len(points), length=distances[-1] if points else 0.0,
+                    coordinates=_pack_doubles(c for point in points for c in point),
+                    cumulative_distances=_pack_doubles(distances))
+
+    @property
+    def points(self):
+        """ A list of the (lat, lon) points of the shape. """
+        coordinates = _unpack_doubles(self.coordinates)
+        return list(zip(coordinates[0::2], coordinates[1::2]))
+
+    @property
+    def distances(self):
+        """ The distance in meters from the first point to every point. """
+        return _unpack_doubles(self.cumulative_distances).tolist()
+
+    def __repr__(self):
+        return '<ShapeGeometry %s: %d points>' % (self.shape_id, self.point_count)
+
+
+class HopGeometry(Base):
+    """ The part of a shape between two consecutive stops of a trip.
+
+    Derived by :py:func:`pygtfs.linear.reference_feed` once per shape, pair
+    of stops and start distance, so that a pattern passing the same pair of
+    stops twice along a looping shape has a hop for each pass. The
+    distances, rounded to three decimals, are in the units of the shape's
+    ``shape_dist_traveled``, or in meters along the shape if the feed leaves
+    them out. The coordinates are packed like the ones of
+    :py:class:`ShapeGeometry`, from the projection of the first stop to the
+    projection of the second.
+    """
+    __tablename__ = '_hop_geometries'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    shape_id = Column(Unicode, primary_key=True)
+    from_stop_id = Column(Unicode, primary_key=True)
+    to_stop_id = Column(Unicode, primary_key=True)
+    start_distance = Column(Float, primary_key=True)
+    end_distance = Column(Float)
+    coordinates = Column(LargeBinary)
+
+    __table_args__ = (
+        ForeignKeyConstraint([feed_id, shape_id],
+                             [ShapeGeometry.feed_id, ShapeGeometry.shape_id]),
+    )
+
+    points = ShapeGeometry.points
+
+    def __repr__(self):
+        return '<HopGeometry %s: %s - %s>' % (self.shape_id, self.from_stop_id,
+                                              self.to_stop_id)
+
+
 class Service(Base):
     __tablename__ = 'calendar'
     _plural_name_ = 'services'
@@ -292,6 +483,25 @@ class ServiceException(Base):
         return '<ServiceException %s: %s>' % (self.service_id, self.date)
 
 
+class ServiceDate(Base):
+    """ A date on which a service runs.
+
+    Derived by the loader from the :py:class:`Service` weekdays and date
+    range and the :py:class:`ServiceException` entries of a feed.
+    """
+    __tablename__ = '_service_dates'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    service_id = Column(Unicode, primary_key=True)
+
+    __table_args__ = (
+        ForeignKeyConstraint([feed_id, service_id], [Service.feed_id, Service.service_id]),
+    )
+
+    def __repr__(self):
+        return '<ServiceDate %s: %s>' % (self.service_id, self.date)
+
+
 class Trip(Base):
     __tablename__ = 'trips'
     _plural_name_ = 'trips'
@@ -318,8 +528,19 @@ class Trip(Base):
             primaryjoin=and_(Route.route_id==foreign(route_id),
                              Route.feed_id==feed_id))
 
-    shape_points = relationship(ShapePoint, backref="trips",
-            secondary="_trip_shapes")
+    # shapes are shared by many trips: both go through the one geometry row
+    # of the shape, ordered by sequence
+    shape_points = relationship(ShapePoint, backref=backref("trips", viewonly=True),
+            secondary=ShapeGeometry.__table__,
+            primaryjoin=and_(ShapeGeometry.feed_id == feed_id,
+                             ShapeGeometry.shape_id == shape_id),
+            secondaryjoin=and_(ShapeGeometry.feed_id == ShapePoint.feed_id,
+                               ShapeGeometry.shape_id == ShapePoint.shape_id),
+            order_by=ShapePoint.shape_pt_sequence, viewonly=True)
+
+    geometry = relationship(ShapeGeometry, viewonly=True,
+            primaryjoin=and_(foreign(shape_id) == ShapeGeometry.shape_id,
+                             feed_id == ShapeGeometry.feed_id))
 
     # TODO: The service_id references to calendar or to calendar_dates.
     # Need to implement this requirement, but not using a simple foreign key.
@@ -390,6 +611,67 @@ class StopTime(Base):
         return '<StopTime %s: %d>' % (self.trip_id, self.stop_sequence)
 
 
+class StopDeparture(Base):
+    """ A departure of a trip from a stop, for departure boards.
+
+    Derived by the loader from the :py:class:`StopTime` entries passengers
+    can board at, with the departure time in seconds after midnight of the
+    service day, and the service, route and headsign of the trip.
+    """
+    __tablename__ = '_stop_departures'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    trip_id = Column(Unicode, primary_key=True)
+    # the primary key of the stop time, which may repeat a stop_sequence
+    stop_id = Column(Unicode, primary_key=True)
+    stop_sequence = Column(Integer, primary_key=True)
+    departure_seconds = Column(Integer)
+    service_id = Column(Unicode)
+    route_id = Column(Unicode)
+    headsign = Column(Unicode, nullable=True)
+
+    __table_args__ = (
+        ForeignKeyConstraint([feed_id, trip_id], [Trip.feed_id, Trip.trip_id]),
+        Index('idx_stop_departures', feed_id, stop_id, departure_seconds),
+    )
+
+    def __repr__(self):
+        return '<StopDeparture %s: %s %d>' % (self.trip_id, self.stop_id,
+                                              self.departure_seconds)
+
+
+class StopDistance(Base):
+    """ The distance of a stop time along the shape of its trip.
+
+    Derived by :py:func:`pygtfs.linear.reference_feed`, in the units of
+    :py:class:`HopGeometry`. The ``shape_dist_traveled`` of the
+    :py:class:`StopTime` keeps the value given by the feed, so that
+    updating the feed compares it with the file and not with the derived
+    distance.
+    """
+    __tablename__ = '_stop_distances'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    trip_id = Column(Unicode, primary_key=True)
+    # the primary key of the stop time, which may repeat a stop_sequence
+    stop_id = Column(Unicode, primary_key=True)
+    stop_sequence = Column(Integer, primary_key=True)
+    distance = Column(Float)
+
+    __table_args__ = (
+        ForeignKeyConstraint([feed_id, trip_id], [Trip.feed_id, Trip.trip_id]),
+    )
+
+    stop_time = relationship(StopTime, viewonly=True,
+            backref=backref("distance", uselist=False, viewonly=True),
+            primaryjoin=and_(StopTime.feed_id == foreign(feed_id),
+                             StopTime.trip_id == foreign(trip_id),
+                             StopTime.stop_id == foreign(stop_id),
+                             StopTime.stop_sequence == foreign(stop_sequence)))
+
+    def __repr__(self):
+        return '<StopDistance %s: %s %d>' % (self.trip_id, self.stop_id,
+                                             self.stop_sequence)
+
+
 class Fare(Base):
     __tablename__ = 'fare_attributes'
     _plural_name_ = 'fares'
@@ -468,6 +750,29 @@ class Frequency(Base):
                                          self.end_time)
 
 
+class FrequencyTrip(Base):
+    """ A trip run by a frequency based trip, at one start time.
+
+    Derived from the :py:class:`Frequency` entries of a feed by
+    :py:meth:`pygtfs.Schedule.expand_frequencies`, only when asked for. The
+    stop times of the trip are the ones of the template trip, shifted by
+    `offset_seconds`.
+    """
+    __tablename__ = '_frequency_trips'
+    feed_id = Column(Integer, ForeignKey('_feed.feed_id'), primary_key=True)
+    trip_id = Column(Unicode, primary_key=True)
+    start_seconds = Column(Integer, primary_key=True)
+    offset_seconds = Column(Integer)
+    exact_times = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        ForeignKeyConstraint([feed_id, trip_id], [Trip.feed_id, Trip.trip_id]),
+    )
+
+    def __repr__(self):
+        return '<FrequencyTrip %s %d>' % (self.trip_id, self.start_seconds)
+
+
 class Transfer(Base):
     __tablename__ = 'transfers'
     _plural_name_ = 'transfers'
@@ -546,18 +851,6 @@ _stop_translations = Table(
 )
 
 
-_trip_shapes = Table(
-    '_trip_shapes', Base.metadata,
-    Column('trip_feed_id', Integer),
-    Column('shape_feed_id', Integer),
-    Column('trip_id', Unicode),
-    Column('shape_id', Unicode),
-    Column('shape_pt_sequence', Integer),
-    ForeignKeyConstraint(['trip_feed_id', 'trip_id'], [Trip.feed_id, Trip.trip_id]),
-    ForeignKeyConstraint(['shape_feed_id', 'shape_id', 'shape_pt_sequence'],
-        [ShapePoint.feed_id, ShapePoint.shape_id, ShapePoint.shape_pt_sequence]),
-)
-
 
 # a feed can skip Service (calendar) if it has ServiceException(calendar_dates)
 gtfs_required = {Agency, Stop, Route, Trip, StopTime}
@@ -566,3 +859,63 @@ gtfs_calendar = {Service, ServiceException}
 gtfs_all = [Agency, Stop, Transfer, Route, Fare, FareRule, ShapePoint,
             Service, ServiceException, Trip, Frequency, StopTime, FeedInfo,
             Translation]
+
+
+@functools.lru_cache(maxsize=None)
+def _column_converters(gtfs_class):
+    converters = {key: fn.converter
+                  for key, (fn, _) in inspect(gtfs_class).validators.items()}
+    pk_defaults = {c.name: c.default.arg for c in gtfs_class.__table__.primary_key
+                   if c.default is not None and c.default.is_scalar}
+    return converters, pk_defaults
+
+
+def convert_columns(gtfs_class, columns):
+    """ Convert batches of raw feed values for `gtfs_class`, column by column.
+
+    :param columns: A dict mapping field names to sequences of raw values, as
+        read from the feed. All sequences must have the same length.
+    :returns: A dict mapping the same field names to lists of converted
+        values, exactly as an instance of `gtfs_class` would hold them,
+        including the primary key defaults the ORM fills in for missing
+        values.
+    """
+    converters, pk_defaults = _column_converters(gtfs_class)
+    converted = {}
+    for key, values in columns.items():
+        converter = converters.get(key)
+        if converter is None:
+            values = list(values)
+        elif getattr(converter, 'memoize', False):
+            distinct = {value: None for value in values}
+            for value in distinct:
+                distinct[value] = converter(key, value)
+            values = [distinct[value] for value in values]
+        else:
+            values = [converter(key, value) for value in values]
+        if key in pk_defaults:
+            default = pk_defaults[key]
+            values = [default if value is None else value for value in values]
+        converted[key] = values
+    return converted
+
+
+def _row_converter(gtfs_class):
+    """ Return a function that turns a single feed record into column values.
+
+    The returned function takes a dict of raw values (as read from the feed)
+    and returns a dict suitable for a core ``INSERT``, see
+    :py:func:`convert_columns`.
+    """
+    converters, pk_defaults = _column_converters(gtfs_class)
+
+    def convert(record):
+        row = {}
+        for key, value in record.items():
+            if key in converters:
+                value = converters[key](key, value)
+            if value is None and key in pk_defaults:
+                value = pk_defaults[key]
+            row[key] = value
+        return row
+    return convert
@@ -0,0 +1,213 @@
+""" Linear referencing of stop times onto the shapes of their trips.
+
+:py:func:`reference_feed` projects the stops of every trip onto the trip's
+shape, and writes the distances along the shape to
+:py:class:`pygtfs.gtfs_entities.StopDistance` and the part of the shape
+between every two consecutive stops to
+:py:class:`pygtfs.gtfs_entities.HopGeometry`. The ``shape_dist_traveled``
+given by the feed is left as it is.
+
+The projection is done once per pattern, a shape and the sequence of stops
+of the trips following it, in NumPy: every stop of the pattern is projected
+on every segment of the shape at once, in a local equirectangular plane.
+The stops are then placed in order, each on the nearest segment that does
+not lie before the previous stop, so that shapes looping over themselves
+are followed in the direction of travel.
+
+Distances are in the units of the ``shape_dist_traveled`` of the shape
+points when the feed gives them for the whole shape, as GTFS requires the
+stop times to use the same units, and in meters along the shape otherwise.
+
+Requires numpy.
+"""
+
+import itertools
+import logging
+
+from sqlalchemy import select
+
+from .gtfs_entities import (HopGeometry, ShapeGeometry, ShapePoint, Stop,
+                            StopDistance, StopTime, Trip, _pack_doubles)
+from .spatial import EARTH_RADIUS
+
+logger = logging.getLogger(__name__)
+
+
+def _shapes(schedule, feed_id):
+    """ A dict mapping shape ids to the (n, 2) array of their (lat, lon)
+    points and the (n,) array of their distances. """
+    import numpy
+
+    feed_distances = {}
+    for shape_id, rows in itertools.groupby(schedule.session.execute(
+            select(ShapePoint.shape_id, ShapePoint.shape_dist_traveled)
+            .where(ShapePoint.feed_id == feed_id)
+            .order_by(ShapePoint.shape_id, ShapePoint.shape_pt_sequence)),
+            key=lambda row: row[0]):
+        distances = [distance for _, distance in rows]
+        if None not in distances:
+            feed_distances[shape_id] = numpy.array(distances, dtype='f8')
+
+    shapes = {}
+    for shape_id, coordinates, cumulative_distances in schedule.session.execute(
+            select(ShapeGeometry.shape_id, ShapeGeometry.coordinates,
+                   ShapeGeometry.cumulative_distances)
+            .where(ShapeGeometry.feed_id == feed_id)):
+        points = numpy.frombuffer(coordinates, dtype='<f8').reshape(-1, 2)
+        distances = feed_distances.get(shape_id)
+        if distances is None or len(distances) != len(points):
+            distances = numpy.frombuffer(cumulative_distances, dtype='<f8')
+        shapes[shape_id] = (points, distances)
+    return shapes
+
+
+def project(points, distances, stops):
+    """ The distances along a line of the projections of stops, in order.
+
+    :param points: An (n, 2) array of the (lat, lon) points of the line.
+    :param distances: The (n,) distances of the points along the line.
+    :param stops: An (m, 2) array of the (lat, lon) of the stops, in the
+        order they are visited.
+    :returns: An (m,) array of non decreasing distances.
+    """
+    import numpy
+
+    # a local plane in meters, good enough to compare distances to a line
+    scale = numpy.radians(1) * EARTH_RADIUS
+    cos_lat = numpy.cos(numpy.radians(points[:, 0].mean()))
+    xy = numpy.column_stack([points[:, 1] * cos_lat, points[:, 0]]) * scale
+    stop_xy = numpy.column_stack([stops[:, 1] * cos_lat, stops[:, 0]]) * scale
+
+    starts = xy[:-1]
+    vectors = xy[1:] - xy[:-1]
+    lengths = (vectors ** 2).sum(axis=1)
+    # (m, s): every stop against every segment
+    relative = stop_xy[:, None, :] - starts[None, :, :]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        t = (relative * vectors[None, :, :]).sum(axis=2) / lengths
+    t = numpy.clip(numpy.nan_to_num(t), 0, 1)
+    offsets = relative - t[:, :, None] * vectors[None, :, :]
+    squared = (offsets ** 2).sum(axis=2)
+    positions = distances[:-1] + t * (distances[1:] - distances[:-1])
+
+    found = numpy.empty(len(stops))
+    previous = -numpy.inf
+    for i in range(len(stops)):
+        ahead = numpy.where(positions[i] >= previous, squared[i], numpy.inf)
+        j = numpy.argmin(ahead)
+        if numpy.isinf(ahead[j]):
+            # every projection lies behind the previous stop
+            found[i] = previous
+        else:
+            found[i] = previous = positions[i, j]
+    return found
+
+
+def cut(points, distances, start, end):
+    """ The (k, 2) points of a line between two distances along it. """
+    import numpy
+
+    # the points at the ends, give or take rounding, are interpolated
+    inner = ((distances > start) & (distances < end) &
+             ~numpy.isclose(distances, start) & ~numpy.isclose(distances, end))
+    ends = numpy.column_stack([
+        numpy.interp([start, end], distances, points[:, 0]),
+        numpy.interp([start, end], distances, points[:, 1])])
+    return numpy.concatenate([ends[:1], points[inner], ends[1:]])
+
+
+def _patterns(schedule, feed_id, chunk_size):
+    """ A dict mapping (shape_id, stop_ids) patterns to the lists of
+    (trip_id, stop_sequences) of their trips. """
+    query = (select(StopTime.trip_id, StopTime.stop_sequence, StopTime.stop_id,
+                    Trip.shape_id)
+             .join(Trip, (Trip.feed_id == StopTime.feed_id) &
+                   (Trip.trip_id == StopTime.trip_id))
+             .where(StopTime.feed_id == feed_id)
+             .where(Trip.shape_id.isnot(None))
+             .order_by(StopTime.trip_id, StopTime.stop_sequence)
+             .execution_options(yield_per=chunk_size))
+    patterns = {}
+    for trip_id, rows in itertools.groupby(schedule.session.execute(query),
+                                           key=lambda row: row[0]):
+        rows = list(rows)
+        key = (rows[0].shape_id, tuple(row.stop_id for row in rows))
+        patterns.setdefault(key, []).append(
+            (trip_id, [row.stop_sequence for row in rows]))
+    return patterns
+
+
+def reference(schedule, feed_id, chunk_size=5000):
+    """ Compute the distances of the stop times of a feed along their shapes,
+    and the geometries of the hops between their stops, replacing the ones
+    computed before. Does not commit, see :py:func:`reference_feed`.
+
+    :returns: The number of stop times referenced.
+    """
+    import numpy
+
+    session = schedule.session
+    shapes = _shapes(schedule, feed_id)
+    stops = {stop_id: (lat, lon) for stop_id, lat, lon in session.execute(
+        select(Stop.stop_id, Stop.stop_lat, Stop.stop_lon)
+        .where(Stop.feed_id == feed_id))}
+    patterns = _patterns(schedule, feed_id, chunk_size)
+    logger.info('Projecting %d stop patterns onto %d shapes',
+                len(patterns), len(shapes))
+
+    for table in (StopDistance.__table__, HopGeometry.__table__):
+        session.execute(table.delete().where(table.c.feed_id == feed_id))
+    connection = session.connection()
+    rows = []
+    hops = {}
+    written = 0
+    for (shape_id, stop_ids), trips in patterns.items():
+        if shape_id not in shapes or len(shapes[shape_id][0]) < 2:
+            continue
+        if any(stops.get(stop_id, (None, None))[0] is None
+               or stops[stop_id][1] is None for stop_id in stop_ids):
+            continue
+        points, distances = shapes[shape_id]
+        found = project(points, distances,
+                        numpy.array([stops[stop_id] for stop_id in stop_ids]))
+        rounded = found.round(3).tolist()
+        for trip_id, stop_sequences in trips:
+            rows.extend(dict(feed_id=feed_id, trip_id=trip_id, stop_id=stop_id,
+                             stop_sequence=stop_sequence, distance=distance)
+                        for stop_id, stop_sequence, distance
+                        in zip(stop_ids, stop_sequences, rounded))
+            if len(rows) >= chunk_size:
+                connection.execute(StopDistance.__table__.insert(), rows)
+                written += len(rows)
+                rows = []
+        for i, (from_stop_id, to_stop_id) in enumerate(zip(stop_ids, stop_ids[1:])):
+            # a looping shape may pass the same pair of stops again further on
+            key = (shape_id, from_stop_id, to_stop_id, rounded[i])
+            if key not in hops:
+                hops[key] = dict(
+                    feed_id=feed_id, shape_id=shape_id, from_stop_id=from_stop_id,
+                    to_stop_id=to_stop_id, start_distance=rounded[i],
+                    end_distance=rounded[i + 1],
+                    coordinates=_pack_doubles(cut(
+                        points, distances, found[i], found[i + 1]).ravel().tolist()))
+    if rows:
+        connection.execute(StopDistance.__table__.insert(), rows)
+        written += len(rows)
+    hops = list(hops.values())
+    for start in range(0, len(hops), 100):
+        connection.execute(HopGeometry.__table__.insert(), hops[start:start + 100])
+    return written
+
+
+def reference_feed(schedule, feed_id, chunk_size=5000):
+    """ Compute and store the distances of the stop times of a feed along
+    their shapes, and the geometries of the hops between their stops.
+    :py:func:`pygtfs.loader.update_feed` computes them again when the
+    shapes, stops, trips or stop times of the feed change.
+
+    :returns: The number of stop times referenced.
+    """
+    written = reference(schedule, feed_id, chunk_size)
+    schedule._feeds_changed(feed_id)
+    schedule.session.commit()
+    return written
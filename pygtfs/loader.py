@@ -1,14 +1,23 @@
-from datetime import date
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+import itertools
 import logging
 import sys
 
-from sqlalchemy import and_
-from sqlalchemy.sql.expression import select, join
+from sqlalchemy import (and_, bindparam, event, exists,
+                        inspect as sqlalchemy_inspect, or_, text)
+from sqlalchemy.sql.expression import select
+from sqlalchemy.types import Integer, Numeric
 
-from .gtfs_entities import (Feed, Service, ServiceException, gtfs_required,
-                            Translation, Stop, Trip, ShapePoint, _stop_translations,
-                            _trip_shapes, gtfs_calendar, gtfs_all)
-from . import feed
+from .exceptions import PygtfsException
+from .gtfs_entities import (Base, Feed, Frequency, FrequencyTrip, HopGeometry,
+                            LoadProgress, Service, ServiceDate, ServiceException,
+                            ShapeGeometry, StopDeparture, StopDistance, StopTime,
+                            gtfs_required, Translation, Stop, Trip, ShapePoint,
+                            _stop_translations, gtfs_calendar, gtfs_all,
+                            convert_columns, _row_converter)
+from . import feed, frequencies, linear, postgres
 
 logger = logging.getLogger(__name__)
 
@@ -45,11 +54,213 @@ def overwrite_feed(schedule, feed_filename, *args, **kwargs):
     append_feed(schedule, feed_filename, *args, **kwargs)
 
 
+def update_feed(schedule, feed_filename, strip_fields=True, chunk_size=5000,
+                ignore_files=(), csv_engine='python'):
+    """ Update a stored feed to a new version of it, in place.
+
+    Every table of the latest feed with the same name is compared with the
+    new file on its primary key and the row contents, one table at a time,
+    and only the rows that were added, changed or removed are written, in a
+    single transaction. The feed keeps its feed_id, and the unchanged rows are
+    not touched. Tables in `ignore_files` are left as they are, except that
+    an ignored calendar.txt still gets the dummy services of new service
+    exceptions, as :py:func:`append_feed` creates them. If there is no such
+    feed yet, the feed is appended.
+
+    The derived tables are rebuilt for the rows that changed, and the
+    linear referencing of :py:func:`pygtfs.linear.reference_feed`, if the
+    feed has it, is computed again when its shapes, stops, trips or stop
+    times changed.
+    """
+    fd = feed.Feed(feed_filename, strip_fields, csv_engine=csv_engine)
+    stored = (schedule.session.query(Feed)
+              .filter(Feed.feed_name == fd.feed_name)
+              .filter(~Feed.load_progress.any())
+              .order_by(Feed.feed_id.desc())
+              .first())
+    if stored is None:
+        return append_feed(schedule, feed_filename, strip_fields=strip_fields,
+                           chunk_size=chunk_size, ignore_files=ignore_files,
+                           csv_engine=csv_engine)
+    feed_id = stored.feed_id
+    gtfs_tables = _read_tables(fd, ignore_files)
+
+    # a table missing from the new feed is compared as empty
+    diffs = {}
+    for gtfs_class in gtfs_all:
+        if gtfs_class.__tablename__ + '.txt' not in ignore_files:
+            diffs[gtfs_class] = _TableDiff(gtfs_class)
+        elif gtfs_class is Service:
+            # the stored services are kept, but new service exceptions may
+            # still need their dummy services
+            diffs[gtfs_class] = _TableDiff(gtfs_class, insert_only=True)
+    # one table at a time, keeping only the changes of the tables compared
+    # so far in memory
+    for gtfs_class, diff in diffs.items():
+        if gtfs_class in gtfs_tables and not diff.is_read:
+            diff.read(gtfs_tables[gtfs_class], chunk_size)
+        if gtfs_class is Service and ServiceException in diffs:
+            # the services only the service exceptions create
+            exceptions = diffs[ServiceException]
+            if ServiceException in gtfs_tables:
+                exceptions.read(gtfs_tables[ServiceException], chunk_size)
+            diff.add_dummy_services(feed_id, exceptions)
+        diff.compare(schedule, feed_id, chunk_size)
+        print('%d inserted, %d updated, %d deleted for %s.'
+              % (len(diff.inserts), len(diff.updates), len(diff.deletes),
+                 gtfs_class))
+        logger.info('%d inserted, %d updated, %d deleted for %s.'
+                    % (len(diff.inserts), len(diff.updates), len(diff.deletes),
+                       gtfs_class))
+
+    # the expanded frequency trips are derived from the trips, frequencies
+    # and the first stop times
+    expanded = (any(diffs[c].changed() for c in (Trip, Frequency, StopTime)
+                    if c in diffs) and
+                schedule.session.execute(select(FrequencyTrip.trip_id).where(
+                    FrequencyTrip.feed_id == feed_id).limit(1)).first() is not None)
+    if expanded:
+        schedule.session.execute(FrequencyTrip.__table__.delete().where(
+            FrequencyTrip.feed_id == feed_id))
+    # the derived rows referencing deleted rows go before them
+    services_changed = any(diffs[c].changed() for c in gtfs_calendar if c in diffs)
+    if services_changed:
+        schedule.session.execute(ServiceDate.__table__.delete().where(
+            ServiceDate.feed_id == feed_id))
+    trip_ids = set()
+    for gtfs_class in (Trip, StopTime):
+        if gtfs_class in diffs:
+            trip_ids.update(diffs[gtfs_class].changed('trip_id'))
+    trip_ids = sorted(trip_ids)
+    for trip_ids_chunk in _chunked(trip_ids, 500):
+        schedule.session.execute(StopDeparture.__table__.delete().where(
+            StopDeparture.feed_id == feed_id).where(
+            StopDeparture.trip_id.in_(trip_ids_chunk)))
+    # the linear referencing is derived from the shapes, stops, trips and
+    # stop times, and the hops reference the shape geometries
+    referenced = (any(diffs[c].changed() for c in (ShapePoint, Stop, Trip, StopTime)
+                      if c in diffs) and
+                  schedule.session.execute(select(HopGeometry.shape_id).where(
+                      HopGeometry.feed_id == feed_id).limit(1)).first() is not None)
+    if referenced:
+        for table in (StopDistance.__table__, HopGeometry.__table__):
+            schedule.session.execute(table.delete().where(
+                table.c.feed_id == feed_id))
+    # the tables of older versions are no longer kept up to date, and would
+    # still reference the deleted rows
+    _delete_legacy_rows(schedule, feed_id)
+
+    # delete the dependent rows first, and insert them last
+    for diff in reversed(list(diffs.values())):
+        diff.apply_deletes(schedule, feed_id)
+    for diff in diffs.values():
+        diff.apply_updates(schedule, feed_id)
+        diff.apply_inserts(schedule, feed_id)
+    _remap_many_to_many(schedule, feed_id, diffs)
+    shape_ids = diffs[ShapePoint].changed('shape_id') if ShapePoint in diffs else set()
+    for shape_ids_chunk in _chunked(sorted(shape_ids), 500):
+        schedule.session.execute(ShapeGeometry.__table__.delete().where(
+            ShapeGeometry.feed_id == feed_id).where(
+            ShapeGeometry.shape_id.in_(shape_ids_chunk)))
+        _build_shape_geometries(schedule, feed_id, chunk_size, shape_ids_chunk)
+    if services_changed:
+        _build_service_dates(schedule, feed_id)
+    for trip_ids_chunk in _chunked(trip_ids, 500):
+        _build_stop_departures(schedule, feed_id, chunk_size, trip_ids_chunk)
+    if expanded:
+        frequencies.materialize(schedule, feed_id, chunk_size)
+    if referenced:
+        linear.reference(schedule, feed_id, chunk_size)
+    schedule._feeds_changed(feed_id)
+    stored.feed_append_date = date.today()
+    schedule.session.commit()
+
+    print('Complete.')
+    logger.info('Complete.')
+    return schedule
+
+
 def append_feed(schedule, feed_filename, strip_fields=True,
-                chunk_size=5000, agency_id_override=None, ignore_files=()):
+                chunk_size=5000, agency_id_override=None, ignore_files=(),
+                bulk=False, workers=None, max_in_flight=None, fast_load=False,
+                csv_engine='python', resume=False, expand_frequencies=False):
+    """ Load a gtfs feed into the schedule database.
+
+    :param bulk: Insert the rows with batched core ``INSERT`` statements
+        instead of creating an ORM instance per row. The values go through
+        the same validation, but skipping the unit of work makes loading
+        large feeds several times faster. Always used on PostgreSQL, where
+        the rows are streamed with ``COPY``.
+    :param workers: Parse and convert the feed files in a pool of this many
+        processes, split into chunks of a few megabytes, while this process
+        inserts the converted chunks in dependency order. Implies `bulk`.
+    :param max_in_flight: The maximum number of chunks being parsed or
+        waiting to be inserted, which bounds the memory used by `workers`.
+        Defaults to twice the number of workers.
+    :param fast_load: On sqlite, use the write-ahead log with
+        ``synchronous=NORMAL`` and drop the secondary indexes while loading,
+        then rebuild them in one pass and ``ANALYZE`` the database. A crash
+        may lose the last commits but does not corrupt the database, so it
+        can be combined with `resume`. Ignored on other databases.
+    :param csv_engine: The csv engine reading the feed files, see
+        :py:class:`pygtfs.feed.Feed`.
+    :param resume: Commit after every chunk and record the progress in the
+        :py:class:`pygtfs.gtfs_entities.LoadProgress` table. If an earlier
+        resumable load of a feed with the same name did not finish, continue
+        it from its last committed chunk instead of starting a new feed, as
+        long as the feed files were not changed (they have the same size and
+        modification time).
+        Implies `bulk`.
+    :param expand_frequencies: Store the trips run by the frequency based
+        trips, see :py:meth:`pygtfs.Schedule.expand_frequencies`.
+    """
+
+    fd = feed.Feed(feed_filename, strip_fields, csv_engine=csv_engine)
+    gtfs_tables = _read_tables(fd, ignore_files)
 
-    fd = feed.Feed(feed_filename, strip_fields)
+    with _FastLoad(schedule, fast_load) as fast:
+        checkpoint = None
+        if resume:
+            fingerprint = fd.fingerprint()
+            checkpoint = _Checkpoint.find(schedule, fd.feed_name, fingerprint)
+        if checkpoint is not None:
+            feed_id = checkpoint.feed_id
+            print('Resuming the load of feed %d' % feed_id)
+            logger.info('Resuming the load of feed %d' % feed_id)
+        else:
+            # create new feed
+            feed_entry = Feed(feed_name=fd.feed_name, feed_append_date=date.today())
+            schedule.session.add(feed_entry)
+            schedule.session.flush()
+            feed_id = feed_entry.feed_id
+            if resume:
+                checkpoint = _Checkpoint(schedule, feed_id, fingerprint)
+        _insert_tables(schedule, fd, gtfs_tables, feed_id, chunk_size, bulk,
+                       workers, max_in_flight, checkpoint)
+        schedule.session.flush()
+        schedule.session.commit()
+        fast.create_indexes()
+        _map_many_to_many(schedule, feed_id, gtfs_tables)
+        _build_shape_geometries(schedule, feed_id, chunk_size)
+        _build_service_dates(schedule, feed_id)
+        _build_stop_departures(schedule, feed_id, chunk_size)
+        if expand_frequencies:
+            frequencies.materialize(schedule, feed_id, chunk_size)
+        schedule._feeds_changed(feed_id)
+        if checkpoint is not None:
+            checkpoint.finish()
+        schedule.session.commit()
+
+    print('Complete.')
+    logger.info('Complete.')
+    return schedule
 
+
+def _read_tables(fd, ignore_files):
+    """ Open the tables of a feed, except for `ignore_files`.
+
+    Returns a dict mapping gtfs classes to their :py:class:`pygtfs.feed.CSV`.
+    """
     gtfs_tables = {}
     for gtfs_class in gtfs_all:
         gtfs_filename = gtfs_class.__tablename__ + '.txt'
@@ -62,108 +273,794 @@ def append_feed(schedule, feed_filename, strip_fields=True,
         logger.info('Loading GTFS data for %s:' % gtfs_class)
 
         try:
-            # We ignore the feed supplied feed id, because we create our own
-            # later.
             gtfs_tables[gtfs_class] = fd.read_table(gtfs_filename,
-                                                    set(c.name for c in gtfs_class.__table__.columns) - {'feed_id'})
+                                                    _gtfs_columns(gtfs_class))
         except (KeyError, IOError):
             if gtfs_class in gtfs_required:
                 raise IOError('Error: could not find %s' % gtfs_filename)
 
     if len(set(gtfs_tables) & gtfs_calendar) == 0:
         raise PygtfsException('Must have Calendar.txt or Calendar_dates.txt')
+    return gtfs_tables
 
 
-    # create new feed
-    feed_entry = Feed(feed_name=fd.feed_name, feed_append_date=date.today())
-    schedule.session.add(feed_entry)
-    schedule.session.flush()
-    feed_id = feed_entry.feed_id
+def _insert_tables(schedule, fd, gtfs_tables, feed_id, chunk_size, bulk,
+                   workers, max_in_flight, checkpoint):
+    # service ids of this feed, used to create dummy services for service
+    # exceptions without querying the database
+    known_services = set()
+    if checkpoint is not None:
+        known_services = checkpoint.known_services()
+        gtfs_tables = {gtfs_class: gtfs_table
+                       for gtfs_class, gtfs_table in gtfs_tables.items()
+                       if not checkpoint.is_complete(gtfs_class)}
+    if workers:
+        counts = _parallel_insert_tables(
+            schedule, fd, [c for c in gtfs_all if c in gtfs_tables], feed_id,
+            chunk_size, known_services, workers, max_in_flight or 2 * workers,
+            checkpoint)
     for gtfs_class in gtfs_all:
         if gtfs_class not in gtfs_tables:
             continue
         gtfs_table = gtfs_tables[gtfs_class]
 
-
-        for i, record in enumerate(gtfs_table):
-            if not record:
-                # Empty row.
-                continue
-
-            try:
-                instance = gtfs_class(feed_id=feed_id, **record._asdict())
-            except:
-                print("Failure while writing {0}".format(record))
-                logger.error("Failure while writing {0}".format(record))
-                raise
-            schedule.session.add(instance)
-
-            if isinstance(instance, ServiceException):
-                service = schedule.session.execute(
-                    select(Service).where(Service.service_id == instance.service_id).where(Service.feed_id == feed_id)
-                ).one_or_none()
-                if service is None:
-                    # ServiceException was added for a day that has no associated regular service
-                    # Create a dummy service object for this service exception
-                    dummy = Service(
-                        feed_id=feed_id,
-                        service_id=instance.service_id,
-                        monday='0',
-                        tuesday='0',
-                        wednesday='0',
-                        thursday='0',
-                        friday='0',
-                        saturday='0',
-                        sunday='0',
-                        start_date=instance.date.strftime('%Y%m%d'),
-                        end_date=instance.date.strftime('%Y%m%d'))
-                    schedule.session.add(dummy)
-
-            if i % chunk_size == 0 and i > 0:
-                schedule.session.flush()
-                sys.stdout.write('.')
-                sys.stdout.flush()
+        if workers:
+            i = counts[gtfs_class] - 1
+        elif (bulk or checkpoint is not None or
+              postgres.copy_supported(schedule.session.connection())):
+            i = _bulk_insert_table(schedule, gtfs_class, gtfs_table, feed_id,
+                                   chunk_size, known_services, checkpoint)
+        else:
+            i = _orm_insert_table(schedule, gtfs_class, gtfs_table, feed_id,
+                                  chunk_size, known_services)
         print('%d record%s read for %s.' % ((i+1), '' if i == 0 else 's',
                                             gtfs_class))
         logger.info('%d record%s read for %s.' % ((i+1), '' if i == 0 else 's',
                                             gtfs_class))
-    schedule.session.flush()
-    schedule.session.commit()
-    # load many to many relationships
+
+
+def _map_many_to_many(schedule, feed_id, gtfs_tables):
+    """ Load the many to many relationship tables of a feed """
     if Translation in gtfs_tables:
         print('Mapping translations to stops')
         logger.info('Mapping translations to stops')
-        q = (schedule.session.query(
-                Stop.feed_id.label('stop_feed_id'),
-                Translation.feed_id.label('translation_feed_id'),
-                Stop.stop_id.label('stop_id'),
-                Translation.trans_id.label('trans_id'),
-                Translation.lang.label('lang'))
-            .filter(Stop.feed_id==feed_id)
-            .filter(Translation.feed_id==feed_id)
-            .filter(Stop.stop_name==Translation.trans_id)
-            )
-        upd = _stop_translations.insert().from_select(
-                ['stop_feed_id', 'translation_feed_id', 'stop_id', 'trans_id', 'lang'], q)
-        schedule.session.execute(upd)
-    if ShapePoint in gtfs_tables:
-        print('Mapping shapes to trips')
-        logger.info('Mapping shapes to trips')
-        q = (schedule.session.query(
-                Trip.feed_id.label('trip_feed_id'),
-                ShapePoint.feed_id.label('shape_feed_id'),
-                Trip.trip_id.label('trip_id'),
-                ShapePoint.shape_id.label('shape_id'),
-                ShapePoint.shape_pt_sequence.label('shape_pt_sequence'))
-            .filter(Trip.feed_id==feed_id)
-            .filter(ShapePoint.feed_id==feed_id)
-            .filter(ShapePoint.shape_id==Trip.shape_id)
-            )
-        upd = _trip_shapes.insert().from_select(
-                ['trip_feed_id', 'shape_feed_id', 'trip_id', 'shape_id', 'shape_pt_sequence'], q)
-        schedule.session.execute(upd)
-    schedule.session.commit()
+        _map_stop_translations(schedule, feed_id)
 
-    print('Complete.')
-    logger.info('Complete.')
-    return schedule
+
+def _map_stop_translations(schedule, feed_id):
+    q = (schedule.session.query(
+            Stop.feed_id.label('stop_feed_id'),
+            Translation.feed_id.label('translation_feed_id'),
+            Stop.stop_id.label('stop_id'),
+            Translation.trans_id.label('trans_id'),
+            Translation.lang.label('lang'))
+        .filter(Stop.feed_id==feed_id)
+        .filter(Translation.feed_id==feed_id)
+        .filter(Stop.stop_name==Translation.trans_id)
+        )
+    upd = _stop_translations.insert().from_select(
+            ['stop_feed_id', 'translation_feed_id', 'stop_id', 'trans_id', 'lang'], q)
+    schedule.session.execute(upd)
+
+
+def _remap_many_to_many(schedule, feed_id, diffs):
+    """ Map the many to many relationships of the rows an update changed. """
+    session = schedule.session
+    if any(diffs[c].changed() for c in (Stop, Translation) if c in diffs):
+        session.execute(_stop_translations.delete().where(
+            _stop_translations.c.stop_feed_id == feed_id))
+        _map_stop_translations(schedule, feed_id)
+
+
+def _build_shape_geometries(schedule, feed_id, chunk_size, shape_ids=None):
+    """ Pack the points of every shape of a feed into one geometry row,
+    only of `shape_ids` if given. """
+    if shape_ids is None:
+        print('Packing shape geometries')
+        logger.info('Packing shape geometries')
+        schedule.session.execute(ShapeGeometry.__table__.delete().where(
+            ShapeGeometry.feed_id == feed_id))
+    query = (select(ShapePoint.shape_id, ShapePoint.shape_pt_lat,
+                    ShapePoint.shape_pt_lon)
+             .where(ShapePoint.feed_id == feed_id)
+             .order_by(ShapePoint.shape_id, ShapePoint.shape_pt_sequence)
+             .execution_options(yield_per=chunk_size))
+    if shape_ids is not None:
+        query = query.where(ShapePoint.shape_id.in_(shape_ids))
+    connection = schedule.session.connection()
+    rows = []
+    for shape_id, points in itertools.groupby(schedule.session.execute(query),
+                                              key=lambda row: row[0]):
+        rows.append(dict(ShapeGeometry.pack([(lat, lon) for _, lat, lon in points]),
+                         feed_id=feed_id, shape_id=shape_id))
+        if len(rows) >= 100:
+            connection.execute(ShapeGeometry.__table__.insert(), rows)
+            rows = []
+    if rows:
+        connection.execute(ShapeGeometry.__table__.insert(), rows)
+
+
+def _build_service_dates(schedule, feed_id):
+    """ Expand the services of a feed into the dates they run on. """
+    print('Expanding service dates')
+    logger.info('Expanding service dates')
+    session = schedule.session
+    session.execute(ServiceDate.__table__.delete().where(
+        ServiceDate.feed_id == feed_id))
+    weekdays = (Service.monday, Service.tuesday, Service.wednesday,
+                Service.thursday, Service.friday, Service.saturday,
+                Service.sunday)
+    service_dates = set()
+    for service_id, start_date, end_date, *days in session.execute(
+            select(Service.service_id, Service.start_date, Service.end_date,
+                   *weekdays).where(Service.feed_id == feed_id)):
+        if not any(days) or start_date is None or end_date is None:
+            continue
+        day = start_date
+        while day <= end_date:
+            if days[day.weekday()]:
+                service_dates.add((service_id, day))
+            day += timedelta(days=1)
+    for service_id, exception_date, exception_type in session.execute(
+            select(ServiceException.service_id, ServiceException.date,
+                   ServiceException.exception_type)
+            .where(ServiceException.feed_id == feed_id)):
+        if exception_type == 1:
+            service_dates.add((service_id, exception_date))
+        else:
+            service_dates.discard((service_id, exception_date))
+    service_dates = sorted(service_dates)
+    if service_dates:
+        _insert_columns(schedule, ServiceDate.__table__, {
+            'feed_id': [feed_id] * len(service_dates),
+            'service_id': [service_id for service_id, _ in service_dates],
+            'date': [service_date for _, service_date in service_dates]})
+
+
+def _build_stop_departures(schedule, feed_id, chunk_size, trip_ids=None):
+    """ Derive the departures of a feed from its stop times, only of
+    `trip_ids` if given. Stop times without a departure time or without
+    pickup are left out. """
+    if trip_ids is None:
+        print('Indexing stop departures')
+        logger.info('Indexing stop departures')
+        schedule.session.execute(StopDeparture.__table__.delete().where(
+            StopDeparture.feed_id == feed_id))
+    query = (select(StopTime.trip_id, StopTime.stop_sequence, StopTime.stop_id,
+                    StopTime.departure_time, Trip.service_id, Trip.route_id,
+                    StopTime.stop_headsign, Trip.trip_headsign)
+             .join(Trip, and_(Trip.feed_id == StopTime.feed_id,
+                              Trip.trip_id == StopTime.trip_id))
+             .where(StopTime.feed_id == feed_id)
+             .where(StopTime.departure_time.isnot(None))
+             .where((StopTime.pickup_type != 1) | StopTime.pickup_type.is_(None))
+             .execution_options(yield_per=chunk_size))
+    if trip_ids is not None:
+        query = query.where(StopTime.trip_id.in_(trip_ids))
+    fields = ('trip_id', 'stop_sequence', 'stop_id', 'departure_seconds',
+              'service_id', 'route_id', 'headsign')
+    for rows in schedule.session.execute(query).partitions():
+        columns = {field: [] for field in fields}
+        for (trip_id, stop_sequence, stop_id, departure_time, service_id,
+             route_id, stop_headsign, trip_headsign) in rows:
+            for field, value in zip(fields, (
+                    trip_id, stop_sequence, stop_id,
+                    int(departure_time.total_seconds()), service_id, route_id,
+                    stop_headsign or trip_headsign)):
+                columns[field].append(value)
+        columns['feed_id'] = [feed_id] * len(rows)
+        _insert_columns(schedule, StopDeparture.__table__, columns)
+
+
+# The tables the loader derives from the feed tables: the derived table,
+# the tables it is derived from, and the function building it for a feed.
+_derived_tables = [
+    (ShapeGeometry, (ShapePoint,), _build_shape_geometries),
+    (ServiceDate, (Service, ServiceException),
+     lambda schedule, feed_id, chunk_size: _build_service_dates(schedule, feed_id)),
+    (StopDeparture, (StopTime,), _build_stop_departures),
+]
+
+# The tables of older versions that reference the feed tables, with their
+# feed id columns.
+_legacy_tables = {'_trip_shapes': ('trip_feed_id', 'shape_feed_id')}
+
+
+def _missing_derived(schedule):
+    """ The (derived table, feed_id) of the feeds with rows to derive but
+    none derived, as loaded by an older version of pygtfs. Unfinished
+    resumable loads are left out. """
+    session = schedule.session
+    inspector = sqlalchemy_inspect(session.connection())
+    missing = set()
+    for derived, sources, _ in _derived_tables:
+        query = select(Feed.feed_id).where(or_(*(
+            exists().where(source.feed_id == Feed.feed_id) for source in sources)))
+        if inspector.has_table(LoadProgress.__tablename__):
+            query = query.where(
+                ~exists().where(LoadProgress.feed_id == Feed.feed_id))
+        if inspector.has_table(derived.__tablename__):
+            query = query.where(~exists().where(derived.feed_id == Feed.feed_id))
+        missing.update((derived, feed_id)
+                       for feed_id in session.execute(query).scalars())
+    return missing
+
+
+def _build_missing_derived(schedule, chunk_size=5000):
+    """ Build the derived tables of the feeds loaded by an older version
+    of pygtfs, and commit. Returns the (derived table, feed_id) built. """
+    missing = _missing_derived(schedule)
+    for derived, _, build in _derived_tables:
+        for feed_id in sorted(f for d, f in missing if d is derived):
+            logger.info('Building %s of feed %d', derived.__tablename__, feed_id)
+            build(schedule, feed_id, chunk_size)
+    if missing:
+        schedule.session.commit()
+    return missing
+
+
+def _delete_legacy_rows(schedule, feed_id):
+    """ Delete the rows of a feed from the tables of older versions, if the
+    database still has them. """
+    inspector = sqlalchemy_inspect(schedule.session.connection())
+    for table_name, columns in _legacy_tables.items():
+        if inspector.has_table(table_name):
+            schedule.session.execute(text('DELETE FROM %s WHERE %s' % (
+                table_name, ' OR '.join('%s = :feed_id' % c for c in columns))),
+                dict(feed_id=feed_id))
+
+
+def _chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _dummy_service(feed_id, service_id, service_date):
+    """ The values of a service that only exists through service exceptions """
+    return dict(feed_id=feed_id,
+                service_id=service_id,
+                monday='0',
+                tuesday='0',
+                wednesday='0',
+                thursday='0',
+                friday='0',
+                saturday='0',
+                sunday='0',
+                start_date=service_date.strftime('%Y%m%d'),
+                end_date=service_date.strftime('%Y%m%d'))
+
+
+def _orm_insert_table(schedule, gtfs_class, gtfs_table, feed_id, chunk_size,
+                      known_services):
+    """ Insert the records of one table as ORM instances.
+
+    `known_services` holds the service ids inserted so far for this feed, and
+    is used to create dummy services for service exceptions without querying
+    the database.
+
+    Returns the index of the last record read.
+    """
+    dummies = []
+    i = -1
+    for i, record in enumerate(gtfs_table):
+        if not record:
+            # Empty row.
+            continue
+
+        try:
+            instance = gtfs_class(feed_id=feed_id, **record._asdict())
+        except:
+            print("Failure while writing {0}".format(record))
+            logger.error("Failure while writing {0}".format(record))
+            raise
+        schedule.session.add(instance)
+
+        if isinstance(instance, Service):
+            known_services.add(instance.service_id)
+        elif isinstance(instance, ServiceException):
+            if instance.service_id not in known_services:
+                # ServiceException was added for a day that has no associated regular service
+                # Create a dummy service object for this service exception
+                known_services.add(instance.service_id)
+                dummies.append(Service(**_dummy_service(
+                    feed_id, instance.service_id, instance.date)))
+
+        if i % chunk_size == 0 and i > 0:
+            schedule.session.flush()
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    schedule.session.add_all(dummies)
+    return i
+
+
+def _bulk_insert_table(schedule, gtfs_class, gtfs_table, feed_id, chunk_size,
+                       known_services, checkpoint=None):
+    """ Insert the records of one table with batched core inserts.
+
+    Works like :py:func:`_orm_insert_table`, reading and converting
+    `chunk_size` records at a time as columns. With a `checkpoint`, skips the
+    records loaded before and commits after every chunk.
+
+    Returns the index of the last record read.
+    """
+    skip = checkpoint.rows_loaded(gtfs_class) if checkpoint is not None else 0
+    i = -1
+    for batch in gtfs_table.batches(chunk_size):
+        n = len(batch[0])
+        if skip >= n:
+            skip -= n
+            i += n
+            continue
+        if skip:
+            batch = [column[skip:] for column in batch]
+            i += skip
+            n -= skip
+            skip = 0
+        columns = _convert_batch(gtfs_class, gtfs_table.header, batch)
+        _write_columns(schedule, gtfs_class, gtfs_table.header, columns,
+                       feed_id, known_services)
+        i += n
+        if checkpoint is not None:
+            checkpoint.advance(gtfs_class, n)
+        sys.stdout.write('.')
+        sys.stdout.flush()
+    if checkpoint is not None:
+        checkpoint.table_complete(gtfs_class)
+    return i
+
+
+def _convert_batch(gtfs_class, fields, batch):
+    """ Convert a batch of raw columns, see :py:func:`convert_columns`.
+
+    Returns the dict of converted columns.
+    """
+    try:
+        return convert_columns(gtfs_class, dict(zip(fields, batch)))
+    except Exception:
+        # find the offending record to report it
+        convert = _row_converter(gtfs_class)
+        for values in zip(*batch):
+            record = dict(zip(fields, values))
+            try:
+                convert(record)
+            except:
+                print("Failure while writing {0}".format(record))
+                logger.error("Failure while writing {0}".format(record))
+                raise
+        raise
+
+
+def _write_columns(schedule, gtfs_class, fields, columns, feed_id,
+                   known_services):
+    """ Insert converted columns, and the dummy services they require. """
+    columns = {f: columns[f] for f in fields}
+    columns['feed_id'] = [feed_id] * len(columns[fields[0]])
+    _insert_columns(schedule, gtfs_class.__table__, columns)
+
+    if gtfs_class is Service:
+        known_services.update(columns['service_id'])
+    elif gtfs_class is ServiceException:
+        dummies = []
+        for service_id, service_date in zip(columns['service_id'], columns['date']):
+            if service_id not in known_services:
+                # ServiceException was added for a day that has no associated regular service
+                # Create a dummy service for this service exception
+                known_services.add(service_id)
+                dummies.append(_dummy_service(feed_id, service_id, service_date))
+        if dummies:
+            _insert_columns(schedule, Service.__table__, convert_columns(
+                Service, {k: [d[k] for d in dummies] for k in dummies[0]}))
+
+
+def _insert_columns(schedule, table, columns):
+    """ Insert columns of converted values, using ``COPY`` on PostgreSQL. """
+    connection = schedule.session.connection()
+    if postgres.copy_supported(connection):
+        postgres.copy_columns(connection, table, columns)
+    else:
+        connection.execute(table.insert(),
+                           [dict(zip(columns, values))
+                            for values in zip(*columns.values())])
+
+
+# The size of the chunks files are split into when loading with workers.
+_CHUNK_BYTES = 4 * 2 ** 20
+
+
+def _gtfs_columns(gtfs_class):
+    # We ignore the feed supplied feed id, because we create our own later.
+    return set(c.name for c in gtfs_class.__table__.columns) - {'feed_id'}
+
+
+def _parse_convert_chunk(gtfs_class, chunk, strip_fields, csv_engine):
+    """ Parse and convert a chunk of a file, in a worker process.
+
+    Returns the number of records read, the field names and the converted
+    columns (or None if the chunk has no records).
+    """
+    table = feed.read_chunk(chunk, gtfs_class.__tablename__ + '.txt',
+                            _gtfs_columns(gtfs_class), strip_fields,
+                            csv_engine=csv_engine)
+    for batch in table.batches(len(chunk)):
+        return (len(batch[0]), table.header,
+                _convert_batch(gtfs_class, table.header, batch))
+    return 0, None, None
+
+
+def _parallel_insert_tables(schedule, fd, gtfs_classes, feed_id, chunk_size,
+                            known_services, workers, max_in_flight,
+                            checkpoint=None):
+    """ Load tables with a pool of parsing processes and a single writer.
+
+    The chunks are submitted and written in the order of `gtfs_classes`, with
+    at most `max_in_flight` chunks pending at any time. With a `checkpoint`,
+    the records loaded before are skipped and every chunk is committed.
+
+    Returns a dict with the number of records read per class.
+    """
+    def chunks():
+        for gtfs_class in gtfs_classes:
+            filename = gtfs_class.__tablename__ + '.txt'
+            for chunk in fd.read_chunks(filename, _CHUNK_BYTES):
+                yield gtfs_class, chunk
+
+    counts = dict.fromkeys(gtfs_classes, 0)
+    skip = {gtfs_class: checkpoint.rows_loaded(gtfs_class) if checkpoint else 0
+            for gtfs_class in gtfs_classes}
+    current = None
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        tasks = chunks()
+
+        def submit():
+            for gtfs_class, chunk in tasks:
+                pending.append((gtfs_class, pool.submit(
+                    _parse_convert_chunk, gtfs_class, chunk, fd.strip_fields,
+                    fd.csv_engine)))
+                return
+
+        for _ in range(max_in_flight):
+            submit()
+        while pending:
+            gtfs_class, future = pending.popleft()
+            n, fields, columns = future.result()
+            submit()
+            if checkpoint is not None and current not in (None, gtfs_class):
+                checkpoint.table_complete(current)
+            current = gtfs_class
+            counts[gtfs_class] += n
+            if fields is None or skip[gtfs_class] >= n:
+                skip[gtfs_class] -= min(n, skip[gtfs_class])
+                continue
+            for start in range(skip[gtfs_class], n, chunk_size):
+                _write_columns(schedule, gtfs_class, fields,
+                               {f: columns[f][start:start + chunk_size]
+                                for f in fields},
+                               feed_id, known_services)
+                if checkpoint is not None:
+                    checkpoint.advance(gtfs_class, min(chunk_size, n - start))
+            skip[gtfs_class] = 0
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    if checkpoint is not None and current is not None:
+        checkpoint.table_complete(current)
+    return counts
+
+
+class _Checkpoint(object):
+    """ The progress of a resumable load, see `resume` of :py:func:`append_feed`.
+
+    Progress is counted in non blank records per table, and committed with
+    the rows it describes.
+    """
+
+    def __init__(self, schedule, feed_id, fingerprint, progress=()):
+        self.schedule = schedule
+        self.feed_id = feed_id
+        self.fingerprint = fingerprint
+        self.progress = {p.table_name: p for p in progress}
+
+    @classmethod
+    def find(cls, schedule, feed_name, fingerprint):
+        """ The checkpoint of the latest unfinished load of `feed_name`, if
+        any, provided it was loading the files with this `fingerprint`. """
+        unfinished = (schedule.session.query(Feed)
+                      .filter(Feed.feed_name == feed_name)
+                      .filter(Feed.load_progress.any())
+                      .order_by(Feed.feed_id.desc())
+                      .first())
+        if unfinished is None:
+            return None
+        if any(p.fingerprint != fingerprint for p in unfinished.load_progress):
+            logger.warning('The files of the unfinished load of feed %d have '
+                           'changed, starting a new feed' % unfinished.feed_id)
+            return None
+        return cls(schedule, unfinished.feed_id, fingerprint,
+                   unfinished.load_progress)
+
+    def _get(self, gtfs_class):
+        name = gtfs_class.__tablename__
+        if name not in self.progress:
+            self.progress[name] = LoadProgress(feed_id=self.feed_id,
+                                               table_name=name,
+                                               fingerprint=self.fingerprint,
+                                               rows_loaded=0, complete=False)
+            self.schedule.session.add(self.progress[name])
+        return self.progress[name]
+
+    def known_services(self):
+        return set(self.schedule.session.execute(
+            select(Service.service_id).where(Service.feed_id == self.feed_id)
+        ).scalars())
+
+    def rows_loaded(self, gtfs_class):
+        return self._get(gtfs_class).rows_loaded
+
+    def is_complete(self, gtfs_class):
+        return self._get(gtfs_class).complete
+
+    def advance(self, gtfs_class, n):
+        self._get(gtfs_class).rows_loaded += n
+        self.schedule.session.commit()
+
+    def table_complete(self, gtfs_class):
+        self._get(gtfs_class).complete = True
+        self.schedule.session.commit()
+
+    def finish(self):
+        """ Forget the progress; commit with the last steps of the load. """
+        for progress in self.progress.values():
+            self.schedule.session.delete(progress)
+
+
+class _FastLoad(object):
+    """ Load time settings for sqlite databases.
+
+    On entering, switches to the write-ahead log with ``synchronous=NORMAL``
+    and drops the secondary indexes. A crash or power loss may lose the last
+    commits, but not corrupt the database, so a `resume` checkpoint stays
+    consistent with the rows loaded. :py:meth:`create_indexes` rebuilds the indexes, and exiting
+    rebuilds them if needed, runs ``ANALYZE`` and restores the pragmas.
+    Does nothing unless `enabled` and the database is sqlite.
+    """
+
+    pragmas = (('journal_mode', 'WAL'),
+               ('synchronous', 'NORMAL'),
+               ('cache_size', '-262144'),
+               ('temp_store', 'MEMORY'))
+
+    def __init__(self, schedule, enabled):
+        self.schedule = schedule
+        self.enabled = enabled and schedule.engine.dialect.name == 'sqlite'
+        self.saved = ()
+        self.indexes_dropped = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        session = self.schedule.session
+        # pragmas like journal_mode can't change inside a transaction
+        session.commit()
+        self.saved = tuple((name, session.execute(text('PRAGMA %s' % name)).scalar())
+                           for name, _ in self.pragmas)
+        self._set_pragmas(session.connection().connection.dbapi_connection)
+        # the session may check out another connection after each commit
+        event.listen(self.schedule.engine, 'checkout', self._on_checkout)
+
+        logger.info('Dropping indexes for loading')
+        for index in self._indexes():
+            index.drop(bind=session.connection(), checkfirst=True)
+        session.commit()
+        self.indexes_dropped = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        session = self.schedule.session
+        if exc_type is not None:
+            # otherwise a later rollback would also undo the index creation
+            session.rollback()
+        self.create_indexes()
+        if exc_type is None:
+            logger.info('Analyzing database')
+            session.execute(text('ANALYZE'))
+            session.commit()
+        event.remove(self.schedule.engine, 'checkout', self._on_checkout)
+        for name, value in self.saved:
+            session.execute(text('PRAGMA %s = %s' % (name, value)))
+        session.commit()
+
+    def create_indexes(self):
+        """ Rebuild the indexes dropped on entering. """
+        if not self.indexes_dropped:
+            return
+        print('Creating indexes')
+        logger.info('Creating indexes')
+        session = self.schedule.session
+        for index in self._indexes():
+            index.create(bind=session.connection(), checkfirst=True)
+        session.commit()
+        self.indexes_dropped = False
+
+    @staticmethod
+    def _indexes():
+        return [index for table in Base.metadata.sorted_tables
+                for index in table.indexes]
+
+    def _set_pragmas(self, dbapi_connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self._set_pragmas(dbapi_connection)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class _TableDiff(object):
+    """ The changes between the stored rows of a table and a new version.
+
+    Rows are matched on their primary key, or on all their values for tables
+    without a natural key (fare rules), and compared on all their values.
+    Before matching and comparing, numbers are normalized, as the raw feed
+    values of unvalidated fields are stored as strings and read back as
+    numbers.
+
+    With `insert_only`, only the new rows missing from the stored ones are
+    inserted, and the stored rows are left as they are.
+    """
+
+    def __init__(self, gtfs_class, insert_only=False):
+        self.gtfs_class = gtfs_class
+        self.insert_only = insert_only
+        self.table = table = gtfs_class.__table__
+        surrogate = table.autoincrement_column
+        self.columns = [c for c in table.columns
+                        if c.name != 'feed_id' and c is not surrogate]
+        if surrogate is not None:
+            self.identity = [surrogate]
+            self.key = list(range(len(self.columns)))
+        else:
+            self.identity = [c for c in table.primary_key if c.name != 'feed_id']
+            self.key = [self.columns.index(c) for c in self.identity]
+        self.normalizers = []
+        for c in self.columns:
+            if isinstance(c.type, Numeric):
+                self.normalizers.append(_to_float)
+            elif isinstance(c.type, Integer):
+                self.normalizers.append(_to_int)
+            else:
+                self.normalizers.append(None)
+        # the new rows by key, as lists of (normalized values, values)
+        self.new_rows = {}
+        self.is_read = False
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+
+    def _key_and_normalized(self, values):
+        normalized = tuple(values[i] if normalize is None or values[i] is None
+                           else normalize(values[i])
+                           for i, normalize in enumerate(self.normalizers))
+        return tuple(normalized[i] for i in self.key), normalized
+
+    def add(self, values):
+        key, normalized = self._key_and_normalized(values)
+        self.new_rows.setdefault(key, []).append((normalized, values))
+
+    def read(self, gtfs_table, chunk_size):
+        """ Read and convert the rows of the new version of the table. """
+        missing = {c.name: c.default.arg if c.default is not None and c.default.is_scalar
+                   else None for c in self.columns}
+        for batch in gtfs_table.batches(chunk_size):
+            columns = _convert_batch(self.gtfs_class, gtfs_table.header, batch)
+            n = len(batch[0])
+            for values in zip(*(columns[c.name] if c.name in columns
+                                else [missing[c.name]] * n
+                                for c in self.columns)):
+                self.add(values)
+        self.is_read = True
+
+    def add_dummy_services(self, feed_id, service_exceptions):
+        """ Add the dummy services that loading `service_exceptions` creates. """
+        exception_service_id = service_exceptions.columns.index(
+            ServiceException.__table__.c.service_id)
+        exception_date = service_exceptions.columns.index(
+            ServiceException.__table__.c.date)
+        for entries in list(service_exceptions.new_rows.values()):
+            for _, values in entries:
+                if (values[exception_service_id],) in self.new_rows:
+                    continue
+                dummy = convert_columns(Service, {
+                    k: [v] for k, v in _dummy_service(
+                        feed_id, values[exception_service_id],
+                        values[exception_date]).items()})
+                self.add(tuple(dummy[c.name][0] for c in self.columns))
+
+    def compare(self, schedule, feed_id, chunk_size):
+        """ Compare the stored rows with the new ones, streaming them. """
+        query = (select(*(self.identity + self.columns))
+                 .where(self.table.c.feed_id == feed_id)
+                 .execution_options(yield_per=chunk_size))
+        n = len(self.identity)
+        for row in schedule.session.execute(query):
+            key, normalized = self._key_and_normalized(row[n:])
+            entries = self.new_rows.get(key)
+            if not entries:
+                if not self.insert_only:
+                    self.deletes.append(tuple(row))
+                continue
+            new_normalized, values = entries.pop()
+            if not entries:
+                del self.new_rows[key]
+            if new_normalized != normalized and not self.insert_only:
+                self.updates.append((tuple(row), values))
+        self.inserts = [values for entries in self.new_rows.values()
+                        for _, values in entries]
+        self.new_rows = {}
+
+    def changed(self, name=None):
+        """ The set of values of the column `name` in all changed rows, or
+        whether there are changes at all if `name` is None. """
+        if name is None:
+            return bool(self.inserts or self.updates or self.deletes)
+        i = self.columns.index(self.table.c[name])
+        n = len(self.identity)
+        changed = {values[i] for values in self.inserts}
+        for row, values in self.updates:
+            changed.update((row[n + i], values[i]))
+        changed.update(row[n + i] for row in self.deletes)
+        return changed
+
+    def _where_identity(self, feed_id):
+        return [self.table.c.feed_id == feed_id] + [
+            c == bindparam('_old_' + c.name) for c in self.identity]
+
+    def _identity_params(self, row):
+        return {'_old_' + c.name: value for c, value in zip(self.identity, row)}
+
+    def apply_deletes(self, schedule, feed_id):
+        if not self.deletes:
+            return
+        schedule.session.connection().execute(
+            self.table.delete().where(*self._where_identity(feed_id)),
+            [self._identity_params(row) for row in self.deletes])
+
+    def apply_updates(self, schedule, feed_id):
+        if not self.updates:
+            return
+        changing = [(i, c) for i, c in enumerate(self.columns)
+                    if c not in self.identity]
+        statement = (self.table.update()
+                     .where(*self._where_identity(feed_id))
+                     .values({c.name: bindparam('_new_' + c.name)
+                              for _, c in changing}))
+        params = []
+        for row, values in self.updates:
+            row_params = self._identity_params(row)
+            row_params.update(('_new_' + c.name, values[i]) for i, c in changing)
+            params.append(row_params)
+        schedule.session.connection().execute(statement, params)
+
+    def apply_inserts(self, schedule, feed_id):
+        if not self.inserts:
+            return
+        columns = {c.name: [values[i] for values in self.inserts]
+                   for i, c in enumerate(self.columns)}
+        columns['feed_id'] = [feed_id] * len(self.inserts)
+        _insert_columns(schedule, self.table, columns)
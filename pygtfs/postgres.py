@@ -0,0 +1,74 @@
+""" Loading into PostgreSQL with ``COPY ... FROM STDIN``.
+
+The loader sends converted columns through :py:func:`copy_columns` whenever
+the schedule database is PostgreSQL and the driver supports ``COPY``
+(psycopg2 or psycopg 3). Rows are streamed in the ``text`` format, which
+keeps NULLs and empty strings apart.
+"""
+
+import datetime
+import io
+
+
+def copy_supported(connection):
+    """ Whether `connection` (a sqlalchemy connection) can ``COPY``. """
+    return (connection.dialect.name == 'postgresql' and
+            connection.dialect.driver in ('psycopg2', 'psycopg'))
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_text(value):
+    """ Format a python value as a field of the ``COPY`` text format. """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.timedelta):
+        return '%d seconds' % (value.days * 86400 + value.seconds)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, str):
+        return _escape(value)
+    return str(value)
+
+
+def copy_columns(connection, table, columns):
+    """ Insert `columns` (a dict of equally long lists) into `table`.
+
+    Columns of `table` that are missing from `columns` and have a python side
+    scalar default get that default, like a core ``INSERT`` would give them.
+    """
+    columns = dict(columns)
+    n = len(next(iter(columns.values())))
+    for column in table.columns:
+        if (column.name not in columns and column.default is not None and
+                column.default.is_scalar):
+            columns[column.name] = [column.default.arg] * n
+
+    buf = io.StringIO()
+    for values in zip(*columns.values()):
+        buf.write('\t'.join(map(copy_text, values)))
+        buf.write('\n')
+
+    preparer = connection.dialect.identifier_preparer
+    statement = 'COPY %s (%s) FROM STDIN' % (
+        preparer.format_table(table),
+        ', '.join(preparer.quote(name) for name in columns))
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            buf.seek(0)
+            cursor.copy_expert(statement, buf)
+        else:
+            # psycopg 3
+            with cursor.copy(statement) as copy:
+                copy.write(buf.getvalue())
+    finally:
+        cursor.close()
@@ -0,0 +1,431 @@
+""" Journey planning with RAPTOR over the timetable of a service date.
+
+:py:func:`compile_timetable` reads the trips of a feed running on a date
+into the arrays of the RAPTOR algorithm (Delling, Pajor and Werneck, *Round
+Based Public Transit Routing*, 2012):
+
+* the trips are grouped into patterns, trips serving the same sequence of
+  stops with the same pickup and drop off rules, where no trip overtakes
+  another; the departures and arrivals of a pattern are kept per stop of
+  the pattern, sorted, so the first trip to catch is found by bisection,
+* every stop has the list of the patterns serving it, and of the transfers
+  leaving from it.
+
+The trips of the service day before that run past midnight are included,
+and frequency based trips are expanded, see :py:mod:`pygtfs.frequencies`.
+Times are seconds after midnight of the date, and the queries take and
+return :py:class:`datetime.timedelta` like :py:meth:`pygtfs.Schedule.departures`.
+
+:py:meth:`Timetable.earliest_arrival` finds the journey arriving first, and
+:py:meth:`Timetable.pareto` the journeys that are optimal for both their
+arrival time and their number of transfers. Only the generic stop to stop
+transfers of ``transfers.txt`` are used; transfers without a minimum time
+take the walking time along a straight line. Changing trips at the same
+stop takes the `min_transfer_time` of the transfer from the stop to itself,
+or `min_transfer_seconds` of :py:func:`compile_timetable`.
+
+The trips are read from the database rather than from the
+:py:mod:`pygtfs.columnar` snapshots, which require numpy and hold neither
+the service dates nor the frequencies.
+"""
+
+import bisect
+import collections
+import datetime
+import itertools
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import aliased
+
+from .exceptions import PygtfsException
+from .frequencies import start_times
+from .gtfs_entities import (Feed, Frequency, ServiceDate, Stop, StopTime,
+                            Transfer, Trip)
+from .spatial import distance
+
+# A leg of a :py:data:`Journey`: a ride on `trip_id`, or a walk between
+# two stops (`trip_id` and `route_id` None).
+Leg = collections.namedtuple(
+    'Leg', ['from_stop_id', 'to_stop_id', 'departure_time', 'arrival_time',
+            'trip_id', 'route_id'])
+
+# A journey from one stop to another, as a list of legs.
+Journey = collections.namedtuple(
+    'Journey', ['departure_time', 'arrival_time', 'transfers', 'legs'])
+
+_INFINITY = float('inf')
+
+
+def _seconds(value):
+    return None if value is None else int(value.total_seconds())
+
+
+def _interpolate(times):
+    """ Fill the missing times of a trip linearly between the known ones. """
+    known = [i for i, t in enumerate(times) if t is not None]
+    if not known:
+        return None
+    for a, b in zip(known, known[1:]):
+        for i in range(a + 1, b):
+            times[i] = times[a] + (times[b] - times[a]) * (i - a) // (b - a)
+    for i in range(known[0]):
+        times[i] = times[known[0]]
+    for i in range(known[-1] + 1, len(times)):
+        times[i] = times[known[-1]]
+    return times
+
+
+class Timetable(object):
+    """ The RAPTOR arrays of the trips of a feed on a service date, see
+    :py:func:`compile_timetable`.
+
+    :ivar stop_ids: The stop ids, indexed by stop.
+    :ivar pattern_stops: For every pattern, the stops it serves in order.
+    :ivar pattern_trips: For every pattern, the (trip_id, route_id) of its
+        trips, in the order of their departures.
+    :ivar departures: For every pattern and stop of the pattern, the
+        departures in seconds of its trips.
+    :ivar arrivals: Likewise, the arrivals.
+    :ivar boarding: For every pattern, whether passengers can board at every
+        stop of it.
+    :ivar alighting: Likewise, whether passengers can get off.
+    :ivar stop_patterns: For every stop, the (pattern, position) of the
+        patterns serving it.
+    :ivar transfers: For every stop, the (stop, seconds) of the transfers
+        leaving it.
+    :ivar change_seconds: For every stop, the seconds it takes to get off a
+        trip and board another one there.
+    """
+
+    def __init__(self, date, feed_id, stop_ids, children, pattern_stops,
+                 pattern_trips, departures, arrivals, boarding, alighting,
+                 transfers, change_seconds=None):
+        self.date = date
+        self.feed_id = feed_id
+        self.stop_ids = stop_ids
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+        self.children = children
+        self.pattern_stops = pattern_stops
+        self.pattern_trips = pattern_trips
+        self.departures = departures
+        self.arrivals = arrivals
+        self.boarding = boarding
+        self.alighting = alighting
+        self.transfers = transfers
+        self.change_seconds = change_seconds or [0] * len(stop_ids)
+        self.stop_patterns = [[] for _ in stop_ids]
+        for p, stops in enumerate(pattern_stops):
+            for i, s in enumerate(stops):
+                self.stop_patterns[s].append((p, i))
+
+    def __repr__(self):
+        return '<Timetable %s: %d stops, %d patterns, %d trips>' % (
+            self.date, len(self.stop_ids), len(self.pattern_stops),
+            sum(len(trips) for trips in self.pattern_trips))
+
+    def _stops(self, stop_id):
+        """ The indices of a stop, or of the stops of a station. """
+        if stop_id in self.children:
+            return [self.stop_index[child] for child in self.children[stop_id]]
+        try:
+            return [self.stop_index[stop_id]]
+        except KeyError:
+            raise KeyError('unknown stop %r' % stop_id)
+
+    def _raptor(self, origins, targets, departure, max_transfers):
+        """ Run the rounds of RAPTOR. Returns the arrival times and the
+        parents of the labels improved in every round. """
+        n = len(self.stop_ids)
+        target_set = set(targets)
+        best = [_INFINITY] * n
+        arrivals = [[_INFINITY] * n]
+        parents = [{}]
+        marked = set()
+        for s in origins:
+            arrivals[0][s] = best[s] = departure
+            parents[0][s] = None
+            marked.add(s)
+        self._relax_transfers(marked, arrivals[0], parents[0], best, target_set)
+        # the earliest boarding times, after the change time at the stops
+        # reached by a trip
+        ready_times = list(arrivals[0])
+
+        for _ in range(max_transfers + 1):
+            previous = arrivals[-1]
+            previous_ready = ready_times
+            current = list(previous)
+            ready_times = list(previous_ready)
+            current_parents = {}
+            best_target = min(best[s] for s in target_set)
+            queue = {}
+            for s in marked:
+                for p, i in self.stop_patterns[s]:
+                    if queue.get(p, i + 1) > i:
+                        queue[p] = i
+            marked = set()
+            for p, start in queue.items():
+                stops = self.pattern_stops[p]
+                departures = self.departures[p]
+                pattern_arrivals = self.arrivals[p]
+                boarding = self.boarding[p]
+                alighting = self.alighting[p]
+                trip = None
+                for i in range(start, len(stops)):
+                    s = stops[i]
+                    if trip is not None and alighting[i]:
+                        arrival = pattern_arrivals[i][trip]
+                        if arrival < best[s] and arrival < best_target:
+                            current[s] = best[s] = arrival
+                            ready_times[s] = arrival + self.change_seconds[s]
+                            current_parents[s] = (p, trip, board, i)
+                            marked.add(s)
+                            if s in target_set:
+                                best_target = arrival
+                    ready = previous_ready[s]
+                    if boarding[i] and ready < _INFINITY and (
+                            trip is None or ready <= departures[i][trip]):
+                        j = bisect.bisect_left(departures[i], ready)
+                        if j < len(departures[i]) and (trip is None or j < trip):
+                            trip = j
+                            board = i
+            self._relax_transfers(marked, current, current_parents, best,
+                                  target_set, ready_times)
+            arrivals.append(current)
+            parents.append(current_parents)
+            if not marked:
+                break
+        return arrivals, parents
+
+    def _relax_transfers(self, marked, current, parents, best, target_set,
+                         ready_times=None):
+        # from the stops marked by the trips of the round, not the transfers
+        best_target = min(best[s] for s in target_set)
+        for s in list(marked):
+            for to_stop, seconds in self.transfers[s]:
+                arrival = current[s] + seconds
+                if arrival < best[to_stop] and arrival < best_target:
+                    current[to_stop] = best[to_stop] = arrival
+                    if ready_times is not None:
+                        ready_times[to_stop] = arrival
+                    parents[to_stop] = ('transfer', s)
+                    marked.add(to_stop)
+
+    def _journey(self, arrivals, parents, k, target):
+        """ The legs of the label of `target` in round `k`. """
+        legs = []
+        s = target
+        while True:
+            while s not in parents[k]:
+                k -= 1
+            parent = parents[k][s]
+            if parent is None:
+                break
+            if parent[0] == 'transfer':
+                from_stop = parent[1]
+                legs.append(Leg(self.stop_ids[from_stop], self.stop_ids[s],
+                                datetime.timedelta(seconds=arrivals[k][from_stop]),
+                                datetime.timedelta(seconds=arrivals[k][s]),
+                                None, None))
+                s = from_stop
+                continue
+            p, trip, board, alight = parent
+            stops = self.pattern_stops[p]
+            trip_id, route_id = self.pattern_trips[p][trip]
+            legs.append(Leg(self.stop_ids[stops[board]], self.stop_ids[s],
+                            datetime.timedelta(seconds=self.departures[p][board][trip]),
+                            datetime.timedelta(seconds=self.arrivals[p][alight][trip]),
+                            trip_id, route_id))
+            s = stops[board]
+            k -= 1
+        legs.reverse()
+        return legs
+
+    def _journeys(self, origin, destination, departure, max_transfers):
+        origins = self._stops(origin)
+        targets = self._stops(destination)
+        departure = _seconds(departure)
+        arrivals, parents = self._raptor(origins, targets, departure,
+                                         max_transfers)
+        journeys = []
+        best = _INFINITY
+        for k in range(len(arrivals)):
+            arrival, target = min((arrivals[k][t], t) for t in targets)
+            if arrival < best:
+                best = arrival
+                legs = self._journey(arrivals, parents, k, target)
+                rides = sum(1 for leg in legs if leg.trip_id is not None)
+                journeys.append(Journey(
+                    legs[0].departure_time if legs else datetime.timedelta(
+                        seconds=departure),
+                    datetime.timedelta(seconds=arrival), max(0, rides - 1), legs))
+        return journeys
+
+    def earliest_arrival(self, origin, destination, departure, max_transfers=8):
+        """ The journey arriving first at `destination`, leaving `origin`
+        at `departure` or later, or None.
+
+        :param origin: A stop id, or the id of a station to leave from any
+            of its stops.
+        :param destination: Likewise.
+        :param departure: A :py:class:`datetime.timedelta` after midnight.
+        :param max_transfers: The maximum number of transfers.
+        :returns: A :py:data:`Journey`.
+        """
+        journeys = self._journeys(origin, destination, departure, max_transfers)
+        return journeys[-1] if journeys else None
+
+    def pareto(self, origin, destination, departure, max_transfers=8):
+        """ The journeys from `origin` to `destination` that no other journey
+        beats on both arrival time and number of transfers, fewest transfers
+        first. Takes the arguments of :py:meth:`earliest_arrival`.
+        """
+        return self._journeys(origin, destination, departure, max_transfers)
+
+
+def _patterns(trips):
+    """ Group trips into patterns without overtaking. `trips` maps
+    (stops, boarding, alighting) keys to lists of (trip, departures,
+    arrivals). Returns a list of (key, trips) sorted by departure. """
+    patterns = []
+    for key, key_trips in trips.items():
+        key_trips.sort(key=lambda trip: (trip[1][0], trip[2][-1]))
+        groups = []
+        for trip in key_trips:
+            for group in groups:
+                last = group[-1]
+                if all(d >= ld and a >= la for d, a, ld, la in zip(
+                        trip[1], trip[2], last[1], last[2])):
+                    group.append(trip)
+                    break
+            else:
+                groups.append([trip])
+        patterns.extend((key, group) for group in groups)
+    return patterns
+
+
+def compile_timetable(schedule, date, feed_id=None, walking_speed=1.3,
+                      min_transfer_seconds=0):
+    """ Compile the trips of a feed running on `date` into a
+    :py:class:`Timetable`.
+
+    :param feed_id: The feed, the latest one by default.
+    :param walking_speed: The speed in meters per second of the transfers
+        without a minimum transfer time.
+    :param min_transfer_seconds: The time it takes to change trips at a stop
+        without a transfer to itself in ``transfers.txt``.
+    """
+    session = schedule.session
+    if feed_id is None:
+        feed_id = session.execute(select(Feed.feed_id).order_by(
+            Feed.feed_id.desc())).scalar()
+        if feed_id is None:
+            raise PygtfsException('There are no feeds to route on')
+
+    stop_rows = session.execute(
+        select(Stop.stop_id, Stop.stop_lat, Stop.stop_lon, Stop.parent_station)
+        .where(Stop.feed_id == feed_id).order_by(Stop.stop_id)).all()
+    stop_ids = [row.stop_id for row in stop_rows]
+    stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+    children = collections.defaultdict(list)
+    for row in stop_rows:
+        if row.parent_station:
+            children[row.parent_station].append(row.stop_id)
+
+    # the trips of the day, and the ones of the day before past midnight
+    frequencies = collections.defaultdict(list)
+    for frequency in session.query(Frequency).filter(Frequency.feed_id == feed_id):
+        frequencies[frequency.trip_id].append(frequency)
+    trips = collections.defaultdict(list)
+    late = aliased(StopTime)
+    for service_date, offset in ((date, 0), (date - datetime.timedelta(days=1),
+                                             -86400)):
+        query = (select(StopTime.trip_id, StopTime.stop_id, StopTime.arrival_time,
+                        StopTime.departure_time, StopTime.pickup_type,
+                        StopTime.drop_off_type, Trip.route_id)
+                 .join(Trip, and_(Trip.feed_id == StopTime.feed_id,
+                                  Trip.trip_id == StopTime.trip_id))
+                 .join(ServiceDate, and_(ServiceDate.feed_id == Trip.feed_id,
+                                         ServiceDate.service_id == Trip.service_id,
+                                         ServiceDate.date == service_date))
+                 .where(StopTime.feed_id == feed_id)
+                 .order_by(StopTime.trip_id, StopTime.stop_sequence))
+        if offset:
+            # of the day before, only the trips that can run past midnight
+            query = query.where(or_(
+                StopTime.trip_id.in_(
+                    select(late.trip_id).where(late.feed_id == feed_id)
+                    .where(late.arrival_time >= datetime.timedelta(days=1))),
+                StopTime.trip_id.in_(list(frequencies))))
+        for trip_id, rows in itertools.groupby(session.execute(query),
+                                               key=lambda row: row[0]):
+            rows = list(rows)
+            arrivals = _interpolate([_seconds(
+                row.departure_time if row.arrival_time is None
+                else row.arrival_time) for row in rows])
+            departures = _interpolate([_seconds(
+                row.arrival_time if row.departure_time is None
+                else row.departure_time) for row in rows])
+            if arrivals is None:
+                continue
+            key = (tuple(stop_index[row.stop_id] for row in rows),
+                   tuple(row.pickup_type != 1 for row in rows),
+                   tuple(row.drop_off_type != 1 for row in rows))
+            route_id = rows[0].route_id
+            if trip_id in frequencies:
+                starts = sorted({t for f in frequencies[trip_id]
+                                 for t in start_times(f.start_time, f.end_time,
+                                                      f.headway_secs)})
+                shifts = [t - departures[0] for t in starts]
+            else:
+                shifts = [0]
+            for shift in shifts:
+                shift += offset
+                if arrivals[-1] + shift < 0:
+                    continue
+                trips[key].append(((trip_id, route_id),
+                                   [t + shift for t in departures],
+                                   [t + shift for t in arrivals]))
+
+    pattern_stops = []
+    pattern_trips = []
+    pattern_departures = []
+    pattern_arrivals = []
+    boarding = []
+    alighting = []
+    for (stops, board, alight), group in _patterns(trips):
+        pattern_stops.append(list(stops))
+        boarding.append(list(board))
+        alighting.append(list(alight))
+        pattern_trips.append([trip for trip, _, _ in group])
+        pattern_departures.append([list(column) for column in
+                                   zip(*(d for _, d, _ in group))])
+        pattern_arrivals.append([list(column) for column in
+                                 zip(*(a for _, _, a in group))])
+
+    coordinates = {row.stop_id: (row.stop_lat, row.stop_lon) for row in stop_rows}
+    transfers = [[] for _ in stop_ids]
+    change_seconds = [min_transfer_seconds] * len(stop_ids)
+    for from_stop_id, to_stop_id, transfer_type, min_transfer_time in session.execute(
+            select(Transfer.from_stop_id, Transfer.to_stop_id,
+                   Transfer.transfer_type, Transfer.min_transfer_time)
+            .where(Transfer.feed_id == feed_id)
+            .where(Transfer.from_route_id == '').where(Transfer.to_route_id == '')
+            .where(Transfer.from_trip_id == '').where(Transfer.to_trip_id == '')):
+        if transfer_type == 3:
+            continue
+        if from_stop_id == to_stop_id:
+            if min_transfer_time is not None:
+                change_seconds[stop_index[from_stop_id]] = int(min_transfer_time)
+            continue
+        if min_transfer_time is None:
+            (lat1, lon1), (lat2, lon2) = (coordinates[from_stop_id],
+                                          coordinates[to_stop_id])
+            if None in (lat1, lon1, lat2, lon2):
+                continue
+            min_transfer_time = int(distance(lat1, lon1, lat2, lon2) / walking_speed)
+        transfers[stop_index[from_stop_id]].append(
+            (stop_index[to_stop_id], min_transfer_time))
+
+    return Timetable(date, feed_id, stop_ids, dict(children), pattern_stops,
+                     pattern_trips, pattern_departures, pattern_arrivals,
+                     boarding, alighting, transfers, change_seconds)
@@ -1,7 +1,68 @@
+import collections
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+import urllib.parse
+import uuid
+
 import sqlalchemy
 import sqlalchemy.orm
+from sqlalchemy.orm import joinedload, selectinload
+
+from .gtfs_entities import (gtfs_all, Feed, Base, FeedVersion, FrequencyTrip,
+                            Route, Service, ServiceDate, ShapePoint, Stop,
+                            StopDeparture, StopTime, Trip)
+from . import cache, columnar, frequencies, loader, routing, spatial
+from .exceptions import PygtfsException
+
+# the backref attributes exist once the mappers are configured
+sqlalchemy.orm.configure_mappers()
+
+logger = logging.getLogger(__name__)
 
-from .gtfs_entities import gtfs_all, Feed, Base
+# Named eager loading profiles, see :py:meth:`Schedule.loading`. A profile
+# maps entities to the loader options applied to every query for them, so
+# that walking the relationships they cover issues a constant number of
+# queries. Collections are loaded with ``selectinload``, many-to-one
+# relationships with ``joinedload``. More profiles can be added here.
+loading_profiles = {
+    # routes, trips, their stop times and stops, services and frequencies
+    'timetable': {
+        Route: (selectinload(Route.trips).selectinload(Trip.stop_times)
+                .joinedload(StopTime.stop),
+                selectinload(Route.trips).joinedload(Trip.service),
+                selectinload(Route.trips).selectinload(Trip.frequencies)),
+        Trip: (selectinload(Trip.stop_times).joinedload(StopTime.stop),
+               joinedload(Trip.route),
+               joinedload(Trip.service),
+               selectinload(Trip.frequencies)),
+        Stop: (selectinload(Stop.stop_times).joinedload(StopTime.trip)
+               .joinedload(Trip.route),),
+        StopTime: (joinedload(StopTime.stop),
+                   joinedload(StopTime.trip).joinedload(Trip.route)),
+        Service: (selectinload(Service.trips),),
+    },
+    # trips with their shape geometry and points, and the stops they serve
+    'geometry': {
+        Route: (selectinload(Route.trips).joinedload(Trip.geometry),
+                selectinload(Route.trips).selectinload(Trip.shape_points),
+                selectinload(Route.trips).selectinload(Trip.stop_times)
+                .joinedload(StopTime.stop)),
+        Trip: (joinedload(Trip.geometry),
+               selectinload(Trip.shape_points),
+               selectinload(Trip.stop_times).joinedload(StopTime.stop)),
+        ShapePoint: (selectinload(ShapePoint.trips),),
+    },
+}
+
+
+# A row of :py:meth:`Schedule.departures`. The departure time is relative to
+# midnight of the requested date, the service date may be the day before.
+Departure = collections.namedtuple(
+    'Departure', ['departure_time', 'trip_id', 'route_id', 'headsign',
+                  'stop_sequence', 'service_date', 'feed_id'])
 
 
 class Schedule:
@@ -19,34 +80,418 @@ class Schedule:
     by attribute.
 
     :param db_conection: Either a sqlalchemy database url or a filename to be used with sqlite.
+    :param thread_safe: Share the schedule between threads: `session` is then a
+        ``scoped_session``, giving every thread its own session, and the
+        current :py:attr:`loading_profile` is set per thread. Call
+        :py:meth:`remove_session` when a thread or a request is done with it.
+    :param pool_size: The number of connections kept open by the pool.
+    :param max_overflow: The number of connections opened beyond `pool_size`
+        when they are all in use.
+    :param read_only: Open the database read only: sqlite files are opened
+        with ``mode=ro``, PostgreSQL transactions are read only, and the
+        tables are not created. Otherwise, opening a database whose feeds were
+        loaded by an older version of pygtfs builds their derived tables,
+        like the shape geometries, once.
+    :param cache_size: Keep the results of up to `cache_size` calls of the
+        entity lists, the ``<entities>_by_id`` functions,
+        :py:meth:`services_on`, :py:meth:`trips_on` and :py:meth:`departures`,
+        see :py:mod:`pygtfs.cache`. The counters are in :py:attr:`cache`.
+        The results are dropped when the session's transaction ends or an
+        instance is detached from it. Not available for thread safe
+        schedules.
+    :param cache_ttl: The number of seconds results are cached, unlimited by
+        default.
 
     """
 
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, thread_safe=False, pool_size=None,
+                 max_overflow=None, read_only=False, cache_size=0,
+                 cache_ttl=None):
         self.db_connection = db_connection
         self.db_filename = None
         if '://' not in db_connection:
             self.db_connection = 'sqlite:///%s' % self.db_connection
         if self.db_connection.startswith('sqlite'):
             self.db_filename = self.db_connection
-        self.engine = sqlalchemy.create_engine(self.db_connection)
+        self.thread_safe = thread_safe
+        if cache_size and thread_safe:
+            # the cached entities belong to the session of one thread
+            raise ValueError('the result cache is not available for thread '
+                             'safe schedules')
+        self.cache = cache.ResultCache(cache_size, cache_ttl) if cache_size else None
+        self.read_only = read_only
+        self.engine = sqlalchemy.create_engine(
+            self.db_connection,
+            **_engine_options(self.db_connection, thread_safe, pool_size,
+                              max_overflow, read_only))
         Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
-        self.session = Session()
-        Base.metadata.create_all(self.engine)
+        if thread_safe:
+            self.session = sqlalchemy.orm.scoped_session(Session)
+        else:
+            self.session = Session()
+        if self.cache is not None:
+            # commit and rollback expire the cached instances, close and
+            # expunge detach them
+            sqlalchemy.event.listen(self.session, 'after_transaction_end',
+                                    self._transaction_ended)
+            sqlalchemy.event.listen(self.session, 'persistent_to_detached',
+                                    lambda session, instance: self.cache.invalidate())
+        self._local = threading.local()
+        if not read_only:
+            Base.metadata.create_all(self.engine)
+            # the feeds loaded by an older version lack the derived tables
+            loader._build_missing_derived(self)
+            self._missing_derived = set()
+        else:
+            self._missing_derived = loader._missing_derived(self)
+            if self._missing_derived:
+                logger.warning('Feeds %s were loaded by an older version of '
+                               'pygtfs; open the database once without '
+                               'read_only to build their derived tables',
+                               sorted({f for _, f in self._missing_derived}))
+        self._spatial_index = None
+        self._spatial_index_lock = threading.Lock()
+        self.loading_profile = None
+
+    @property
+    def loading_profile(self):
+        """ The name of the eager loading profile applied to queries, see
+        :py:meth:`loading`. """
+        return getattr(self._local, 'loading_profile', None)
+
+    @loading_profile.setter
+    def loading_profile(self, profile):
+        self._local.loading_profile = profile
+
+    def remove_session(self):
+        """ Close the session of the current thread, e.g. at the end of a
+        request. A new one is opened on the next query. Only for thread safe
+        schedules. """
+        if not self.thread_safe:
+            raise ValueError('remove_session requires Schedule(thread_safe=True)')
+        self.session.remove()
+
+    def query(self, entity):
+        """ A query for `entity`, with the options of the current
+        :py:attr:`loading_profile`. All the entity accessors use it. """
+        query = self.session.query(entity)
+        if self.loading_profile is not None:
+            query = query.options(*loading_profiles[self.loading_profile].get(entity, ()))
+        return query
+
+    @contextlib.contextmanager
+    def loading(self, profile):
+        """ Load relationships with the named profile of
+        :py:data:`loading_profiles` within a ``with`` block. """
+        if profile is not None and profile not in loading_profiles:
+            raise ValueError('unknown loading profile %r, expected one of %s'
+                             % (profile, ', '.join(loading_profiles)))
+        previous = self.loading_profile
+        self.loading_profile = profile
+        try:
+            yield self
+        finally:
+            self.loading_profile = previous
+
+    @contextlib.contextmanager
+    def count_queries(self):
+        """ Count the statements sent to the database within a ``with``
+        block. Yields a counter, with the number in its `count`. """
+        counter = _QueryCounter()
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', counter)
+        try:
+            yield counter
+        finally:
+            sqlalchemy.event.remove(self.engine, 'before_cursor_execute', counter)
+
+    def _cached(self, key, feed_id, compute):
+        """ The result of `compute()`, from the result cache if it is on.
+        `key` identifies the call, `feed_id` the feed it is restricted to. """
+        if self.cache is None:
+            return compute()
+        result = self.cache.get(key + (feed_id, self.loading_profile), compute,
+                                feed_id)
+        # callers may change the lists they get
+        return list(result)
+
+    def _transaction_ended(self, session, transaction):
+        if transaction.parent is None:
+            self.cache.invalidate()
+
+    def _feeds_changed(self, feed_id):
+        """ Update the indexes derived from a feed after it was loaded,
+        changed or dropped, before committing. """
+        session = self.session() if self.thread_safe else self.session
+        version = uuid.uuid4().hex
+        table = FeedVersion.__table__
+        replaced = session.execute(table.update().where(
+            table.c.feed_id == feed_id).values(version=version)).rowcount
+        if not replaced:
+            # nothing to insert once the feed is dropped
+            session.execute(table.insert().from_select(
+                ['feed_id', 'version'],
+                sqlalchemy.select(Feed.feed_id, sqlalchemy.literal(version))
+                .where(Feed.feed_id == feed_id)))
+        if self.cache is not None:
+            self.cache.invalidate(feed_id)
+        if self._spatial_index is not None or spatial.has_stored_index(self):
+            self._stop_index.refresh(feed_id)
+        directory = columnar.cache_directory(self, feed_id)
+        if directory is not None:
+            # once committed, so that no other process rebuilds the cache
+            # from the data before the change
+            sqlalchemy.event.listen(
+                session, 'after_commit',
+                lambda session: columnar.invalidate(directory), once=True)
+
+    def columnar(self, feed_id, cache=True):
+        """ The main tables of a feed as NumPy structured arrays, see
+        :py:mod:`pygtfs.columnar`. Requires numpy.
+
+        :param cache: For sqlite databases in a file, keep the arrays in
+            memory-mapped files next to the database, read on later calls
+            until the feed changes.
+        """
+        return columnar.columnar(self, feed_id, cache)
 
     def drop_feed(self, feed_id):
-        """ Delete a feed from a database by feed id"""
-        # the following does not cascade unfortunatly.
-        # self.session.query(Feed).filter(Feed.feed_id == feed_id).delete()
-        feed = self.session.query(Feed).get(feed_id)
-        self.session.delete(feed)
+        """ Delete a feed from a database by feed id
+
+        Issues one ``DELETE`` per table, dependent tables first, instead of
+        loading the rows of the feed into the session.
+        """
+        loader._delete_legacy_rows(self, feed_id)
+        for table in reversed(Base.metadata.sorted_tables):
+            feed_columns = [c for c in table.columns
+                            if c.name == 'feed_id' or c.name.endswith('_feed_id')]
+            if feed_columns:
+                self.session.execute(table.delete().where(
+                    sqlalchemy.or_(*(c == feed_id for c in feed_columns))))
+        self._feeds_changed(feed_id)
+        self.session.commit()
+
+    def _require_derived(self, derived, feed_id):
+        """ Raise if a read only schedule lacks the `derived` rows of feeds
+        loaded by an older version, instead of returning no results. """
+        feed_ids = sorted(f for d, f in self._missing_derived
+                          if d is derived and feed_id in (None, f))
+        if feed_ids:
+            raise PygtfsException(
+                'Feeds %s have no %s, they were loaded by an older version of '
+                'pygtfs: open the database once without read_only to build it'
+                % (feed_ids, derived.__tablename__))
+
+    def services_on(self, date, feed_id=None):
+        """ A list of the services running on `date`, taking the service
+        exceptions into account """
+        self._require_derived(ServiceDate, feed_id)
+        query = (self.session.query(Service)
+                 .join(ServiceDate, sqlalchemy.and_(
+                     ServiceDate.feed_id == Service.feed_id,
+                     ServiceDate.service_id == Service.service_id))
+                 .filter(ServiceDate.date == date))
+        if feed_id is not None:
+            query = query.filter(ServiceDate.feed_id == feed_id)
+        return self._cached(('services_on', date), feed_id, query.all)
+
+    def trips_on(self, date, feed_id=None):
+        """ A list of the trips running on `date` """
+        self._require_derived(ServiceDate, feed_id)
+        query = (self.session.query(Trip)
+                 .join(ServiceDate, sqlalchemy.and_(
+                     ServiceDate.feed_id == Trip.feed_id,
+                     ServiceDate.service_id == Trip.service_id))
+                 .filter(ServiceDate.date == date))
+        if feed_id is not None:
+            query = query.filter(ServiceDate.feed_id == feed_id)
+        return self._cached(('trips_on', date), feed_id, query.all)
+
+    def frequency_trips(self, start=None, end=None, trip_id=None, feed_id=None):
+        """ Generate the trips run by the frequency based trips, see
+        :py:mod:`pygtfs.frequencies`.
+
+        :param start: The earliest start time, as a
+            :py:class:`datetime.timedelta` after midnight.
+        :param end: The latest start time.
+        :param trip_id: Only expand the trip with this id.
+        :returns: An iterator of :py:data:`pygtfs.frequencies.ExpandedTrip`,
+            with their stop times, built one at a time.
+        """
+        return frequencies.expand(self, start, end, trip_id, feed_id)
+
+    def expand_frequencies(self, feed_id):
+        """ Store the trips run by the frequency based trips of a feed, so
+        that :py:meth:`departures` lists them. The loader keeps them up to
+        date on updates. Returns the number of trips. """
+        count = frequencies.materialize(self, feed_id)
+        self._feeds_changed(feed_id)
         self.session.commit()
+        return count
+
+    def timetable(self, date, feed_id=None, min_transfer_seconds=0):
+        """ The :py:class:`pygtfs.routing.Timetable` of the trips running on
+        `date`, to plan journeys on. See :py:mod:`pygtfs.routing`.
+
+        :param feed_id: The feed, by default the last one loaded.
+        :param min_transfer_seconds: The time it takes to change trips at a
+            stop, unless ``transfers.txt`` gives it.
+        """
+        self._require_derived(ServiceDate, feed_id)
+        return routing.compile_timetable(
+            self, date, feed_id, min_transfer_seconds=min_transfer_seconds)
+
+    @property
+    def _stop_index(self):
+        """ The spatial index of the stops, created on first use so that
+        opening a database does not write to it. """
+        with self._spatial_index_lock:
+            if self._spatial_index is None:
+                self._spatial_index = spatial.stop_index(self)
+        return self._spatial_index
+
+    def stops_near(self, lat, lon, radius, limit=None, feed_id=None):
+        """ A list of the stops within `radius` meters of a point, nearest
+        first, see :py:mod:`pygtfs.spatial`. """
+        found = self._stop_index.near(lat, lon, radius, feed_id)
+        if limit is not None:
+            found = found[:limit]
+        return self._stops_by_key([(stop_feed_id, stop_id)
+                                   for _, stop_feed_id, stop_id in found])
+
+    def stops_in_bbox(self, min_lat, min_lon, max_lat, max_lon, feed_id=None):
+        """ A list of the stops in a bounding box, see :py:mod:`pygtfs.spatial`. """
+        return self._stops_by_key([
+            (stop_feed_id, stop_id) for stop_feed_id, stop_id, _, _
+            in self._stop_index.in_bbox(min_lat, min_lon, max_lat, max_lon,
+                                        feed_id)])
+
+    def _stops_by_key(self, keys):
+        """ The stops with the (feed_id, stop_id) `keys`, in the same order. """
+        if not keys:
+            return []
+        stop_ids = collections.defaultdict(list)
+        for stop_feed_id, stop_id in keys:
+            stop_ids[stop_feed_id].append(stop_id)
+        stops = {}
+        for stop_feed_id, ids in stop_ids.items():
+            for start in range(0, len(ids), 500):
+                for stop in self.session.query(Stop).filter(
+                        Stop.feed_id == stop_feed_id,
+                        Stop.stop_id.in_(ids[start:start + 500])):
+                    stops[stop.feed_id, stop.stop_id] = stop
+        return [stops[key] for key in keys]
+
+    def departures(self, stop_id, date, start=None, end=None, limit=None,
+                   feed_id=None):
+        """ The departures from a stop on `date`, ordered by time.
+
+        :param start: The earliest departure time, as a
+            :py:class:`datetime.timedelta` after midnight. Defaults to
+            midnight.
+        :param end: The latest departure time, unlimited by default.
+        :param limit: The maximum number of departures to return.
+        :returns: A list of :py:class:`Departure` rows, including the trips
+            of the previous service day that depart after midnight. The
+            frequency based trips of feeds expanded with
+            :py:meth:`expand_frequencies` depart once per trip they run.
+        """
+        self._require_derived(ServiceDate, feed_id)
+        self._require_derived(StopDeparture, feed_id)
+        start = int(start.total_seconds()) if start is not None else 0
+        end = int(end.total_seconds()) if end is not None else None
+        day = datetime.timedelta(days=1)
+        selects = []
+        for service_date, offset in ((date, 0), (date - day, 86400)):
+            # trips expanded by expand_frequencies replace their template
+            expanded = sqlalchemy.exists().where(
+                FrequencyTrip.feed_id == StopDeparture.feed_id,
+                FrequencyTrip.trip_id == StopDeparture.trip_id)
+            for departure_seconds, condition in (
+                    (StopDeparture.departure_seconds, ~expanded),
+                    (StopDeparture.departure_seconds + FrequencyTrip.offset_seconds,
+                     None)):
+                query = (sqlalchemy.select(
+                            (departure_seconds - offset).label('seconds'),
+                            StopDeparture.trip_id, StopDeparture.route_id,
+                            StopDeparture.headsign, StopDeparture.stop_sequence,
+                            ServiceDate.date, StopDeparture.feed_id)
+                         .join(ServiceDate, sqlalchemy.and_(
+                             ServiceDate.feed_id == StopDeparture.feed_id,
+                             ServiceDate.service_id == StopDeparture.service_id,
+                             ServiceDate.date == service_date))
+                         .where(StopDeparture.stop_id == stop_id)
+                         .where(departure_seconds >= start + offset))
+                if condition is not None:
+                    query = query.where(condition)
+                else:
+                    query = query.join(FrequencyTrip, sqlalchemy.and_(
+                        FrequencyTrip.feed_id == StopDeparture.feed_id,
+                        FrequencyTrip.trip_id == StopDeparture.trip_id))
+                if end is not None:
+                    query = query.where(departure_seconds <= end + offset)
+                if feed_id is not None:
+                    query = query.where(StopDeparture.feed_id == feed_id)
+                else:
+                    # lets the database use the (feed_id, stop_id, time) index
+                    query = query.where(StopDeparture.feed_id.in_(
+                        sqlalchemy.select(Feed.feed_id).scalar_subquery()))
+                selects.append(query)
+        query = sqlalchemy.union_all(*selects).order_by('seconds', 'trip_id')
+        if limit is not None:
+            query = query.limit(limit)
+        return self._cached(
+            ('departures', stop_id, date, start, end, limit), feed_id,
+            lambda: [Departure(datetime.timedelta(seconds=seconds), *rest)
+                     for seconds, *rest in self.session.execute(query)])
+
+
+def _engine_options(db_connection, thread_safe, pool_size, max_overflow,
+                    read_only):
+    """ The keyword arguments of ``create_engine`` for the options of a
+    :py:class:`Schedule`. """
+    url = sqlalchemy.engine.make_url(db_connection)
+    options = {}
+    if pool_size is not None:
+        options['pool_size'] = pool_size
+    if max_overflow is not None:
+        options['max_overflow'] = max_overflow
+    if url.get_backend_name() == 'sqlite':
+        memory = url.database in (None, '', ':memory:')
+        if thread_safe:
+            # connections move between threads with the pool
+            options['connect_args'] = {'check_same_thread': False}
+            if memory:
+                # all the threads must see the same database
+                options['poolclass'] = sqlalchemy.pool.StaticPool
+        if read_only:
+            if memory:
+                raise ValueError('an in memory sqlite database cannot be read only')
+            check_same_thread = not thread_safe
+            options['creator'] = lambda: sqlite3.connect(
+                'file:%s?mode=ro' % urllib.parse.quote(url.database), uri=True,
+                check_same_thread=check_same_thread)
+    elif read_only:
+        if url.get_backend_name() != 'postgresql':
+            raise ValueError('read only schedules require sqlite or postgresql')
+        options['execution_options'] = {'postgresql_readonly': True}
+    return options
+
+
+class _QueryCounter(object):
+    """ A ``before_cursor_execute`` listener counting statements. """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
 
 
 def _meta_query_all(entity, docstring=None):
     def _query_all(instance_self):
         """ A list generated on access """
-        return instance_self.session.query(entity).all()
+        return instance_self._cached((entity._plural_name_,), None,
+                                     lambda: instance_self.query(entity).all())
 
     if docstring is not None:
         _query_all.__doc__ = docstring
@@ -56,7 +501,9 @@ def _meta_query_all(entity, docstring=None):
 def _meta_query_by_id(entity, docstring=None):
     def _query_by_id(self, id):
         """ A function that returns a list of entries with matching ids """
-        return self.session.query(entity).filter(entity.id == id).all()
+        return self._cached(
+            (entity._plural_name_ + '_by_id', id), None,
+            lambda: self.query(entity).filter(entity.id == id).all())
     if docstring is not None:
         _query_by_id.__doc__ = docstring
     return _query_by_id
@@ -68,13 +515,46 @@ def _meta_query_raw(entity, docstring=None):
             A raw sqlalchemy query object that the user can then manipulate
             manually
         """
-        return instance_self.session.query(entity)
+        return instance_self.query(entity)
 
     if docstring is not None:
         _query_raw.__doc__ = docstring
     return property(_query_raw)
 
 
+def _meta_query_iter(entity, docstring=None):
+    primary_key = sqlalchemy.inspect(entity).primary_key
+
+    def _query_iter(self, feed_id=None, batch_size=1000):
+        """
+            An iterator over the entries, optionally of one feed only.
+
+            Reads `batch_size` entries at a time, paginating on the primary
+            key, so that whole tables can be scanned in constant memory.
+        """
+        mapper = sqlalchemy.inspect(entity)
+        query = self.query(entity).order_by(*primary_key)
+        if feed_id is not None:
+            query = query.filter(entity.feed_id == feed_id)
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.filter(sqlalchemy.tuple_(*primary_key) >
+                                   sqlalchemy.tuple_(*last))
+            batch = page.limit(batch_size).all()
+            if not batch:
+                return
+            last = mapper.primary_key_from_instance(batch[-1])
+            yield from batch
+            if len(batch) < batch_size:
+                return
+
+    if docstring is not None:
+        _query_iter.__doc__ = docstring
+    return _query_iter
+
+
 for entity in (gtfs_all + [Feed]):
     entity_doc = "A list of :py:class:`pygtfs.gtfs_entities.{0}` objects".format(entity.__name__)
     entity_raw_doc = ("A :py:class:`sqlalchemy.orm.Query` object to fetch "
@@ -82,8 +562,13 @@ for entity in (gtfs_all + [Feed]):
                       .format(entity.__name__))
     entity_by_id_doc = "A list of :py:class:`pygtfs.gtfs_entities.{0}` objects with matching id".format(entity.__name__)
     setattr(Schedule, entity._plural_name_, _meta_query_all(entity, entity_doc))
+    entity_iter_doc = ("An iterator over :py:class:`pygtfs.gtfs_entities.{0}` objects, "
+                       "optionally of one feed, read in batches"
+                       .format(entity.__name__))
     setattr(Schedule, entity._plural_name_ + "_query",
             _meta_query_raw(entity, entity_raw_doc))
+    setattr(Schedule, entity._plural_name_ + "_iter",
+            _meta_query_iter(entity, entity_iter_doc))
     if hasattr(entity, 'id'):
         setattr(Schedule, entity._plural_name_ + "_by_id", _meta_query_by_id(entity, entity_by_id_doc))
 
@@ -0,0 +1,208 @@
+""" Spatial indexes over the stops of a schedule.
+
+On sqlite databases built with the R*Tree module, the stops are indexed in
+an ``_stop_rtree`` virtual table, created on the first spatial query and
+kept up to date by the loader. Elsewhere, a grid of the stops is built in
+memory on first use, and rebuilt after a feed changes. Both return the same
+results, see :py:func:`stop_index`.
+"""
+
+import abc
+import math
+
+from sqlalchemy import inspect as sqlalchemy_inspect, select, text
+
+from .gtfs_entities import Stop
+
+# The mean earth radius in meters.
+EARTH_RADIUS = 6371008.8
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ The great circle distance in meters between two points. """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) *
+         math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius):
+    """ A (min_lat, min_lon, max_lat, max_lon) box containing the circle of
+    `radius` meters around a point. """
+    angle = radius / EARTH_RADIUS
+    dlat = math.degrees(angle)
+    if lat + dlat >= 90 or lat - dlat <= -90:
+        # the circle contains a pole
+        return max(-90, lat - dlat), -180, min(90, lat + dlat), 180
+    # the meridians tangent to the circle, which are further apart than
+    # dlat / cos(lat) at high latitudes and for large radii
+    dlon = math.degrees(math.asin(min(1.0, math.sin(angle) /
+                                      math.cos(math.radians(lat)))))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+class _StopIndex(abc.ABC):
+    """ The interface of the stop indexes. """
+
+    @abc.abstractmethod
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon, feed_id=None):
+        """ A list of (feed_id, stop_id, lat, lon) of the stops in a box. """
+
+    def near(self, lat, lon, radius, feed_id=None):
+        """ A list of (distance, feed_id, stop_id) of the stops within
+        `radius` meters, nearest first. """
+        min_lat, min_lon, max_lat, max_lon = radius_bbox(lat, lon, radius)
+        candidates = []
+        # a box crossing the antimeridian is queried in two parts
+        for west, east in _split_lon(min_lon, max_lon):
+            candidates.extend(self.in_bbox(min_lat, west, max_lat, east, feed_id))
+        found = []
+        for stop_feed_id, stop_id, stop_lat, stop_lon in candidates:
+            d = distance(lat, lon, stop_lat, stop_lon)
+            if d <= radius:
+                found.append((d, stop_feed_id, stop_id))
+        found.sort()
+        return found
+
+    @abc.abstractmethod
+    def refresh(self, feed_id):
+        """ Reindex the stops of a feed after it was loaded, changed or
+        dropped, within the same transaction. """
+
+
+def _split_lon(min_lon, max_lon):
+    if min_lon < -180:
+        return [(min_lon + 360, 180), (-180, max_lon)]
+    if max_lon > 180:
+        return [(min_lon, 180), (-180, max_lon - 360)]
+    return [(min_lon, max_lon)]
+
+
+class _RTreeIndex(_StopIndex):
+    """ A stop index in a sqlite R*Tree virtual table.
+
+    The boxes of the R*Tree are stored as 32 bit floats, rounded outwards,
+    so the exact coordinates are kept as auxiliary columns to filter the
+    candidates.
+    """
+
+    table = '_stop_rtree'
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        session = schedule.session
+        exists = sqlalchemy_inspect(session.connection()).has_table(self.table)
+        if not exists:
+            session.execute(text(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING rtree('
+                'id, min_lat, max_lat, min_lon, max_lon, '
+                '+feed_id INTEGER, +stop_id TEXT, +lat REAL, +lon REAL)'
+                % self.table))
+            # index the feeds loaded before the index existed
+            for feed_id in session.execute(text('SELECT feed_id FROM _feed')).scalars():
+                self.refresh(feed_id)
+            session.commit()
+
+    @staticmethod
+    def supported(schedule):
+        """ Whether the database has the R*Tree module with auxiliary
+        columns (sqlite 3.24). """
+        if schedule.engine.dialect.name != 'sqlite':
+            return False
+        session = schedule.session
+        version = session.execute(text('SELECT sqlite_version()')).scalar()
+        if tuple(map(int, version.split('.')[:2])) < (3, 24):
+            return False
+        options = session.execute(text('PRAGMA compile_options')).scalars()
+        return 'ENABLE_RTREE' in set(options)
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon, feed_id=None):
+        query = ('SELECT feed_id, stop_id, lat, lon FROM %s '
+                 'WHERE max_lat >= :min_lat AND min_lat <= :max_lat '
+                 'AND max_lon >= :min_lon AND min_lon <= :max_lon' % self.table)
+        params = dict(min_lat=min_lat, min_lon=min_lon, max_lat=max_lat,
+                      max_lon=max_lon)
+        if feed_id is not None:
+            query += ' AND feed_id = :feed_id'
+            params['feed_id'] = feed_id
+        return [(stop_feed_id, stop_id, lat, lon) for stop_feed_id, stop_id, lat, lon
+                in self.schedule.session.execute(text(query), params)
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon]
+
+    def refresh(self, feed_id):
+        session = self.schedule.session
+        session.execute(text('DELETE FROM %s WHERE feed_id = :feed_id' % self.table),
+                        dict(feed_id=feed_id))
+        session.execute(text(
+            'INSERT INTO %s (min_lat, max_lat, min_lon, max_lon, feed_id, '
+            'stop_id, lat, lon) '
+            'SELECT stop_lat, stop_lat, stop_lon, stop_lon, feed_id, stop_id, '
+            'stop_lat, stop_lon FROM stops WHERE feed_id = :feed_id '
+            'AND stop_lat IS NOT NULL AND stop_lon IS NOT NULL' % self.table),
+            dict(feed_id=feed_id))
+
+
+class _GridIndex(_StopIndex):
+    """ A stop index in a grid of `cell_size` degrees, held in memory.
+
+    Built from the stops table on first use, and dropped when a feed changes.
+    """
+
+    def __init__(self, schedule, cell_size=0.01):
+        self.schedule = schedule
+        self.cell_size = cell_size
+        self._cells = None
+
+    def _build(self):
+        cells = {}
+        for feed_id, stop_id, lat, lon in self.schedule.session.execute(
+                select(Stop.feed_id, Stop.stop_id, Stop.stop_lat, Stop.stop_lon)):
+            if lat is None or lon is None:
+                continue
+            cells.setdefault(self._cell(lat, lon), []).append(
+                (feed_id, stop_id, lat, lon))
+        return cells
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon, feed_id=None):
+        if self._cells is None:
+            self._cells = self._build()
+        (min_i, min_j), (max_i, max_j) = (self._cell(min_lat, min_lon),
+                                          self._cell(max_lat, max_lon))
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self._cells):
+            keys = [key for key in self._cells
+                    if min_i <= key[0] <= max_i and min_j <= key[1] <= max_j]
+        else:
+            keys = [(i, j) for i in range(min_i, max_i + 1)
+                    for j in range(min_j, max_j + 1)]
+        found = []
+        for key in keys:
+            for stop in self._cells.get(key, ()):
+                if ((feed_id is None or stop[0] == feed_id) and
+                        min_lat <= stop[2] <= max_lat and
+                        min_lon <= stop[3] <= max_lon):
+                    found.append(stop)
+        return found
+
+    def refresh(self, feed_id):
+        self._cells = None
+
+
+def stop_index(schedule):
+    """ Create the stop index of `schedule`: an R*Tree if the database
+    supports it, a grid in memory otherwise. Creating the R*Tree commits the
+    session; read only schedules use it only if it was already created. """
+    if _RTreeIndex.supported(schedule):
+        if not schedule.read_only or has_stored_index(schedule):
+            return _RTreeIndex(schedule)
+    return _GridIndex(schedule)
+
+
+def has_stored_index(schedule):
+    """ Whether the database holds a stop index, which has to be kept up to
+    date even if `schedule` did not use it yet. """
+    return (schedule.engine.dialect.name == 'sqlite' and sqlalchemy_inspect(
+        schedule.session.connection()).has_table(_RTreeIndex.table))
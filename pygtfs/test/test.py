@@ -1,12 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import datetime
+import math
 import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
-from pygtfs import overwrite_feed
+from pygtfs import (append_feed, cache, columnar, compiled, compiler, feed,
+                    linear, loader, overwrite_feed, postgres, routing,
+                    spatial, update_feed)
 from pygtfs import Schedule
+from pygtfs.gtfs_entities import (Base, convert_columns, gtfs_all, LoadProgress,
+                                  FrequencyTrip, HopGeometry, Service,
+                                  ServiceDate, ShapeGeometry, StopDeparture,
+                                  StopDistance, StopTime, Transfer, Trip)
 
+from pygtfs.exceptions import PygtfsException
+from sqlalchemy import exc, func, select, text
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import aiosqlite
+    import greenlet
+    from pygtfs.async_schedule import AsyncSchedule
+except ImportError:
+    aiosqlite = greenlet = AsyncSchedule = None
 from sqlalchemy.orm import Query
 
 
@@ -116,6 +143,1530 @@ class TestSchedule(unittest.TestCase):
         self.assertEqual(isinstance(self.schedule.agencies_query, Query),
                          True)
 
+    def test_services_on(self):
+        def service_ids(day):
+            return sorted(s.service_id for s in self.schedule.services_on(day))
+        self.assertEqual(service_ids(datetime.date(2007, 6, 2)), ['FULLW', 'WE'])
+        self.assertEqual(service_ids(datetime.date(2007, 6, 5)), ['FULLW'])
+        # removed by a service exception
+        self.assertEqual(service_ids(datetime.date(2007, 6, 4)), [])
+        self.assertEqual(service_ids(datetime.date(2011, 1, 1)), [])
+
+    def test_trips_on(self):
+        trips = self.schedule.trips_on(datetime.date(2007, 6, 2))
+        self.assertEqual(len(trips), 11)
+        trips = self.schedule.trips_on(datetime.date(2007, 6, 5))
+        self.assertEqual(len(trips), 7)
+        self.assertTrue(all(t.service_id == 'FULLW' for t in trips))
+        feed_id = self.schedule.feeds[0].feed_id
+        self.assertEqual(self.schedule.trips_on(datetime.date(2007, 6, 5),
+                                                feed_id=feed_id + 1), [])
+
+    def test_departures(self):
+        departures = self.schedule.departures('STAGECOACH',
+                                              datetime.date(2007, 6, 5))
+        self.assertEqual([(d.trip_id, d.departure_time) for d in departures],
+                         [('CITY1', datetime.timedelta(hours=6)),
+                          ('STBA', datetime.timedelta(hours=6)),
+                          ('CITY2', datetime.timedelta(hours=6, minutes=58))])
+        self.assertEqual(departures[1].route_id, 'STBA')
+        self.assertEqual(departures[1].headsign, 'Shuttle')
+        departures = self.schedule.departures(
+            'BEATTY_AIRPORT', datetime.date(2007, 6, 2),
+            start=datetime.timedelta(hours=8, minutes=1),
+            end=datetime.timedelta(hours=15), limit=2)
+        self.assertEqual([d.trip_id for d in departures], ['AAMV2', 'AB2'])
+        # no FULLW service on that day
+        departures = self.schedule.departures('STAGECOACH',
+                                              datetime.date(2007, 6, 4))
+        self.assertEqual(departures, [])
+
+    def test_frequency_trips(self):
+        trips = list(self.schedule.frequency_trips(trip_id='STBA'))
+        self.assertEqual(len(trips), 32)
+        self.assertEqual(trips[-1].start_time, datetime.timedelta(hours=21, minutes=30))
+        trips = list(self.schedule.frequency_trips(
+            start=datetime.timedelta(hours=7), end=datetime.timedelta(hours=8),
+            trip_id='STBA'))
+        self.assertEqual([t.start_time.seconds // 60 for t in trips], [420, 450, 480])
+        self.assertEqual([(st.stop_id, st.departure_time.seconds // 60)
+                          for st in trips[1].stop_times],
+                         [('STAGECOACH', 450), ('BEATTY_AIRPORT', 470)])
+        # CITY2 starts at its first stop, at 6:30 in the template
+        trip = next(self.schedule.frequency_trips(trip_id='CITY2'))
+        self.assertEqual(trip.start_time, datetime.timedelta(hours=6))
+        self.assertEqual(trip.stop_times[0].arrival_time,
+                         datetime.timedelta(hours=5, minutes=58))
+        self.assertEqual(len(list(self.schedule.frequency_trips(trip_id='CITY1'))), 52)
+
+    def test_expand_frequencies(self):
+        date = datetime.date(2007, 6, 5)
+        start = datetime.timedelta(hours=6)
+        end = datetime.timedelta(hours=9)
+        self.assertEqual(self.schedule.expand_frequencies(
+            self.schedule.feeds[0].feed_id), 136)
+        expected = sorted(
+            (st.departure_time, trip.trip_id)
+            for trip in self.schedule.frequency_trips()
+            for st in trip.stop_times
+            if st.stop_id == 'STAGECOACH' and start <= st.departure_time <= end)
+        departures = self.schedule.departures('STAGECOACH', date, start, end)
+        self.assertEqual([(d.departure_time, d.trip_id) for d in departures],
+                         expected)
+        self.assertEqual(len(departures), 26)
+
+    def test_iter_methods(self):
+        for name in ('stop_times', 'frequencies', 'fare_rules', 'feeds'):
+            entries = getattr(self.schedule, name)
+            self.assertCountEqual(
+                list(getattr(self.schedule, name + '_iter')(batch_size=3)),
+                entries)
+        feed_id = self.schedule.feeds[0].feed_id
+        self.assertEqual(len(list(self.schedule.stops_iter(feed_id=feed_id))), 9)
+        self.assertEqual(list(self.schedule.stops_iter(feed_id=feed_id + 1)), [])
+
+class TestBulkSchedule(TestSchedule):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(self.schedule, data_location, bulk=True)
+
+
+class TestParallelSchedule(TestSchedule):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(self.schedule, data_location, workers=2)
+
+
+@unittest.skipUnless(feed._pyarrow_available(), "pyarrow is not installed")
+class TestPyarrowCsvSchedule(TestSchedule):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(self.schedule, data_location, csv_engine="pyarrow")
+
+
+class TestCsvEngines(unittest.TestCase):
+    @unittest.skipUnless(feed._pyarrow_available(), "pyarrow is not installed")
+    def test_pyarrow_records(self):
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        python = feed.Feed(data_location, csv_engine="python")
+        pyarrow = feed.Feed(data_location, csv_engine="pyarrow")
+        for gtfs_class in gtfs_all:
+            filename = gtfs_class.__tablename__ + ".txt"
+            columns = set(c.name for c in gtfs_class.__table__.columns)
+            self.assertEqual([r for r in python.read_table(filename, columns) if r],
+                             list(pyarrow.read_table(filename, columns)))
+
+    def test_default_engine_ragged_rows(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            feed_dir = os.path.join(tmpdir, "sample_feed")
+            shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                         "data", "sample_feed"), feed_dir)
+            filename = os.path.join(feed_dir, "stops.txt")
+            with open(filename) as f:
+                lines = f.read().splitlines()
+            # an extra column, missing from the first row
+            lines = [line + ",extra" for line in lines]
+            lines[1] = lines[1][:-len(",extra")]
+            with open(filename, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            schedule = Schedule(":memory:")
+            append_feed(schedule, feed_dir)
+            self.assertEqual(len(schedule.stops), 9)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            feed.Feed(os.path.dirname(__file__), csv_engine="nope")
+
+
+class TestReadColumns(unittest.TestCase):
+    def read(self, engine, **kwargs):
+        fd = feed.Feed(os.path.join(os.path.dirname(__file__),
+                                    "data", "sample_feed"), csv_engine=engine)
+        return list(fd.read_columns("stop_times.txt",
+                                    {"trip_id", "stop_sequence", "shape_dist_traveled"},
+                                    batch_size=10, **kwargs))
+
+    def check_batches(self, engine):
+        batches = self.read(engine)
+        self.assertEqual([len(b["trip_id"]) for b in batches], [10, 10, 8])
+        self.assertEqual(batches[0]["trip_id"][:3], ["STBA", "STBA", "CITY1"])
+        self.assertEqual(batches[0]["stop_sequence"][:3], ["1", "2", "1"])
+        self.assertEqual(batches[2]["shape_dist_traveled"][0], None)
+
+    def check_dtypes(self, engine):
+        batches = self.read(engine, dtypes=True)
+        self.assertEqual(batches[0]["stop_sequence"].dtype, numpy.int64)
+        self.assertEqual(list(batches[0]["stop_sequence"][:3]), [1, 2, 1])
+        self.assertTrue(numpy.isnan(batches[2]["shape_dist_traveled"]).all())
+        self.assertEqual(batches[0]["trip_id"][0], "STBA")
+
+    def test_python(self):
+        self.check_batches("python")
+
+    @unittest.skipUnless(feed._pyarrow_available(), "pyarrow is not installed")
+    def test_pyarrow(self):
+        self.check_batches("pyarrow")
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_python_dtypes(self):
+        self.check_dtypes("python")
+
+    @unittest.skipIf(numpy is None or not feed._pyarrow_available(),
+                     "numpy or pyarrow is not installed")
+    def test_pyarrow_dtypes(self):
+        self.check_dtypes("pyarrow")
+
+
+class TestFeedChunks(unittest.TestCase):
+    def test_chunks_match_table(self):
+        fd = feed.Feed(os.path.join(os.path.dirname(__file__),
+                                    "data", "sample_feed"))
+        columns = {'trip_id', 'stop_id', 'arrival_time', 'stop_sequence'}
+        records = list(fd.read_table('stop_times.txt', columns))
+        chunks = list(fd.read_chunks('stop_times.txt', 100))
+        self.assertGreater(len(chunks), 1)
+        chunked = [record for chunk in chunks
+                   for record in feed.read_chunk(chunk, 'stop_times.txt', columns)]
+        self.assertEqual(chunked, records)
+
+
+class TestFastLoad(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.schedule = Schedule(os.path.join(self.tmpdir, "gtfs.sqlite"))
+
+    def tearDown(self):
+        self.schedule.session.close()
+        self.schedule.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def pragmas(self):
+        return [self.schedule.session.execute(text("PRAGMA %s" % name)).scalar()
+                for name in ("journal_mode", "synchronous", "cache_size")]
+
+    def indexes(self):
+        return self.schedule.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND sql IS NOT NULL ORDER BY name")).scalars().all()
+
+    def test_fast_load(self):
+        pragmas = self.pragmas()
+        indexes = self.indexes()
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(self.schedule, data_location, bulk=True, fast_load=True)
+        self.assertEqual(self.pragmas(), pragmas)
+        self.assertEqual(self.indexes(), indexes)
+        self.assertEqual(len(self.schedule.stop_times), 28)
+        self.assertEqual(len(self.schedule.stops[0].translations), 2)
+
+    def test_fast_load_journal(self):
+        pragmas = self.pragmas()
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        seen = []
+        original = loader._insert_tables
+
+        def insert_tables(schedule, *args):
+            # synchronous=NORMAL is 1
+            seen.append(self.pragmas()[:2])
+            return original(schedule, *args)
+
+        loader._insert_tables = insert_tables
+        try:
+            append_feed(self.schedule, data_location, fast_load=True,
+                        resume=True)
+        finally:
+            loader._insert_tables = original
+        self.assertEqual(seen, [["wal", 1]])
+        self.assertEqual(self.pragmas(), pragmas)
+        self.assertEqual(len(self.schedule.stop_times), 28)
+
+
+@unittest.skipUnless(os.environ.get("PYGTFS_TEST_POSTGRES"),
+                     "set PYGTFS_TEST_POSTGRES to a postgresql:// url to run")
+class TestPostgresSchedule(TestSchedule):
+    def setUp(self):
+        self.schedule = Schedule(os.environ["PYGTFS_TEST_POSTGRES"])
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(self.schedule, data_location)
+
+
+class TestCopyText(unittest.TestCase):
+    def test_copy_text(self):
+        self.assertEqual([postgres.copy_text(v) for v in
+                          (None, "", "a\tb\\", True, 3, 1.5,
+                           datetime.date(2007, 6, 4),
+                           datetime.timedelta(hours=25, seconds=1))],
+                         ["\\N", "", "a\\tb\\\\", "t", "3", "1.5", "2007-06-04",
+                          "90001 seconds"])
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.feed_dir = os.path.join(self.tmpdir, "sample_feed")
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed"), self.feed_dir)
+        self.schedule = Schedule(":memory:")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def interrupt(self, **kwargs):
+        """ Load the feed, stopping after 25 stop times were committed. """
+        original = loader._Checkpoint.advance
+
+        def advance(checkpoint, gtfs_class, n):
+            original(checkpoint, gtfs_class, n)
+            if checkpoint.rows_loaded(StopTime) >= 25:
+                raise RuntimeError("interrupted")
+
+        loader._Checkpoint.advance = advance
+        try:
+            with self.assertRaises(RuntimeError):
+                append_feed(self.schedule, self.feed_dir, chunk_size=5,
+                            resume=True, **kwargs)
+        finally:
+            loader._Checkpoint.advance = original
+        self.schedule.session.rollback()
+
+    def test_resume(self):
+        self.interrupt()
+        self.assertEqual(len(self.schedule.stop_times), 25)
+        progress = {p.table_name: p for p in self.schedule.session.query(LoadProgress)}
+        self.assertTrue(progress["trips"].complete)
+        self.assertFalse(progress["stop_times"].complete)
+        self.assertEqual(progress["stop_times"].rows_loaded, 25)
+
+        append_feed(self.schedule, self.feed_dir, chunk_size=5, resume=True)
+        self.assertEqual(len(self.schedule.feeds), 1)
+        self.assertEqual(len(self.schedule.stop_times), 28)
+        self.assertEqual(len(self.schedule.trips), 11)
+        self.assertEqual(self.schedule.session.query(LoadProgress).count(), 0)
+
+    def test_resume_changed_files(self):
+        self.interrupt()
+        # a newer export of the feed, under the same name
+        filename = os.path.join(self.feed_dir, "stop_times.txt")
+        with open(filename, "a") as f:
+            f.write("AAMV4,16:30:00,16:30:00,AMV,3,,,,\n")
+        append_feed(self.schedule, self.feed_dir, chunk_size=5, resume=True)
+        unfinished, feed = self.schedule.feeds
+        self.assertEqual(len(unfinished.stop_times), 25)
+        self.assertEqual(len(feed.stop_times), 29)
+        self.assertEqual(self.schedule.session.query(LoadProgress)
+                         .filter_by(feed_id=feed.feed_id).count(), 0)
+
+    def test_resume_without_unfinished_load(self):
+        append_feed(self.schedule, self.feed_dir, resume=True)
+        append_feed(self.schedule, self.feed_dir, resume=True)
+        self.assertEqual(len(self.schedule.feeds), 2)
+        self.assertEqual(len(self.schedule.stop_times), 56)
+
+
+class TestUpdateFeed(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.feed_dir = os.path.join(self.tmpdir, "sample_feed")
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed"), self.feed_dir)
+        self.schedule = Schedule(":memory:")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def edit(self, filename, edit_lines):
+        filename = os.path.join(self.feed_dir, filename)
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        with open(filename, "w") as f:
+            f.write("\n".join(edit_lines(lines)) + "\n")
+
+    def snapshot(self, schedule):
+        tables = {}
+        for gtfs_class in gtfs_all:
+            columns = [c for c in gtfs_class.__table__.columns
+                       if c.name not in ("feed_id", "fare_rule_internal_key")]
+            rows = schedule.session.execute(
+                gtfs_class.__table__.select().with_only_columns(*columns))
+            tables[gtfs_class] = sorted(map(tuple, rows), key=repr)
+        tables[ServiceDate] = sorted(schedule.session.execute(
+            select(ServiceDate.service_id, ServiceDate.date)))
+        tables[StopDeparture] = sorted(schedule.session.execute(
+            StopDeparture.__table__.select().with_only_columns(*(
+                c for c in StopDeparture.__table__.columns
+                if c.name != "feed_id"))))
+        tables[ShapeGeometry] = sorted(schedule.session.execute(
+            ShapeGeometry.__table__.select().with_only_columns(*(
+                c for c in ShapeGeometry.__table__.columns
+                if c.name != "feed_id"))))
+        return tables
+
+    def test_update(self):
+        append_feed(self.schedule, self.feed_dir)
+        feed_id = self.schedule.feeds[0].feed_id
+        self.edit("stop_times.txt", lambda lines: [
+            lines[0], lines[1].replace("6:00:00", "6:05:00")] + lines[2:-1])
+        self.edit("shapes.txt", lambda lines: lines + [
+            "S1,36.4,-117.1,1,", "S1,36.5,-117.2,2,"])
+        self.edit("trips.txt", lambda lines: [
+            line + "S1" if line.startswith("AB,FULLW,AB1,") else line
+            for line in lines])
+        self.edit("fare_rules.txt", lambda lines: lines[:-1])
+
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual([f.feed_id for f in self.schedule.feeds], [feed_id])
+        fresh = Schedule(":memory:")
+        append_feed(fresh, self.feed_dir)
+        self.assertEqual(self.snapshot(self.schedule), self.snapshot(fresh))
+        self.assertEqual(len(self.schedule.stop_times), 27)
+        self.assertEqual(len(self.schedule.trips_by_id("AB1")[0].shape_points), 2)
+        self.assertEqual(self.schedule.trips_by_id("AB1")[0].geometry.points,
+                         [(36.4, -117.1), (36.5, -117.2)])
+
+    def test_update_expanded_frequencies(self):
+        append_feed(self.schedule, self.feed_dir, expand_frequencies=True)
+        self.edit("frequencies.txt", lambda lines: [
+            line.replace(",1800", ",3600") if line.startswith("STBA,") else line
+            for line in lines])
+        update_feed(self.schedule, self.feed_dir)
+        count = self.schedule.session.query(FrequencyTrip).filter(
+            FrequencyTrip.trip_id == "STBA").count()
+        self.assertEqual(count, 16)
+        self.assertEqual(self.schedule.session.query(FrequencyTrip).count(), 120)
+
+    def test_update_departures_after_midnight(self):
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("stop_times.txt", lambda lines: [
+            line.replace("6:00:00", "25:00:00").replace("6:20:00", "25:20:00")
+            if line.startswith("STBA,") else line for line in lines])
+        update_feed(self.schedule, self.feed_dir)
+        departures = self.schedule.departures(
+            "STAGECOACH", datetime.date(2007, 6, 6),
+            end=datetime.timedelta(hours=2))
+        self.assertEqual([(d.trip_id, d.departure_time, d.service_date)
+                          for d in departures],
+                         [("STBA", datetime.timedelta(hours=1),
+                           datetime.date(2007, 6, 5))])
+        fresh = Schedule(":memory:")
+        append_feed(fresh, self.feed_dir)
+        self.assertEqual(self.snapshot(self.schedule), self.snapshot(fresh))
+
+    def test_update_colliding_hash(self):
+        # hash(-1) == hash(-2), so the rows only differ in their values
+        self.edit("stop_times.txt", lambda lines: [
+            lines[0], lines[1] + "-1"] + lines[2:])
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("stop_times.txt", lambda lines: [
+            lines[0], lines[1].replace(",-1", ",-2")] + lines[2:])
+        update_feed(self.schedule, self.feed_dir)
+        stop_time = self.schedule.session.query(StopTime).filter(
+            StopTime.trip_id == "STBA", StopTime.stop_sequence == 1).one()
+        self.assertEqual(stop_time.shape_dist_traveled, -2)
+
+    def test_repeated_stop_sequence(self):
+        # the stop times of a trip only have to differ in stop or sequence
+        self.edit("stop_times.txt", lambda lines: [
+            line.replace("BEATTY_AIRPORT,2,", "BEATTY_AIRPORT,1,")
+            if line.startswith("STBA,") else line for line in lines])
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("stop_times.txt", lambda lines: [
+            line.replace("6:20:00", "6:25:00") if line.startswith("STBA,")
+            else line for line in lines])
+        update_feed(self.schedule, self.feed_dir)
+        departures = self.schedule.session.query(StopDeparture).filter(
+            StopDeparture.trip_id == "STBA").order_by(StopDeparture.stop_id).all()
+        self.assertEqual([(d.stop_id, d.stop_sequence, d.departure_seconds)
+                          for d in departures],
+                         [("BEATTY_AIRPORT", 1, 6 * 3600 + 25 * 60),
+                          ("STAGECOACH", 1, 6 * 3600)])
+
+    def test_update_dummy_services(self):
+        append_feed(self.schedule, self.feed_dir, ignore_files=["calendar.txt"])
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual(len(self.schedule.services), 2)
+        os.remove(os.path.join(self.feed_dir, "calendar.txt"))
+        update_feed(self.schedule, self.feed_dir)
+        fresh = Schedule(":memory:")
+        append_feed(fresh, self.feed_dir)
+        self.assertEqual(self.snapshot(self.schedule), self.snapshot(fresh))
+
+    def enforce_foreign_keys(self):
+        self.schedule.session.connection().exec_driver_sql(
+            "PRAGMA foreign_keys=ON")
+
+    def test_update_calendar_dates_only(self):
+        self.enforce_foreign_keys()
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("calendar_dates.txt", lambda lines: lines + [
+            "EXTRA,20110610,1"])
+        update_feed(self.schedule, self.feed_dir, ignore_files=["calendar.txt"])
+        self.assertEqual(len(self.schedule.services), 3)
+        self.assertEqual([s.service_id for s in
+                          self.schedule.services_on(datetime.date(2011, 6, 10))],
+                         ["EXTRA"])
+        # the services of the trips only run on exceptions, without calendar
+        self.edit("calendar_dates.txt", lambda lines: lines + [
+            "OTHER,20110611,1", "WE,20110612,1"])
+        os.remove(os.path.join(self.feed_dir, "calendar.txt"))
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual(sorted(s.service_id for s in self.schedule.services),
+                         ["EXTRA", "FULLW", "OTHER", "WE"])
+        self.assertEqual([s.service_id for s in
+                          self.schedule.services_on(datetime.date(2011, 6, 11))],
+                         ["OTHER"])
+
+    def test_update_removed_service_foreign_keys(self):
+        self.enforce_foreign_keys()
+        self.edit("calendar.txt", lambda lines: lines + [
+            "EXTRA,1,1,1,1,1,0,0,20070101,20071231"])
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("calendar.txt", lambda lines: lines[:-1])
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual(self.schedule.session.query(ServiceDate).filter(
+            ServiceDate.service_id == "EXTRA").count(), 0)
+        self.assertEqual(len(self.schedule.services_on(datetime.date(2007, 6, 5))), 1)
+
+    def test_update_removed_trip_foreign_keys(self):
+        self.enforce_foreign_keys()
+        append_feed(self.schedule, self.feed_dir)
+        self.edit("stop_times.txt", lambda lines: [
+            line for line in lines if not line.startswith("AB1,")])
+        self.edit("trips.txt", lambda lines: [
+            line for line in lines if ",AB1," not in line])
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual(self.schedule.trips_by_id("AB1"), [])
+        self.assertEqual(self.schedule.session.query(StopDeparture).filter(
+            StopDeparture.trip_id == "AB1").count(), 0)
+        fresh = Schedule(":memory:")
+        append_feed(fresh, self.feed_dir)
+        self.assertEqual(self.snapshot(self.schedule), self.snapshot(fresh))
+
+    def test_update_appends_new_feed(self):
+        update_feed(self.schedule, self.feed_dir)
+        self.assertEqual(len(self.schedule.feeds), 1)
+        self.assertEqual(len(self.schedule.stop_times), 28)
+
+
+class TestFrequencyTemplates(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.feed_dir = os.path.join(self.tmpdir, "sample_feed")
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed"), self.feed_dir)
+        self.schedule = Schedule(":memory:")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def edit(self, filename, edit_line):
+        filename = os.path.join(self.feed_dir, filename)
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        with open(filename, "w") as f:
+            f.write("\n".join(map(edit_line, lines)) + "\n")
+
+    def stored_starts(self, trip_id):
+        self.schedule.expand_frequencies(self.schedule.feeds[0].feed_id)
+        return self.schedule.session.execute(
+            select(FrequencyTrip.start_seconds)
+            .where(FrequencyTrip.trip_id == trip_id)
+            .order_by(FrequencyTrip.start_seconds)).scalars().all()
+
+    def test_overlapping_entries(self):
+        self.edit("frequencies.txt", lambda line: line + (
+            "\nSTBA,7:00:00,9:00:00,1200" if line.startswith("STBA,") else ""))
+        append_feed(self.schedule, self.feed_dir)
+        starts = [int(t.start_time.total_seconds())
+                  for t in self.schedule.frequency_trips(trip_id="STBA")]
+        self.assertEqual(starts, sorted(set(starts)))
+        # 32 every half hour, and 7:20, 7:40, 8:20 and 8:40
+        self.assertEqual(len(starts), 36)
+        self.assertEqual(self.stored_starts("STBA"), starts)
+
+    def test_untimed_first_stop(self):
+        self.edit("stop_times.txt", lambda line: line.replace(
+            "STBA,6:00:00,6:00:00,", "STBA,,,"))
+        append_feed(self.schedule, self.feed_dir)
+        trip = next(self.schedule.frequency_trips(trip_id="STBA"))
+        self.assertEqual(trip.start_time, datetime.timedelta(hours=6))
+        self.assertEqual([st.departure_time for st in trip.stop_times],
+                         [None, datetime.timedelta(hours=6)])
+        self.assertEqual(len(self.stored_starts("STBA")), 32)
+
+    def test_untimed_template(self):
+        self.edit("stop_times.txt", lambda line: line.replace(
+            "STBA,6:00:00,6:00:00,", "STBA,,,").replace(
+            "STBA,6:20:00,6:20:00,", "STBA,,,"))
+        append_feed(self.schedule, self.feed_dir)
+        with self.assertLogs("pygtfs.frequencies", "WARNING"):
+            self.assertEqual(
+                list(self.schedule.frequency_trips(trip_id="STBA")), [])
+        with self.assertLogs("pygtfs.frequencies", "WARNING"):
+            self.assertEqual(self.stored_starts("STBA"), [])
+        self.assertEqual(len(self.stored_starts("CITY1")), 52)
+
+
+class TestShapeGeometry(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.feed_dir = feed_dir = os.path.join(self.tmpdir, "sample_feed")
+        shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed"), feed_dir)
+        with open(os.path.join(feed_dir, "shapes.txt"), "a") as f:
+            # from the airport to bullfrog, out of sequence order
+            f.write("\nS1,36.88108,-116.81797,3,\nS1,36.868446,-116.784582,1,"
+                    "\nS1,36.88108,-116.784582,2,\n")
+        with open(os.path.join(feed_dir, "trips.txt")) as f:
+            lines = f.read().splitlines()
+        with open(os.path.join(feed_dir, "trips.txt"), "w") as f:
+            f.write("\n".join(line + "S1" if line.startswith("AB,") else line
+                              for line in lines) + "\n")
+        self.schedule = Schedule(":memory:")
+        append_feed(self.schedule, feed_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_geometry(self):
+        trip = self.schedule.trips_by_id("AB1")[0]
+        self.assertEqual([p.shape_pt_sequence for p in trip.shape_points], [1, 2, 3])
+        geometry = trip.geometry
+        self.assertEqual(geometry.point_count, 3)
+        self.assertEqual(geometry.points, [(36.868446, -116.784582),
+                                           (36.88108, -116.784582),
+                                           (36.88108, -116.81797)])
+        self.assertEqual(geometry.distances, [
+            0, spatial.distance(36.868446, -116.784582, 36.88108, -116.784582),
+            geometry.length])
+        self.assertAlmostEqual(geometry.length, geometry.distances[1] +
+                               spatial.distance(36.88108, -116.784582,
+                                                36.88108, -116.81797))
+        self.assertEqual(sorted(t.trip_id for t in trip.shape_points[0].trips),
+                         ["AB1", "AB2"])
+        self.assertIsNone(self.schedule.trips_by_id("STBA")[0].geometry)
+        self.assertEqual(self.schedule.trips_by_id("STBA")[0].shape_points, [])
+        self.assertEqual(len(self.schedule.session.execute(
+            select(ShapeGeometry)).all()), 1)
+
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_reference_feed(self):
+        feed_id = self.schedule.feeds[0].feed_id
+        self.assertEqual(linear.reference_feed(self.schedule, feed_id), 4)
+        length = self.schedule.trips_by_id("AB1")[0].geometry.length
+        distances = {(st.trip_id, st.stop_id): st.distance.distance
+                     for st in self.schedule.stop_times
+                     if st.distance is not None}
+        self.assertAlmostEqual(distances["AB1", "BEATTY_AIRPORT"], 0)
+        self.assertAlmostEqual(distances["AB1", "BULLFROG"], length, places=2)
+        # the opposite direction can't go back along the shape
+        self.assertAlmostEqual(distances["AB2", "BEATTY_AIRPORT"], length, places=2)
+        self.assertEqual(len(distances), 4)
+        # the distances of the feed are left as they are
+        self.assertTrue(all(st.shape_dist_traveled is None
+                            for st in self.schedule.stop_times))
+        hop = self.schedule.session.query(HopGeometry).filter_by(
+            feed_id=feed_id, shape_id="S1", from_stop_id="BEATTY_AIRPORT",
+            to_stop_id="BULLFROG").one()
+        self.assertEqual(len(hop.points), 3)
+        self.assertEqual(hop.points[1], (36.88108, -116.784582))
+        # referencing again replaces the rows
+        self.assertEqual(linear.reference_feed(self.schedule, feed_id), 4)
+        self.assertEqual(self.schedule.session.query(StopDistance).count(), 4)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_reference_repeated_stop_sequence(self):
+        self.edit("stop_times.txt", lambda lines: [
+            line.replace("BULLFROG,2,", "BULLFROG,1,")
+            if line.startswith("AB1,") else line for line in lines])
+        schedule = Schedule(":memory:")
+        append_feed(schedule, self.feed_dir)
+        self.assertEqual(linear.reference_feed(
+            schedule, schedule.feeds[0].feed_id), 4)
+        stop_times = schedule.session.query(StopTime).filter(
+            StopTime.trip_id == "AB1").all()
+        self.assertEqual(len(stop_times), 2)
+        self.assertTrue(all(st.distance is not None for st in stop_times))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_reference_loop(self):
+        # around a square one and a half times, passing both stops twice
+        corners = ["36.868446,-116.784582", "36.88108,-116.784582",
+                   "36.88108,-116.81797", "36.868446,-116.81797"]
+        self.edit("shapes.txt", lambda lines: lines + [
+            "S2,%s,%d," % (corners[i % 4], i + 1) for i in range(7)])
+        self.edit("trips.txt", lambda lines: lines + [
+            "AB,FULLW,AB3,Loop,0,1,S2"])
+        self.edit("stop_times.txt", lambda lines: lines + [
+            "AB3,9:00:00,9:00:00,BEATTY_AIRPORT,1,,,,",
+            "AB3,9:10:00,9:10:00,BULLFROG,2,,,,",
+            "AB3,9:20:00,9:20:00,BEATTY_AIRPORT,3,,,,",
+            "AB3,9:30:00,9:30:00,BULLFROG,4,,,,"])
+        schedule = Schedule(":memory:")
+        append_feed(schedule, self.feed_dir)
+        linear.reference_feed(schedule, schedule.feeds[0].feed_id)
+        length = schedule.trips_by_id("AB3")[0].geometry.length
+        hops = schedule.session.query(HopGeometry).filter_by(
+            shape_id="S2", from_stop_id="BEATTY_AIRPORT",
+            to_stop_id="BULLFROG").order_by(HopGeometry.start_distance).all()
+        self.assertEqual(len(hops), 2)
+        self.assertLess(hops[0].end_distance, hops[1].start_distance)
+        self.assertLess(hops[1].end_distance, length + 1)
+        self.assertGreater(hops[1].start_distance, length / 2)
+        self.assertEqual(schedule.session.query(HopGeometry).filter_by(
+            shape_id="S2").count(), 3)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_update_referenced_feed(self):
+        self.schedule.session.connection().exec_driver_sql(
+            "PRAGMA foreign_keys=ON")
+        feed_id = self.schedule.feeds[0].feed_id
+        linear.reference_feed(self.schedule, feed_id)
+        filename = os.path.join(self.feed_dir, "shapes.txt")
+        with open(filename) as f:
+            shapes = f.read().replace("S1,36.88108,-116.784582,2,",
+                                      "S1,36.87,-116.79,2,")
+        with open(filename, "w") as f:
+            f.write(shapes)
+        update_feed(self.schedule, self.feed_dir)
+        hop = self.schedule.session.query(HopGeometry).filter_by(
+            feed_id=feed_id, shape_id="S1", from_stop_id="BEATTY_AIRPORT",
+            to_stop_id="BULLFROG").one()
+        self.assertEqual(hop.points[1], (36.87, -116.79))
+        stop_time = self.schedule.session.query(StopTime).filter(
+            StopTime.trip_id == "AB1", StopTime.stop_id == "BULLFROG").one()
+        self.assertIsNone(stop_time.shape_dist_traveled)
+        self.assertAlmostEqual(
+            stop_time.distance.distance,
+            self.schedule.trips_by_id("AB1")[0].geometry.length, places=2)
+
+    def legacy_database(self):
+        """ A database of the feed as loaded before _shape_geometries. """
+        db = os.path.join(self.tmpdir, "legacy.sqlite")
+        schedule = Schedule(db)
+        append_feed(schedule, self.feed_dir)
+        connection = schedule.session.connection()
+        connection.exec_driver_sql("DELETE FROM _shape_geometries")
+        connection.exec_driver_sql(
+            "CREATE TABLE _trip_shapes (trip_feed_id INTEGER, "
+            "shape_feed_id INTEGER, trip_id VARCHAR, shape_id VARCHAR, "
+            "shape_pt_sequence INTEGER, "
+            "FOREIGN KEY(trip_feed_id, trip_id) "
+            "REFERENCES trips (feed_id, trip_id), "
+            "FOREIGN KEY(shape_feed_id, shape_id, shape_pt_sequence) "
+            "REFERENCES shapes (feed_id, shape_id, shape_pt_sequence))")
+        connection.exec_driver_sql(
+            "INSERT INTO _trip_shapes SELECT trips.feed_id, shapes.feed_id, "
+            "trip_id, shapes.shape_id, shape_pt_sequence FROM trips "
+            "JOIN shapes ON trips.feed_id = shapes.feed_id "
+            "AND trips.shape_id = shapes.shape_id")
+        schedule.session.commit()
+        schedule.session.close()
+        schedule.engine.dispose()
+        return db
+
+    def edit(self, filename, edit_lines):
+        filename = os.path.join(self.feed_dir, filename)
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        with open(filename, "w") as f:
+            f.write("\n".join(edit_lines(lines)) + "\n")
+
+    def test_legacy_database(self):
+        db = self.legacy_database()
+        with self.assertLogs("pygtfs.schedule", "WARNING"):
+            Schedule(db, read_only=True)
+        schedule = Schedule(db)
+        trip = schedule.trips_by_id("AB1")[0]
+        self.assertEqual([p.shape_pt_sequence for p in trip.shape_points], [1, 2, 3])
+        self.assertEqual(trip.geometry.point_count, 3)
+        # built once
+        self.assertEqual(loader._missing_derived(schedule), set())
+
+    def test_legacy_drop_feed(self):
+        schedule = Schedule(self.legacy_database())
+        schedule.session.connection().exec_driver_sql("PRAGMA foreign_keys=ON")
+        schedule.drop_feed(schedule.feeds[0].feed_id)
+        self.assertEqual(schedule.session.execute(
+            text("SELECT count(*) FROM _trip_shapes")).scalar(), 0)
+        self.assertEqual(schedule.trips, [])
+
+    def test_legacy_update_feed(self):
+        schedule = Schedule(self.legacy_database())
+        schedule.session.connection().exec_driver_sql("PRAGMA foreign_keys=ON")
+        self.edit("trips.txt", lambda lines: [
+            line for line in lines if ",AB1," not in line])
+        self.edit("stop_times.txt", lambda lines: [
+            line for line in lines if not line.startswith("AB1,")])
+        update_feed(schedule, self.feed_dir)
+        self.assertEqual(schedule.trips_by_id("AB1"), [])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestLinearReferencing(unittest.TestCase):
+    def test_project_loop(self):
+        # out and back along the equator, with a stop visited both ways
+        points = numpy.array([[0, 0], [0, 0.01], [0, 0]])
+        distances = numpy.array([0, 1000, 2000])
+        stops = numpy.array([[0.0001, 0], [0.0001, 0.005], [0.0001, 0.01],
+                             [-0.0001, 0.005]])
+        numpy.testing.assert_allclose(linear.project(points, distances, stops),
+                                      [0, 500, 1000, 1500])
+
+    def test_cut(self):
+        points = numpy.array([[0, 0], [0, 1], [1, 1]])
+        distances = numpy.array([0, 10, 20])
+        numpy.testing.assert_allclose(linear.cut(points, distances, 5, 15),
+                                      [[0, 0.5], [0, 1], [0.5, 1]])
+
+
+class TestLegacyDatabase(unittest.TestCase):
+    """ Databases loaded before the derived tables existed. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "gtfs.sqlite")
+        schedule = Schedule(self.db)
+        append_feed(schedule, os.path.join(os.path.dirname(__file__),
+                                           "data", "sample_feed"))
+        schedule.session.close()
+        schedule.engine.dispose()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def clear(self, *tables):
+        schedule = Schedule(self.db)
+        for table in tables:
+            schedule.session.execute(table.__table__.delete())
+        schedule.session.commit()
+        schedule.session.close()
+        schedule.engine.dispose()
+
+    def test_service_dates(self):
+        self.clear(ServiceDate)
+        with self.assertLogs("pygtfs.schedule", "WARNING"):
+            read_only = Schedule(self.db, read_only=True)
+        with self.assertRaises(PygtfsException):
+            read_only.services_on(datetime.date(2007, 6, 5))
+        with self.assertRaises(PygtfsException):
+            read_only.trips_on(datetime.date(2007, 6, 5))
+        schedule = Schedule(self.db)
+        self.assertEqual([s.service_id for s in schedule.services_on(
+            datetime.date(2007, 6, 5))], ["FULLW"])
+        self.assertEqual(len(schedule.trips_on(datetime.date(2007, 6, 5))), 7)
+        self.assertEqual(len(Schedule(self.db, read_only=True).trips_on(
+            datetime.date(2007, 6, 5))), 7)
+
+    def test_stop_departures(self):
+        self.clear(StopDeparture)
+        date = datetime.date(2007, 6, 5)
+        with self.assertLogs("pygtfs.schedule", "WARNING"):
+            read_only = Schedule(self.db, read_only=True)
+        with self.assertRaises(PygtfsException):
+            read_only.departures("STAGECOACH", date)
+        departures = Schedule(self.db).departures("STAGECOACH", date)
+        self.assertEqual(len(departures), 3)
+        self.assertEqual(Schedule(self.db, read_only=True).departures(
+            "STAGECOACH", date), departures)
+
+
+class TestDropFeed(unittest.TestCase):
+    def test_drop_feed(self):
+        schedule = Schedule(":memory:")
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        append_feed(schedule, data_location)
+        append_feed(schedule, data_location)
+        dropped, kept = [f.feed_id for f in schedule.feeds]
+        schedule.drop_feed(dropped)
+        self.assertEqual([f.feed_id for f in schedule.feeds], [kept])
+        self.assertEqual(len(schedule.stop_times), 28)
+        self.assertEqual(len(schedule.stops[0].translations), 2)
+        schedule.drop_feed(kept)
+        for table in Base.metadata.sorted_tables:
+            count = schedule.session.execute(
+                select(func.count()).select_from(table)).scalar()
+            self.assertEqual(count, 0, table.name)
+
+
+class TestThreadSafeSchedule(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "feed.db")
+        schedule = Schedule(self.db)
+        append_feed(schedule, os.path.join(os.path.dirname(__file__),
+                                           "data", "sample_feed"))
+        schedule.session.close()
+        schedule.engine.dispose()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_threads(self, schedule, target, n=4):
+        results = [None] * n
+        errors = []
+
+        def run(i):
+            try:
+                results[i] = target()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                schedule.remove_session()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_session_per_thread(self):
+        schedule = Schedule(self.db, thread_safe=True, pool_size=2, max_overflow=2)
+        sessions = self.run_threads(schedule, lambda: (
+            schedule.session(), len(schedule.stop_times),
+            len(schedule.stops_near(36.425288, -117.133162, 100))))
+        self.assertEqual(len({id(session) for session, _, _ in sessions}), 4)
+        self.assertEqual({result[1:] for result in sessions}, {(28, 1)})
+
+    def test_loading_profile_per_thread(self):
+        schedule = Schedule(self.db, thread_safe=True)
+        with schedule.loading("timetable"):
+            profiles = self.run_threads(schedule, lambda: schedule.loading_profile)
+            self.assertEqual(schedule.loading_profile, "timetable")
+        self.assertEqual(profiles, [None] * 4)
+
+    def test_memory(self):
+        schedule = Schedule(":memory:", thread_safe=True)
+        append_feed(schedule, os.path.join(os.path.dirname(__file__),
+                                           "data", "sample_feed"))
+        self.assertEqual(self.run_threads(schedule, lambda: len(schedule.trips)),
+                         [11] * 4)
+
+    def test_read_only(self):
+        schedule = Schedule(self.db, read_only=True)
+        self.assertEqual(len(schedule.routes), 6)
+        # the stop index is created by the first spatial query
+        self.assertIsInstance(schedule._stop_index, spatial._GridIndex)
+        writable = Schedule(self.db)
+        writable.stops_near(36.425288, -117.133162, 100)
+        self.assertIsInstance(Schedule(self.db, read_only=True)._stop_index,
+                              type(writable._stop_index))
+        with self.assertRaises(exc.OperationalError):
+            schedule.drop_feed(1)
+        with self.assertRaises(ValueError):
+            Schedule(":memory:", read_only=True)
+        with self.assertRaises(ValueError):
+            schedule.remove_session()
+
+
+@unittest.skipIf(aiosqlite is None or greenlet is None,
+                 "aiosqlite and greenlet are not installed")
+class TestAsyncSchedule(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, "feed.db")
+        self.schedule = Schedule(self.db)
+        append_feed(self.schedule, os.path.join(os.path.dirname(__file__),
+                                                "data", "sample_feed"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_async(self, test):
+        async def run():
+            async with AsyncSchedule(self.db) as schedule:
+                return await test(schedule)
+        return asyncio.run(run())
+
+    def test_accessors(self):
+        async def test(schedule):
+            self.assertEqual(len(await schedule.stops), 9)
+            self.assertEqual(len(await schedule.stop_times), 28)
+            routes = await schedule.routes_by_id("AB")
+            self.assertEqual(routes[0].route_long_name, "Airport - Bullfrog")
+            trips = await schedule.all(schedule.trips_query.where(
+                Trip.route_id == "AB"))
+            self.assertEqual(sorted(t.trip_id for t in trips), ["AB1", "AB2"])
+            self.assertCountEqual(
+                [(st.trip_id, st.stop_sequence) for st in self.schedule.stop_times],
+                [(st.trip_id, st.stop_sequence)
+                 async for st in schedule.stop_times_iter(batch_size=5)])
+        self.run_async(test)
+
+    def test_concurrent(self):
+        async def test(schedule):
+            trip_ids = [t.trip_id for t in await schedule.trips]
+            results = await asyncio.gather(*(schedule.trips_by_id(trip_id)
+                                             for trip_id in trip_ids))
+            self.assertEqual([r[0].trip_id for r in results], trip_ids)
+        self.run_async(test)
+
+    def test_loading(self):
+        async def test(schedule):
+            with schedule.loading("timetable"):
+                route = (await schedule.routes_by_id("AB"))[0]
+            self.assertIsNone(schedule.loading_profile)
+            self.assertEqual(
+                sorted(len(trip.stop_times) for trip in route.trips), [2, 2])
+            self.assertEqual(route.trips[0].stop_times[0].stop.stop_id[:4], "BEAT")
+        self.run_async(test)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = cache.ResultCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_lru(self):
+        self.assertEqual(self.cache.get("a", lambda: 1), 1)
+        self.assertEqual(self.cache.get("b", lambda: 2), 2)
+        self.assertEqual(self.cache.get("a", lambda: 3), 1)
+        self.cache.get("c", lambda: 4)
+        self.assertEqual(self.cache.get("b", lambda: 5), 5)
+        self.assertEqual(self.cache.info(), cache.CacheInfo(1, 4, 2, 2, 2))
+
+    def test_ttl(self):
+        self.cache.get("a", lambda: 1)
+        self.now = 9
+        self.assertEqual(self.cache.get("a", lambda: 2), 1)
+        self.now = 10
+        self.assertEqual(self.cache.get("a", lambda: 2), 2)
+
+    def test_invalidate(self):
+        self.cache = cache.ResultCache()
+        self.cache.get("all", lambda: 0)
+        self.cache.get("one", lambda: 1, feed_id=1)
+        self.cache.get("two", lambda: 2, feed_id=2)
+        self.cache.invalidate(1)
+        self.assertEqual(self.cache.get("two", lambda: None), 2)
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestScheduleCache(unittest.TestCase):
+    def setUp(self):
+        self.data_location = os.path.join(os.path.dirname(__file__),
+                                          "data", "sample_feed")
+        self.schedule = Schedule(":memory:", cache_size=100)
+        append_feed(self.schedule, self.data_location)
+
+    def test_hits(self):
+        stops = self.schedule.stops_by_id("FUR_CREEK_RES")
+        with self.schedule.count_queries() as counter:
+            self.assertEqual(self.schedule.stops_by_id("FUR_CREEK_RES"), stops)
+            self.schedule.routes
+            self.schedule.routes
+            self.schedule.departures("STAGECOACH", datetime.date(2007, 6, 4))
+            self.schedule.departures("STAGECOACH", datetime.date(2007, 6, 4))
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(self.schedule.cache.info()[:2], (3, 3))
+        self.schedule.routes.pop()
+        self.assertEqual(len(self.schedule.routes), 6)
+
+    def test_session_lifetime(self):
+        stop, = self.schedule.stops_by_id("FUR_CREEK_RES")
+        self.schedule.session.commit()
+        self.assertEqual(len(self.schedule.cache), 0)
+        stop, = self.schedule.stops_by_id("FUR_CREEK_RES")
+        self.schedule.session.expunge(stop)
+        self.assertEqual(len(self.schedule.cache), 0)
+        stop, = self.schedule.stops_by_id("FUR_CREEK_RES")
+        self.schedule.session.close()
+        self.assertEqual(len(self.schedule.cache), 0)
+        stop, = self.schedule.stops_by_id("FUR_CREEK_RES")
+        self.assertEqual(len(stop.stop_times), 2)
+
+    def test_invalidation(self):
+        self.assertEqual(len(self.schedule.routes_by_id("AB")), 1)
+        feed_id = self.schedule.feeds[0].feed_id
+        self.schedule.trips_on(datetime.date(2007, 6, 4), feed_id=feed_id)
+        append_feed(self.schedule, self.data_location)
+        self.assertEqual(len(self.schedule.routes_by_id("AB")), 2)
+        # dropped with the commits of the load
+        self.assertEqual(len(self.schedule.cache), 1)
+        self.schedule.drop_feed(feed_id)
+        self.assertEqual(len(self.schedule.routes_by_id("AB")), 1)
+        self.assertEqual(
+            self.schedule.trips_on(datetime.date(2007, 6, 4), feed_id=feed_id), [])
+        overwrite_feed(self.schedule, self.data_location)
+        self.assertEqual([r.feed_id for r in self.schedule.routes_by_id("AB")],
+                         [f.feed_id for f in self.schedule.feeds])
+
+    def test_thread_safe(self):
+        with self.assertRaises(ValueError):
+            Schedule(":memory:", cache_size=100, thread_safe=True)
+
+
+class TestSpatial(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        self.data_location = os.path.join(os.path.dirname(__file__),
+                                          "data", "sample_feed")
+        append_feed(self.schedule, self.data_location)
+
+    def brute_force_near(self, lat, lon, radius):
+        found = sorted((spatial.distance(lat, lon, s.stop_lat, s.stop_lon), s.stop_id)
+                       for s in self.schedule.stops)
+        return [stop_id for d, stop_id in found if d <= radius]
+
+    def test_distance(self):
+        # one degree of latitude
+        self.assertAlmostEqual(spatial.distance(0, 10, 1, 10), 111195, delta=1)
+        self.assertEqual(spatial.distance(36.9, -116.7, 36.9, -116.7), 0)
+
+    def test_radius_bbox(self):
+        for lat in (80, -80, 36.9):
+            for radius in (1000, 100000, 1000000):
+                min_lat, min_lon, max_lat, max_lon = spatial.radius_bbox(
+                    lat, 10, radius)
+                self.assertAlmostEqual(max_lon - 10, 10 - min_lon)
+                # the box is bounded by the meridians tangent to the circle,
+                # which touch it closer to the pole than its center
+                angle = radius / spatial.EARTH_RADIUS
+                tangent_lat = math.degrees(math.asin(
+                    math.sin(math.radians(lat)) / math.cos(angle)))
+                self.assertAlmostEqual(
+                    spatial.distance(lat, 10, tangent_lat, max_lon) / radius, 1)
+        # circles around a pole cover all the longitudes
+        self.assertEqual(spatial.radius_bbox(89.9, 10, 20000)[1::2], (-180, 180))
+        self.assertEqual(spatial.radius_bbox(-80, 10, 1200000)[:2], (-90, -180))
+
+    def test_stops_near(self):
+        for radius in (10, 1000, 5000, 50000):
+            self.assertEqual(
+                [s.stop_id for s in self.schedule.stops_near(36.9, -116.77, radius)],
+                self.brute_force_near(36.9, -116.77, radius))
+        nearest = self.schedule.stops_near(36.641496, -116.40094, 100, limit=1)
+        self.assertEqual([s.stop_id for s in nearest], ["AMV"])
+
+    def test_stops_in_bbox(self):
+        stops = self.schedule.stops_in_bbox(36.8, -116.8, 37, -116.7)
+        self.assertEqual(sorted(s.stop_id for s in stops),
+                         sorted(s.stop_id for s in self.schedule.stops
+                                if 36.8 <= s.stop_lat <= 37
+                                and -116.8 <= s.stop_lon <= -116.7))
+        self.assertEqual(self.schedule.stops_in_bbox(0, 0, 1, 1), [])
+
+    def test_grid_index(self):
+        grid = spatial._GridIndex(self.schedule)
+        index = self.schedule._stop_index
+        for args in ((36.8, -116.8, 37, -116.7), (-90, -180, 90, 180)):
+            self.assertEqual(sorted(grid.in_bbox(*args)),
+                             sorted(index.in_bbox(*args)))
+        self.assertEqual(grid.near(36.9, -116.77, 5000),
+                         index.near(36.9, -116.77, 5000))
+
+    def test_feed_changes(self):
+        append_feed(self.schedule, self.data_location)
+        self.assertEqual(len(self.schedule.stops_near(36.9, -116.77, 50000)), 16)
+        self.schedule.drop_feed(self.schedule.feeds[0].feed_id)
+        self.assertEqual(len(self.schedule.stops_near(36.9, -116.77, 50000)), 8)
+
+    @unittest.skipUnless(
+        spatial._RTreeIndex.supported(Schedule(":memory:")),
+        "sqlite is built without the R*Tree module")
+    def test_lazy_rtree(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmpdir, "gtfs.sqlite")
+            schedule = Schedule(db)
+            append_feed(schedule, self.data_location)
+            schedule.session.close()
+
+            def has_rtree():
+                return spatial.has_stored_index(Schedule(db, read_only=True))
+
+            # opening the database and loading it do not create the index
+            self.assertFalse(has_rtree())
+            schedule = Schedule(db)
+            self.assertEqual(len(schedule.stops_near(36.9, -116.77, 50000)), 8)
+            self.assertTrue(has_rtree())
+            # a schedule that did not query it yet keeps it up to date
+            append_feed(Schedule(db), self.data_location)
+            self.assertEqual(
+                len(Schedule(db).stops_near(36.9, -116.77, 50000)), 16)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_abstract_index(self):
+        class BoxOnly(spatial._StopIndex):
+            def in_bbox(self, min_lat, min_lon, max_lat, max_lon, feed_id=None):
+                return []
+
+        with self.assertRaises(TypeError):
+            BoxOnly()
+
+
+class TestLoadingProfiles(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        self.data_location = os.path.join(os.path.dirname(__file__),
+                                          "data", "sample_feed")
+        append_feed(self.schedule, self.data_location)
+
+    def walk_timetable(self):
+        self.schedule.session.expire_all()
+        with self.schedule.count_queries() as counter:
+            names = []
+            for route in self.schedule.routes:
+                for trip in route.trips:
+                    names.append(trip.service.service_id)
+                    names.extend(st.stop.stop_name for st in trip.stop_times)
+        return counter.count, sorted(names)
+
+    def test_timetable(self):
+        lazy_count, lazy_names = self.walk_timetable()
+        with self.schedule.loading("timetable"):
+            count, names = self.walk_timetable()
+        self.assertEqual(names, lazy_names)
+        self.assertLess(count, lazy_count)
+
+        # the number of queries does not grow with the data
+        append_feed(self.schedule, self.data_location)
+        with self.schedule.loading("timetable"):
+            self.assertEqual(self.walk_timetable()[0], count)
+        self.assertGreater(self.walk_timetable()[0], lazy_count)
+
+    def test_geometry(self):
+        with self.schedule.loading("geometry"):
+            trips = self.schedule.trips
+            with self.schedule.count_queries() as counter:
+                for trip in trips:
+                    trip.shape_points
+                    trip.geometry
+                    [st.stop.stop_lat for st in trip.stop_times]
+        self.assertEqual(counter.count, 0)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            with self.schedule.loading("fast"):
+                pass
+        self.assertIsNone(self.schedule.loading_profile)
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data_location = os.path.join(os.path.dirname(__file__),
+                                          "data", "sample_feed")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_columnar(self):
+        schedule = Schedule(":memory:")
+        append_feed(schedule, self.data_location)
+        arrays = schedule.columnar(schedule.feeds[0].feed_id)
+        self.assertEqual(len(arrays.stop_times), 28)
+        first = arrays.stop_times[0]
+        self.assertEqual(arrays.decode("trip_id", [first["trip_id"]]), ["AAMV1"])
+        self.assertEqual(arrays.decode("stop_id", [first["stop_id"]]),
+                         ["BEATTY_AIRPORT"])
+        self.assertEqual(first["arrival_time"], 8 * 3600)
+        self.assertTrue(numpy.isnan(first["shape_dist_traveled"]))
+        self.assertEqual(list(arrays.encode("stop_id", ["AMV", "nowhere"])),
+                         [list(arrays.ids["stop_id"]).index("AMV"), -1])
+        stops = arrays.stops[arrays.stops["stop_id"] == arrays.encode("stop_id", ["AMV"])[0]]
+        self.assertAlmostEqual(stops["stop_lat"][0], 36.641496)
+        # trips keep their order of stops
+        trip = arrays.stop_times[arrays.stop_times["trip_id"] == first["trip_id"]]
+        self.assertEqual(list(trip["stop_sequence"]), [1, 2])
+
+    def test_cache(self):
+        db = os.path.join(self.tmpdir, "feed.db")
+        schedule = Schedule(db)
+        append_feed(schedule, self.data_location)
+        feed_id = schedule.feeds[0].feed_id
+        directory = columnar.cache_directory(schedule, feed_id)
+        self.assertEqual(directory, db + ".columnar/%d" % feed_id)
+        built = schedule.columnar(feed_id)
+        self.assertTrue(os.path.isdir(directory))
+        cached = Schedule(db).columnar(feed_id)
+        self.assertIsInstance(cached.stop_times, numpy.memmap)
+        for name, table in built.tables.items():
+            for field in table.dtype.names:
+                numpy.testing.assert_array_equal(cached.tables[name][field],
+                                                 table[field])
+
+        update_feed(schedule, self.data_location)
+        self.assertFalse(os.path.isdir(directory))
+        schedule.columnar(feed_id)
+        # dropped once the change is committed
+        schedule._feeds_changed(feed_id)
+        self.assertTrue(os.path.isdir(directory))
+        schedule.session.rollback()
+        schedule.drop_feed(feed_id)
+        self.assertFalse(os.path.isdir(directory))
+
+    def test_cache_fingerprint(self):
+        db = os.path.join(self.tmpdir, "feed.db")
+        schedule = Schedule(db)
+        append_feed(schedule, self.data_location)
+        feed_id = schedule.feeds[0].feed_id
+        self.assertEqual(len(schedule.columnar(feed_id).stop_times), 28)
+        schedule.session.close()
+        schedule.engine.dispose()
+
+        # another database copied over the file: nothing dropped the cache
+        other = os.path.join(self.tmpdir, "other.db")
+        schedule = Schedule(other)
+        append_feed(schedule, self.data_location)
+        # the same number of rows, different content
+        schedule.session.execute(StopTime.__table__.update().where(
+            StopTime.trip_id == "AAMV1").values(stop_sequence=StopTime.stop_sequence + 10))
+        schedule.session.commit()
+        self.assertEqual(schedule.feeds[0].feed_id, feed_id)
+        schedule.session.close()
+        schedule.engine.dispose()
+        shutil.copyfile(other, db)
+        for _ in range(2):
+            schedule = Schedule(db)
+            stop_times = schedule.columnar(feed_id).stop_times
+            self.assertEqual(len(stop_times), 28)
+            self.assertEqual(stop_times["stop_sequence"][0], 11)
+        # a cache hit reads the fingerprint, without counting rows
+        with schedule.count_queries() as counter:
+            schedule.columnar(feed_id)
+        self.assertEqual(counter.count, 1)
+
+
+class TestCompiled(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "feed.gtfsc")
+        self.schedule = Schedule(":memory:")
+        append_feed(self.schedule, os.path.join(os.path.dirname(__file__),
+                                                "data", "sample_feed"))
+        compiler.compile_feed(self.schedule, self.filename)
+        self.compiled = compiled.CompiledFeed(self.filename)
+
+    def tearDown(self):
+        self.compiled.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_entities(self):
+        self.assertEqual(self.compiled.stop_ids(),
+                         sorted(s.stop_id for s in self.schedule.stops))
+        for stop in self.schedule.stops:
+            self.assertEqual(tuple(self.compiled.stop(stop.stop_id)),
+                             (stop.stop_id, stop.stop_name, stop.stop_lat,
+                              stop.stop_lon, stop.location_type,
+                              stop.parent_station))
+        for trip in self.schedule.trips:
+            self.assertEqual(tuple(self.compiled.trip(trip.trip_id)),
+                             (trip.trip_id, trip.route_id, trip.service_id,
+                              trip.trip_headsign, trip.direction_id,
+                              trip.shape_id))
+        route = self.compiled.route("AB")
+        self.assertEqual(route.route_long_name, "Airport - Bullfrog")
+        with self.assertRaises(KeyError):
+            self.compiled.stop("nowhere")
+
+    def test_stop_times(self):
+        for trip in self.schedule.trips:
+            stop_times = sorted(trip.stop_times, key=lambda st: st.stop_sequence)
+            self.assertEqual(
+                [(st.stop_id, st.stop_sequence, st.arrival_time.total_seconds(),
+                  st.departure_time.total_seconds()) for st in stop_times],
+                [(st.stop_id, st.stop_sequence, st.arrival_time, st.departure_time)
+                 for st in self.compiled.stop_times(trip.trip_id)])
+        departures = self.compiled.stop_times_at("BEATTY_AIRPORT", 8 * 3600 + 1,
+                                                 13 * 3600)
+        self.assertEqual([st.trip_id for st in departures],
+                         ["AAMV2", "AB2", "AAMV3"])
+
+    def test_service_dates(self):
+        self.assertFalse(self.compiled.runs_on("FULLW", datetime.date(2007, 6, 4)))
+        self.assertTrue(self.compiled.runs_on("FULLW", datetime.date(2007, 6, 5)))
+        self.assertFalse(self.compiled.runs_on("nothing", datetime.date(2007, 6, 5)))
+        self.assertEqual(
+            self.compiled.service_dates("WE"),
+            sorted(d.date for d in self.schedule.session.query(ServiceDate)
+                   .filter(ServiceDate.service_id == "WE")))
+
+    def test_long_section_name(self):
+        with self.assertRaises(PygtfsException):
+            compiler._write(os.path.join(self.tmpdir, "long.gtfsc"),
+                            {"stops." + "x" * 30: ("B", b"")})
+
+    def test_reader_without_sqlalchemy(self):
+        # a fresh interpreter, where importing sqlalchemy fails
+        script = ("import sys; sys.modules['sqlalchemy'] = None\n"
+                  "from pygtfs import compiled\n"
+                  "with compiled.CompiledFeed(sys.argv[1]) as feed:\n"
+                  "    print(feed.stop('AMV').stop_name)\n")
+        output = subprocess.check_output(
+            [sys.executable, "-c", script, self.filename],
+            cwd=os.path.join(os.path.dirname(__file__), "..", ".."),
+            stderr=subprocess.DEVNULL)
+        self.assertEqual(output.decode().strip(), "Amargosa Valley (Demo)")
+
+    def test_format_version(self):
+        with open(self.filename, "r+b") as f:
+            f.seek(8)
+            f.write(b"\xff")
+        with self.assertRaises(PygtfsException):
+            compiled.CompiledFeed(self.filename)
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(":memory:")
+        append_feed(self.schedule, os.path.join(os.path.dirname(__file__),
+                                                "data", "sample_feed"))
+        self.timetable = self.schedule.timetable(datetime.date(2007, 6, 5))
+
+    def hours(self, hours, minutes=0):
+        return datetime.timedelta(hours=hours, minutes=minutes)
+
+    def small(self):
+        # A -> C directly, or faster through B with a transfer
+        return routing.Timetable(
+            datetime.date(2007, 6, 5), 1, ["A", "B", "C", "D"], {"STATION": ["A", "D"]},
+            pattern_stops=[[0, 2], [0, 1], [1, 2]],
+            pattern_trips=[[("DIRECT", "R1")], [("FEEDER", "R2")],
+                           [("EXPRESS", "R3")]],
+            departures=[[[8 * 3600], [10 * 3600]], [[8 * 3600], [8 * 3600 + 600]],
+                        [[8 * 3600 + 900], [9 * 3600]]],
+            arrivals=[[[8 * 3600], [10 * 3600]], [[8 * 3600], [8 * 3600 + 600]],
+                      [[8 * 3600 + 900], [9 * 3600]]],
+            boarding=[[True, False], [True, False], [True, False]],
+            alighting=[[False, True], [False, True], [False, True]],
+            transfers=[[], [], [], []])
+
+    def test_compile(self):
+        self.assertEqual(self.timetable.stop_ids,
+                         sorted(s.stop_id for s in self.schedule.stops))
+        trips = [trip_id for trips in self.timetable.pattern_trips
+                 for trip_id, _ in trips]
+        # the frequency based trips are expanded
+        self.assertEqual(trips.count("STBA"), 32)
+        self.assertEqual(set(trips),
+                         {t.trip_id for t in self.schedule.trips_on(
+                             datetime.date(2007, 6, 5))})
+        for departures in self.timetable.departures:
+            for column in departures:
+                self.assertEqual(column, sorted(column))
+        # the generic transfer walks, the trip and route specific ones are skipped
+        self.assertEqual(len(self.timetable.transfers[
+            self.timetable.stop_index["FUR_CREEK_RES"]]), 1)
+
+    def test_earliest_arrival(self):
+        journey = self.timetable.earliest_arrival("STAGECOACH", "BULLFROG",
+                                                  self.hours(6))
+        self.assertEqual(journey.arrival_time, self.hours(8, 10))
+        self.assertEqual(journey.transfers, 1)
+        self.assertEqual([(leg.trip_id, leg.from_stop_id, leg.to_stop_id)
+                          for leg in journey.legs],
+                         [("STBA", "STAGECOACH", "BEATTY_AIRPORT"),
+                          ("AB1", "BEATTY_AIRPORT", "BULLFROG")])
+        self.assertEqual(journey.legs[1].departure_time, self.hours(8))
+
+        journey = self.timetable.earliest_arrival("STAGECOACH", "BEATTY_AIRPORT",
+                                                  self.hours(6, 1))
+        self.assertEqual(journey.departure_time, self.hours(6, 30))
+        self.assertEqual(journey.arrival_time, self.hours(6, 50))
+
+    def test_unreachable(self):
+        # the Amargosa Valley trips only run on weekends
+        self.assertIsNone(self.timetable.earliest_arrival(
+            "STAGECOACH", "AMV", self.hours(6)))
+        self.assertIsNone(self.timetable.earliest_arrival(
+            "STAGECOACH", "BULLFROG", self.hours(23)))
+        self.assertEqual(self.timetable.pareto("STAGECOACH", "BULLFROG",
+                                               self.hours(23)), [])
+        with self.assertRaises(KeyError):
+            self.timetable.earliest_arrival("nowhere", "BULLFROG", self.hours(6))
+
+    def test_pareto(self):
+        timetable = self.small()
+        journeys = timetable.pareto("A", "C", self.hours(7))
+        self.assertEqual([(j.transfers, j.arrival_time) for j in journeys],
+                         [(0, self.hours(10)), (1, self.hours(9))])
+        self.assertEqual([leg.trip_id for leg in journeys[1].legs],
+                         ["FEEDER", "EXPRESS"])
+        self.assertEqual(timetable.earliest_arrival("A", "C", self.hours(7)),
+                         journeys[1])
+        self.assertEqual(timetable.earliest_arrival(
+            "A", "C", self.hours(7), max_transfers=0), journeys[0])
+        # the last trips are missed
+        self.assertIsNone(timetable.earliest_arrival("A", "C", self.hours(8, 1)))
+
+    def test_station(self):
+        timetable = self.small()
+        journey = timetable.earliest_arrival("STATION", "C", self.hours(7))
+        self.assertEqual(journey.legs[0].from_stop_id, "A")
+
+    def test_transfers(self):
+        timetable = self.small()
+        timetable.transfers[3].append((0, 300))
+        journey = timetable.earliest_arrival("D", "C", self.hours(7))
+        self.assertEqual([(leg.trip_id, leg.from_stop_id) for leg in journey.legs],
+                         [(None, "D"), ("FEEDER", "A"), ("EXPRESS", "B")])
+        self.assertEqual(journey.legs[0].arrival_time, self.hours(7, 5))
+        self.assertIsNone(timetable.earliest_arrival("D", "C", self.hours(7, 56)))
+
+    def test_change_time(self):
+        timetable = self.small()
+        # the express leaves B five minutes after the feeder arrives
+        timetable.change_seconds[1] = 600
+        journey = timetable.earliest_arrival("A", "C", self.hours(7))
+        self.assertEqual([leg.trip_id for leg in journey.legs], ["DIRECT"])
+        timetable.change_seconds[1] = 300
+        journey = timetable.earliest_arrival("A", "C", self.hours(7))
+        self.assertEqual([leg.trip_id for leg in journey.legs],
+                         ["FEEDER", "EXPRESS"])
+
+    def test_min_transfer_time(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            feed_dir = os.path.join(tmpdir, "sample_feed")
+            shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                         "data", "sample_feed"), feed_dir)
+            filename = os.path.join(feed_dir, "transfers.txt")
+            with open(filename) as f:
+                lines = f.read().splitlines()
+            lines = [lines[0] + ",min_transfer_time"] + [
+                line + "," for line in lines[1:]] + [
+                "2,BEATTY_AIRPORT,BEATTY_AIRPORT,,,,,900"]
+            with open(filename, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            schedule = Schedule(":memory:")
+            append_feed(schedule, feed_dir)
+        finally:
+            shutil.rmtree(tmpdir)
+        timetable = schedule.timetable(datetime.date(2007, 6, 5),
+                                       min_transfer_seconds=120)
+        airport = timetable.stop_index["BEATTY_AIRPORT"]
+        self.assertEqual(timetable.change_seconds[airport], 900)
+        self.assertEqual(set(timetable.change_seconds), {120, 900})
+        # the stagecoach arriving at 7:50 no longer makes it to AB1 at 8:00
+        journey = timetable.earliest_arrival("STAGECOACH", "BULLFROG",
+                                             self.hours(7, 10))
+        self.assertIsNone(journey)
+        journey = self.timetable.earliest_arrival("STAGECOACH", "BULLFROG",
+                                                  self.hours(7, 10))
+        self.assertEqual(journey.arrival_time, self.hours(8, 10))
+
+
 class TestIgnoreFiles(unittest.TestCase):
     def setUp(self):
         self.schedule = Schedule(":memory:")
@@ -130,5 +1681,61 @@ class TestIgnoreFiles(unittest.TestCase):
         ser = [service.service_id for service in self.schedule.services]
         self.assertEqual(ser, ["FULLW", "WE"])
 
+class TestCalendarDatesOnly(unittest.TestCase):
+    def load(self, **kwargs):
+        schedule = Schedule(":memory:")
+        data_location = os.path.join(os.path.dirname(__file__),
+                                     "data", "sample_feed")
+        overwrite_feed(schedule, data_location, ignore_files=["calendar.txt"],
+                       **kwargs)
+        return schedule
+
+    def check_dummy_services(self, schedule):
+        services = schedule.services
+        self.assertEqual([s.service_id for s in services], ['FULLW'])
+        self.assertEqual(services[0].start_date, datetime.date(2007, 6, 4))
+        self.assertEqual(services[0].end_date, datetime.date(2007, 6, 4))
+        self.assertFalse(services[0].monday)
+        self.assertEqual(len(schedule.service_exceptions), 1)
+
+    def test_dummy_services(self):
+        self.check_dummy_services(self.load())
+
+    def test_dummy_services_bulk(self):
+        self.check_dummy_services(self.load(bulk=True))
+
+
+class TestConvertColumns(unittest.TestCase):
+    def test_stop_times(self):
+        columns = convert_columns(StopTime, {
+            'trip_id': ['T1', 'T1', 'T1'],
+            'arrival_time': ['8:00:00', '25:01:02', None],
+            'pickup_type': ['0', None, '3'],
+        })
+        self.assertEqual(columns['trip_id'], ['T1', 'T1', 'T1'])
+        self.assertEqual(columns['arrival_time'],
+                         [datetime.timedelta(hours=8),
+                          datetime.timedelta(hours=25, minutes=1, seconds=2),
+                          None])
+        self.assertEqual(columns['pickup_type'], [0, None, 3])
+
+    def test_dates_and_bools(self):
+        columns = convert_columns(Service, {'monday': ['1', '0'],
+                                            'start_date': ['20070101', '20101231']})
+        self.assertEqual(columns['monday'], [True, False])
+        self.assertEqual(columns['start_date'], [datetime.date(2007, 1, 1),
+                                                 datetime.date(2010, 12, 31)])
+
+    def test_primary_key_defaults(self):
+        columns = convert_columns(Transfer, {'from_route_id': [None, 'R']})
+        self.assertEqual(columns['from_route_id'], ['', 'R'])
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            convert_columns(Service, {'start_date': ['2007-01-01']})
+        with self.assertRaises(ValueError):
+            convert_columns(StopTime, {'pickup_type': ['4']})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,6 +21,8 @@ setup(
                       'pytz>=2014.9',
                       'docopt'
                       ],
+    extras_require={'pyarrow': ['pyarrow'], 'numpy': ['numpy'],
+                    'asyncio': ['sqlalchemy[asyncio]>=2.0', 'aiosqlite']},
     tests_require=['nose'],
     test_suite='nose.collector',
     setup_requires=['setuptools_scm'],